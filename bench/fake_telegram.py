@@ -0,0 +1,144 @@
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+from collections import defaultdict, deque
+from aiohttp import web
+
+logger = logging.getLogger("bench.fake_telegram")
+
+# Bot API stand-in: answers the methods the bot uses with well-formed objects,
+# records every call and enforces Telegram-like flood limits with 429s
+# (per chat PER_CHAT_RATE msg/s, plus a random FLOOD_PROBABILITY share), so the
+# rate limiter and retry paths are part of what gets measured.
+PER_CHAT_RATE = 1.0
+PER_CHAT_BURST = 3
+_SENDS = ("sendMessage", "sendDocument", "sendAudio", "sendVideo", "sendMediaGroup",
+          "copyMessage", "forwardMessage", "editMessageText")
+
+
+class FakeTelegram:
+    def __init__(self, flood_probability: float = 0.0, seed: int = 1):
+        self.flood_probability = flood_probability
+        self.random = random.Random(seed)
+        self.calls = []  # (time, method, chat id, params, result)
+        self.flood_429 = 0
+        self.uploaded_bytes = 0
+        self._recent = defaultdict(deque)  # chat id -> send times within the last second
+        self._message_ids = defaultdict(int)
+        self._waiters = []  # (predicate, future)
+
+    def wait_for(self, predicate, timeout: float):
+        """Wait for a recorded call (time, method, chat id, params, result) matching predicate"""
+        for call in self.calls:
+            if predicate(call):
+                return asyncio.sleep(0, call)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((predicate, future))
+        return asyncio.wait_for(future, timeout)
+
+    def _record(self, method: str, chat_id, params: dict, result):
+        call = (time.monotonic(), method, chat_id, params, result)
+        self.calls.append(call)
+        for waiter in list(self._waiters):
+            predicate, future = waiter
+            if not future.done() and predicate(call):
+                future.set_result(call)
+                self._waiters.remove(waiter)
+            elif future.done():
+                self._waiters.remove(waiter)
+
+    def _flooded(self, chat_id) -> float:
+        """retry_after to answer with, 0 if the send goes through"""
+        if self.flood_probability and self.random.random() < self.flood_probability:
+            return 1
+        if chat_id is None:
+            return 0
+        now, recent = time.monotonic(), self._recent[chat_id]
+        while recent and now - recent[0] > PER_CHAT_BURST / PER_CHAT_RATE:
+            recent.popleft()
+        if len(recent) >= PER_CHAT_BURST:
+            return max(1, round(PER_CHAT_BURST / PER_CHAT_RATE - (now - recent[0])))
+        recent.append(now)
+        return 0
+
+    def _message(self, chat_id, **fields) -> dict:
+        self._message_ids[chat_id] += 1
+        return {"message_id": self._message_ids[chat_id], "date": int(time.time()),
+                "chat": {"id": chat_id or 0, "type": "private"}, **fields}
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == "multipart/form-data":
+            params = {}
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    size = 0
+                    while chunk := await part.read_chunk(256 * 1024):
+                        size += len(chunk)
+                    self.uploaded_bytes += size
+                    params[part.name] = {"file_name": part.filename, "file_size": size}
+                else:
+                    params[part.name] = await part.text()
+            return params
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    def _result(self, method: str, chat_id, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method in ("sendDocument", "sendAudio", "sendVideo"):
+            field = method[4:].lower()
+            upload = params.get(field)
+            file_id = upload if isinstance(upload, str) else uuid.uuid4().hex
+            size = upload["file_size"] if isinstance(upload, dict) else 0
+            return self._message(chat_id, document={"file_id": file_id, "file_unique_id": file_id[:16],
+                                                    "file_size": size})
+        if method == "sendMediaGroup":
+            # one message per item, typed like the item; a file_id is sent back as is
+            media = params.get("media") or "[]"
+            media = json.loads(media) if isinstance(media, str) else media
+            messages, group_id = [], uuid.uuid4().hex[:16]
+            for item in media:
+                ref = item.get("media", "")
+                upload = params.get(ref[len("attach://"):]) if ref.startswith("attach://") else None
+                file_id = ref if upload is None and not ref.startswith("attach://") else uuid.uuid4().hex
+                size = upload["file_size"] if isinstance(upload, dict) else 0
+                kind = item.get("type", "document")
+                fields = {"file_id": file_id, "file_unique_id": file_id[:16], "file_size": size}
+                if kind == "photo":
+                    fields = {"photo": [{**fields, "width": 1, "height": 1}]}
+                elif kind in ("audio", "video"):
+                    extra = {"width": 1, "height": 1} if kind == "video" else {}
+                    fields = {kind: {**fields, "duration": 0, **extra}}
+                else:
+                    fields = {"document": fields}
+                messages.append(self._message(chat_id, media_group_id=group_id, **fields))
+            return messages
+        if method in ("sendMessage", "editMessageText", "copyMessage", "forwardMessage"):
+            return self._message(chat_id, text=params.get("text", ""))
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        chat_id = int(params["chat_id"]) if params.get("chat_id") else None
+        if method in _SENDS:
+            retry_after = self._flooded(chat_id)
+            if retry_after:
+                self.flood_429 += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after},
+                }, status=429)
+        result = self._result(method, chat_id, params)
+        self._record(method, chat_id, params, result)
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=2 * 1024 ** 3)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
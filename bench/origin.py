@@ -0,0 +1,126 @@
+import os
+import re
+import shutil
+import random
+import asyncio
+import logging
+import subprocess
+from aiohttp import web
+
+logger = logging.getLogger("bench.origin")
+
+# Local media origin: every video id offers an m4a and an opus audio stream and
+# 360p/720p mp4 video streams. With ffmpeg they are real (tone + test pattern),
+# so post-processing does real work; without it they are random bytes of about
+# the same size. Served with Range support (parallel/resumed downloads) at
+# LATENCY per request. /api/video/<id> is what the bench extractor reads
+# (bench/plugins/yt_dlp_plugins/extractor/bench.py).
+ASSETS_DIR = os.getenv("BENCH_ASSETS_DIR", "/tmp/freedom_bench/assets")
+LATENCY = float(os.getenv("BENCH_ORIGIN_LATENCY", "0.02"))
+
+# name: (ext, vcodec, acodec, height, kbit/s, ffmpeg args)
+ASSETS = {
+    "audio_m4a": ("m4a", "none", "mp4a.40.2", None, 128,
+                  ["-f", "lavfi", "-i", "sine=frequency=440", "-c:a", "aac", "-b:a", "128k"]),
+    "audio_opus": ("webm", "none", "opus", None, 160,
+                   ["-f", "lavfi", "-i", "sine=frequency=440", "-c:a", "libopus", "-b:a", "160k"]),
+    "video_360": ("mp4", "avc1.4d401e", "mp4a.40.2", 360, 700,
+                  ["-f", "lavfi", "-i", "testsrc=size=640x360:rate=25", "-f", "lavfi", "-i", "sine",
+                   "-c:v", "libx264", "-preset", "ultrafast", "-b:v", "600k", "-c:a", "aac", "-b:a", "96k"]),
+    "video_720": ("mp4", "avc1.4d401f", "none", 720, 2500,
+                  ["-f", "lavfi", "-i", "testsrc=size=1280x720:rate=25",
+                   "-c:v", "libx264", "-preset", "ultrafast", "-b:v", "2500k", "-an"]),
+}
+
+
+def _generate(name: str, duration: int) -> str:
+    ext, _, _, _, kbps, args = ASSETS[name]
+    path = os.path.join(ASSETS_DIR, f"{name}_{duration}.{ext}")
+    if os.path.exists(path):
+        return path
+    os.makedirs(ASSETS_DIR, exist_ok=True)
+    if shutil.which("ffmpeg"):
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error", *args, "-t", str(duration), path], check=True)
+    else:
+        with open(path, "wb") as f:
+            f.write(os.urandom(kbps * 1000 // 8 * duration))
+    return path
+
+
+class Origin:
+    def __init__(self, durations=(60, 180, 600), seed: int = 1):
+        self.durations = durations
+        self.random = random.Random(seed)
+        self.files = {}  # (asset, duration) -> path
+        self.videos = {}  # id -> duration
+        self.served_bytes = 0
+        self.requests = 0
+        self.base_url = None
+
+    def prepare(self):
+        """Generate the assets (once, cached in ASSETS_DIR)"""
+        for duration in self.durations:
+            for name in ASSETS:
+                self.files[(name, duration)] = _generate(name, duration)
+
+    def new_video(self, duration: int = None) -> str:
+        """Register a video id, return its page URL"""
+        video_id = f"v{len(self.videos):05d}"
+        self.videos[video_id] = duration or self.random.choice(self.durations)
+        return f"{self.base_url}/watch/{video_id}"
+
+    def _formats(self, video_id: str):
+        duration = self.videos[video_id]
+        formats = []
+        for name, (ext, vcodec, acodec, height, kbps, _) in ASSETS.items():
+            path = self.files[(name, duration)]
+            formats.append({
+                "format_id": name, "ext": ext, "vcodec": vcodec, "acodec": acodec, "height": height,
+                "tbr": kbps, "filesize": os.path.getsize(path),
+                "url": f"{self.base_url}/media/{name}_{duration}.{ext}?v={video_id}",
+            })
+        return formats
+
+    async def _video(self, request: web.Request):
+        video_id = request.match_info["id"]
+        if video_id not in self.videos:
+            raise web.HTTPNotFound()
+        await asyncio.sleep(LATENCY)
+        return web.json_response({"id": video_id, "title": f"Bench {video_id}",
+                                  "duration": self.videos[video_id], "formats": self._formats(video_id)})
+
+    async def _media(self, request: web.Request):
+        path = os.path.join(ASSETS_DIR, request.match_info["name"])
+        if not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        await asyncio.sleep(LATENCY)
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else end, end)
+        response = web.StreamResponse(status=206 if match else 200, headers={
+            "Content-Type": "application/octet-stream", "Accept-Ranges": "bytes",
+            "Content-Length": str(end - start + 1),
+        })
+        if match:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await response.prepare(request)
+        self.requests += 1
+        with open(path, "rb") as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                chunk = f.read(min(left, 256 * 1024))
+                await response.write(chunk)
+                left -= len(chunk)
+                self.served_bytes += len(chunk)
+        return response
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/video/{id}", self._video)
+        app.router.add_get("/media/{name}", self._media)
+        app.router.add_get("/watch/{id}", lambda r: web.Response(text="bench video page"))
+        return app
@@ -0,0 +1,18 @@
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class BenchIE(InfoExtractor):
+    """Videos of the benchmark's local media origin (bench/origin.py)"""
+
+    IE_NAME = "bench"
+    _VALID_URL = r"(?P<base>https?://(?:127\.0\.0\.1|localhost):\d+)/watch/(?P<id>[\w-]+)"
+
+    def _real_extract(self, url):
+        base, video_id = self._match_valid_url(url).group("base", "id")
+        data = self._download_json(f"{base}/api/video/{video_id}", video_id)
+        return {
+            "id": video_id,
+            "title": data["title"],
+            "duration": data["duration"],
+            "formats": data["formats"],
+        }
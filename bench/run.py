@@ -0,0 +1,474 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import asyncio
+import argparse
+import logging
+import subprocess
+from aiohttp import web, ClientSession, ClientTimeout
+
+from bench.origin import Origin
+from bench.fake_telegram import FakeTelegram
+
+logger = logging.getLogger("bench.run")
+
+# End-to-end load run of the real processes against local stand-ins:
+#   fake Bot API (bench/fake_telegram.py)  <- web app + workers send here
+#   media origin + yt-dlp extractor plugin (bench/origin.py, bench/plugins)
+#   S3: moto server if installed, otherwise S3_ENDPOINT_URL (docker-compose MinIO)
+#   Redis: a real one (REDIS_URL), the database gets flushed
+# Simulated users post message updates to the webhook, press the scenario's
+# button on the format keyboard they get back (the real probe: extract pool,
+# meta cache, FORMAT|<info token>|<format>) and wait for the file (or the link).
+# Stage times come from the jobs' progress reports (pub/sub "progress").
+#
+#   docker-compose up -d redis minio
+#   python -m bench.run --scenario mixed --jobs 200 --users 50 --workers 2
+#   python -m bench.run --scenario mixed ... --save-baseline   # after a known-good change
+# Without --save-baseline the run is compared with bench/baselines/<scenario>.json
+# and exits 1 on a regression beyond --tolerance. A baseline keeps the options it
+# was recorded with ("config"): large.json is --jobs 20 --users 5 --workers 1,
+# moto builds each completed multipart object (~300 MB there) in memory.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+BASELINES_DIR = os.path.join(BENCH_DIR, "baselines")
+WORK_DIR = os.getenv("BENCH_WORK_DIR", "/tmp/freedom_bench")
+TOKEN = "123456:BENCH-TOKEN"
+SECRET = "bench-secret"
+SAMPLE_INTERVAL = 0.25
+
+# button pressed -> share of users: the FORMAT|<token>|<choice> button of the probe keyboard
+SCENARIOS = {
+    "audio": {"choices": {"mp3": 1.0}, "durations": (60, 180, 600)},
+    "video": {"choices": {"720p": 1.0}, "durations": (60, 180, 600)},
+    "mixed": {"choices": {"mp3": 0.7, "720p": 0.3}, "durations": (60, 180, 600)},
+    # past the 50 MB Bot API limit: S3 path
+    "large": {"choices": {"720p": 1.0}, "durations": (1800,)},
+}
+STAGES = ("webhook", "probe", "enqueue", "queue_wait", "download", "transcode", "upload", "e2e")
+# compared with the baseline: (path in the report, higher is better)
+CHECKS = [("throughput", True), ("peak_rss_mb.web", False), ("peak_rss_mb.workers", False),
+          ("peak_disk_mb", False)] + [(f"stages.{s}.p95", False) for s in STAGES]
+# differences below this are noise whatever the ratio (seconds / MB)
+ABS_FLOOR = 0.05
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))], 3)
+
+
+def _rss_kb(pid: int) -> int:
+    """Resident memory of a process and all its descendants"""
+    total, children = 0, [pid]
+    while children:
+        pid = children.pop()
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                total += next((int(line.split()[1]) for line in f if line.startswith("VmRSS:")), 0)
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as f:
+                    children += [int(c) for c in f.read().split()]
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _start_s3(env: dict):
+    """S3 for the run: moto in-process unless S3_ENDPOINT_URL is given. Returns a stop function."""
+    env.setdefault("S3_BUCKET", "freedom-bench")
+    env.setdefault("AWS_ACCESS_KEY_ID", os.getenv("AWS_ACCESS_KEY_ID", "minioadmin"))
+    env.setdefault("AWS_SECRET_ACCESS_KEY", os.getenv("AWS_SECRET_ACCESS_KEY", "minioadmin"))
+    stop = None
+    if not env.get("S3_ENDPOINT_URL"):
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            raise SystemExit("S3: install moto or set S3_ENDPOINT_URL (docker-compose MinIO: http://localhost:9000)")
+        port = _free_port()
+        server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+        server.start()
+        env["S3_ENDPOINT_URL"] = f"http://127.0.0.1:{port}"
+        stop = server.stop
+    import boto3
+    s3 = boto3.client("s3", endpoint_url=env["S3_ENDPOINT_URL"], region_name="us-east-1",
+                      aws_access_key_id=env["AWS_ACCESS_KEY_ID"],
+                      aws_secret_access_key=env["AWS_SECRET_ACCESS_KEY"])
+    try:
+        s3.create_bucket(Bucket=env["S3_BUCKET"])
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    return stop or (lambda: None)
+
+
+class Run:
+    def __init__(self, args):
+        self.args = args
+        self.scenario = SCENARIOS[args.scenario]
+        self.random = random.Random(args.seed)
+        self.telegram = FakeTelegram(flood_probability=args.flood, seed=args.seed)
+        self.origin = Origin(durations=self.scenario["durations"], seed=args.seed)
+        self.stages = {s: [] for s in STAGES}
+        self.jobs = {}  # job id -> {stage: first seen}
+        self.chat_jobs = {}  # chat id -> job id
+        self.completed = self.failed = self.timeouts = 0
+        self.peak_rss = {"web": 0, "workers": 0}
+        self.peak_disk = 0
+        self.processes = {}  # name -> Popen
+        self._update_id = 0
+        self._runners = []
+        self.http = self.redis = None
+        self.stop_s3 = lambda: None
+
+    # ========================
+    # Environment
+    # ========================
+    async def _serve(self, app: web.Application) -> str:
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        port = _free_port()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        self._runners.append(runner)
+        return f"http://127.0.0.1:{port}"
+
+    def _env(self) -> dict:
+        env = dict(os.environ)
+        for name in ("download", "metrics"):
+            shutil.rmtree(os.path.join(WORK_DIR, name), ignore_errors=True)
+        env.update({
+            "BOT_TOKEN": TOKEN,
+            "WEBHOOK_SECRET": SECRET,
+            "TELEGRAM_API_URL": self.telegram_url,
+            "REDIS_URL": self.args.redis_url,
+            "DOWNLOAD_DIR": os.path.join(WORK_DIR, "download"),
+            "PROMETHEUS_MULTIPROC_DIR": os.path.join(WORK_DIR, "metrics"),
+            "TRANSCODE_SLOTS_DIR": os.path.join(WORK_DIR, "slots"),
+            "PYTHONPATH": os.pathsep.join([ROOT, os.path.join(BENCH_DIR, "plugins"), env.get("PYTHONPATH", "")]),
+            "PYTHONUNBUFFERED": "1",
+        })
+        return env
+
+    def _spawn(self, name: str, module: str, env: dict):
+        # as modules: run as a script, bot/main.py would import bot/utils.py as the utils package
+        log = open(os.path.join(WORK_DIR, f"{name}.log"), "w")
+        self.processes[name] = subprocess.Popen([sys.executable, "-m", module], cwd=ROOT, env=env,
+                                                stdout=log, stderr=subprocess.STDOUT)
+
+    async def start(self):
+        os.makedirs(WORK_DIR, exist_ok=True)
+        self.origin.prepare()
+        self.telegram_url = await self._serve(self.telegram.app())
+        self.origin.base_url = await self._serve(self.origin.app())
+        import redis.asyncio
+        self.redis = redis.asyncio.from_url(self.args.redis_url)
+        await self.redis.flushdb()
+
+        env = self._env()
+        self.stop_s3 = _start_s3(env)
+        web_port = _free_port()
+        self.web_url = f"http://127.0.0.1:{web_port}"
+        self._spawn("web", "bot.main", {**env, "PORT": str(web_port), "RENDER_EXTERNAL_URL": self.web_url})
+        for i in range(self.args.workers):
+            self._spawn(f"worker{i}", "downloader.worker", {
+                **env, "WORKER_MODE": self.args.worker_mode, "WORKER_NAME": f"bench{i}",
+                "WORKER_METRICS_PORT": str(_free_port()),
+            })
+        # the web app sets its webhook on startup, before it listens: wait for both
+        await self.telegram.wait_for(lambda c: c[1] == "setWebhook", timeout=60)
+        self.http = ClientSession(timeout=ClientTimeout(total=60))
+        for _ in range(120):
+            try:
+                async with self.http.get(f"{self.web_url}/metrics") as resp:
+                    if resp.status == 200:
+                        break
+            except OSError:
+                pass
+            await asyncio.sleep(0.5)
+        else:
+            raise SystemExit(f"Web app not listening on {self.web_url}, see {WORK_DIR}/web.log")
+
+    async def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.http is not None:
+            await self.http.close()
+        if self.redis is not None:
+            await self.redis.close()
+        for runner in self._runners:
+            await runner.cleanup()
+        self.stop_s3()
+
+    # ========================
+    # Measurements
+    # ========================
+    async def sample(self):
+        """Peak RSS (web, all workers with their job processes) and workspace disk"""
+        download_dir = os.path.join(WORK_DIR, "download")
+        while True:
+            web_kb = _rss_kb(self.processes["web"].pid)
+            workers_kb = sum(_rss_kb(p.pid) for n, p in self.processes.items() if n != "web")
+            self.peak_rss["web"] = max(self.peak_rss["web"], web_kb / 1024)
+            self.peak_rss["workers"] = max(self.peak_rss["workers"], workers_kb / 1024)
+            self.peak_disk = max(self.peak_disk, _dir_size(download_dir) / 1024 / 1024)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    async def follow_progress(self):
+        """First time each job was seen in each stage"""
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe("progress")
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            job_id = message["data"].decode()
+            state = {k.decode(): v.decode() for k, v in (await self.redis.hgetall(f"progress:{job_id}")).items()}
+            seen = self.jobs.setdefault(job_id, {})
+            seen.setdefault(state.get("stage"), time.monotonic())
+            if state.get("user"):
+                self.chat_jobs.setdefault(int(state["user"]), job_id)
+
+    def _job_stages(self, chat_id: int, delivered: float):
+        seen = dict(self.jobs.get(self.chat_jobs.get(chat_id), {}))
+        seen.setdefault("done", delivered)  # its report may still be on the way
+
+        def span(stage, start, *ends):
+            end = next((seen[e] for e in ends if e in seen), None)
+            if start in seen and end:
+                self.stages[stage].append(end - seen[start])
+
+        span("queue_wait", "queued", "downloading", "uploading", "done")
+        span("download", "downloading", "transcoding", "uploading", "done")
+        span("transcode", "transcoding", "uploading", "done")
+        span("upload", "uploading", "done")
+
+    # ========================
+    # Users
+    # ========================
+    async def _post_update(self, update: dict) -> float:
+        self._update_id += 1
+        started = time.monotonic()
+        async with self.http.post(f"{self.web_url}/webhook/{SECRET}", json={"update_id": self._update_id, **update},
+                                  headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as response:
+            response.raise_for_status()
+        return time.monotonic() - started
+
+    def _user(self, chat_id: int) -> dict:
+        return {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+
+    def _choice(self) -> str:
+        choices = self.scenario["choices"]
+        return self.random.choices(list(choices), weights=list(choices.values()))[0]
+
+    async def user(self, chat_id: int, url: str, choice: str):
+        timeout = self.args.job_timeout
+        sent = time.monotonic()
+        self.stages["webhook"].append(await self._post_update({"message": {
+            "message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+            "from": self._user(chat_id), "text": url,
+        }}))
+        try:
+            # the format keyboard, or the probe's failure message
+            call = await self.telegram.wait_for(lambda c: c[2] == chat_id and c[1] == "sendMessage" and (
+                "reply_markup" in c[3] or "Не удалось получить форматы" in c[3].get("text", "")), timeout)
+            if "reply_markup" not in call[3]:
+                self.failed += 1
+                return
+            self.stages["probe"].append(call[0] - sent)
+            buttons = [b for row in json.loads(call[3]["reply_markup"])["inline_keyboard"] for b in row]
+            data = next((b["callback_data"] for b in buttons
+                         if b.get("callback_data", "").startswith("FORMAT|")
+                         and b["callback_data"].endswith(f"|{choice}")), None)
+            if data is None:
+                logger.error("No %s button on the probe keyboard: %s", choice, [b.get("text") for b in buttons])
+                self.failed += 1
+                return
+            pressed = time.monotonic()
+            await self._post_update({"callback_query": {
+                "id": str(self._update_id), "from": self._user(chat_id), "chat_instance": str(chat_id),
+                "message": call[4], "data": data,
+            }})
+            delivered = await self.telegram.wait_for(lambda c: c[2] == chat_id and c[0] > pressed and (
+                c[1] in ("sendDocument", "sendAudio", "sendVideo")
+                or (c[1] == "sendMessage" and ("по ссылке" in c[3].get("text", "") or "ошибка" in c[3].get("text", "")))
+            ), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return
+        if "ошибка" in delivered[3].get("text", ""):
+            self.failed += 1
+            return
+        self.completed += 1
+        self.stages["e2e"].append(delivered[0] - pressed)
+        queued = self.jobs.get(self.chat_jobs.get(chat_id), {}).get("queued")
+        if queued:
+            self.stages["enqueue"].append(queued - pressed)
+        self._job_stages(chat_id, delivered[0])
+
+    async def load(self):
+        """--jobs users over --users concurrent slots, --rate new users per second (0: all at once)"""
+        slots = asyncio.Semaphore(self.args.users)
+        urls = []
+
+        async def one(chat_id: int):
+            async with slots:
+                if urls and self.random.random() < self.args.repeat:
+                    url = self.random.choice(urls)  # same link again: inflight join / result cache
+                else:
+                    url = self.origin.new_video()
+                    urls.append(url)
+                await self.user(chat_id, url, self._choice())
+
+        tasks = []
+        for n in range(self.args.jobs):
+            tasks.append(asyncio.create_task(one(100000 + n)))
+            if self.args.rate:
+                await asyncio.sleep(self.random.expovariate(self.args.rate))
+        await asyncio.gather(*tasks)
+
+    async def run(self) -> dict:
+        background = []
+        try:
+            # inside try: a failed start must not leave its web app and workers running
+            await self.start()
+            background = [asyncio.create_task(self.sample()), asyncio.create_task(self.follow_progress())]
+            started = time.monotonic()
+            await self.load()
+            wall = time.monotonic() - started
+        finally:
+            for task in background:
+                task.cancel()
+            await self.stop()
+        return self.report(wall)
+
+    def report(self, wall: float) -> dict:
+        return {
+            "scenario": self.args.scenario,
+            "config": {k: getattr(self.args, k) for k in ("jobs", "users", "rate", "repeat", "flood",
+                                                          "workers", "worker_mode", "seed")},
+            "wall_seconds": round(wall, 2),
+            "throughput": round(self.completed / wall, 3) if wall else 0,  # delivered jobs/s
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "flood_429": self.telegram.flood_429,
+            "origin_mb": round(self.origin.served_bytes / 1024 / 1024, 1),
+            "telegram_upload_mb": round(self.telegram.uploaded_bytes / 1024 / 1024, 1),
+            "peak_rss_mb": {k: round(v, 1) for k, v in self.peak_rss.items()},
+            "peak_disk_mb": round(self.peak_disk, 1),
+            "stages": {stage: {"n": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+                               "p99": percentile(values, 99)}
+                       for stage, values in self.stages.items()},
+        }
+
+
+# ========================
+# Report / baselines
+# ========================
+def _lookup(report: dict, path: str):
+    for part in path.split("."):
+        report = report.get(part) if isinstance(report, dict) else None
+    return report
+
+
+def compare(report: dict, baseline: dict, tolerance: float):
+    """Regressions of report against baseline: [(metric, baseline value, value)]"""
+    regressions = []
+    for path, higher_better in CHECKS:
+        old, new = _lookup(baseline, path), _lookup(report, path)
+        if old is None or new is None or abs(new - old) < ABS_FLOOR:
+            continue
+        worse = new < old * (1 - tolerance) if higher_better else new > old * (1 + tolerance)
+        if worse:
+            regressions.append((path, old, new))
+    return regressions
+
+
+def print_report(report: dict):
+    print(f"\n{report['scenario']}: {report['completed']} delivered, {report['failed']} failed, "
+          f"{report['timeouts']} timed out in {report['wall_seconds']}s -> {report['throughput']} jobs/s")
+    print(f"429s: {report['flood_429']}  origin: {report['origin_mb']} MB  "
+          f"telegram uploads: {report['telegram_upload_mb']} MB")
+    print(f"peak RSS: web {report['peak_rss_mb']['web']} MB, workers {report['peak_rss_mb']['workers']} MB  "
+          f"peak disk: {report['peak_disk_mb']} MB")
+    print(f"\n{'stage':<12}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, row in report["stages"].items():
+        cells = "".join(f"{'-' if row[q] is None else row[q]:>10}" for q in ("p50", "p95", "p99"))
+        print(f"{stage:<12}{row['n']:>6}{cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark against local stand-ins")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="mixed")
+    parser.add_argument("--jobs", type=int, default=100, help="simulated requests")
+    parser.add_argument("--users", type=int, default=20, help="requests in flight at once")
+    parser.add_argument("--rate", type=float, default=0, help="new requests per second (0: as fast as slots free up)")
+    parser.add_argument("--repeat", type=float, default=0.1, help="share of requests for an already requested link")
+    parser.add_argument("--flood", type=float, default=0.0, help="share of Bot API sends answered with 429")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--worker-mode", choices=("fork", "asyncio"), default="fork")
+    parser.add_argument("--job-timeout", type=float, default=600)
+    parser.add_argument("--redis-url", default=os.getenv("BENCH_REDIS_URL", "redis://localhost:6379/15"),
+                        help="flushed before the run, use a spare database")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    report = asyncio.run(Run(args).run())
+    print_report(report)
+    os.makedirs(os.path.join(WORK_DIR, "results"), exist_ok=True)
+    with open(os.path.join(WORK_DIR, "results", f"{args.scenario}-{int(time.time())}.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline_path = os.path.join(BASELINES_DIR, f"{args.scenario}.json")
+    if args.save_baseline:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved: {baseline_path}")
+        return
+    if not os.path.exists(baseline_path):
+        print(f"\nNo baseline for {args.scenario} yet (--save-baseline)")
+        return
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline.get("config") != report["config"]:
+        print("\nWarning: baseline was recorded with a different configuration")
+    regressions = compare(report, baseline, args.tolerance)
+    for path, old, new in regressions:
+        print(f"REGRESSION {path}: {old} -> {new}")
+    if regressions:
+        raise SystemExit(1)
+    print(f"\nWithin {args.tolerance:.0%} of the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+from bench.run import ROOT, BASELINES_DIR
+
+# Cold start of the webhook process: fresh interpreters import bot.main and
+# build the app (everything before on_startup/set_webhook), reporting the
+# median and the modules that ended up loaded. The web process must not load
+# the download side (yt-dlp, boto3, the job code); that fails the run outright.
+#
+#   python -m bench.startup [--runs 7] [--save-baseline]
+FORBIDDEN = ("yt_dlp", "boto3", "botocore", "downloader.task", "downloader.transcode")
+# differences below this are noise whatever the ratio (seconds)
+ABS_FLOOR = 0.05
+
+_PROBE = """
+import sys, time, json
+started = time.perf_counter()
+import bot.main
+bot.main.create_app()
+total = time.perf_counter() - started
+print(json.dumps({"seconds": total, "modules": sorted(sys.modules)}))
+"""
+
+
+def measure(runs: int) -> dict:
+    env = {**os.environ, "PYTHONPATH": ROOT, "BOT_TOKEN": "123456:BENCH-TOKEN",
+           "RENDER_EXTERNAL_URL": "http://127.0.0.1:1"}
+    samples, modules = [], []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", _PROBE], cwd=ROOT, env=env, check=True,
+                             capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        samples.append(result["seconds"])
+        modules = result["modules"]
+    return {
+        "runs": runs,
+        "median_seconds": round(statistics.median(samples), 3),
+        "max_seconds": round(max(samples), 3),
+        "modules": len(modules),
+        "forbidden": [m for m in FORBIDDEN if m in modules],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook process cold start time")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = measure(args.runs)
+    print(f"import + create_app: median {report['median_seconds']}s, max {report['max_seconds']}s, "
+          f"{report['modules']} modules")
+    if report["forbidden"]:
+        print(f"FAIL: the web process loads {', '.join(report['forbidden'])}")
+        raise SystemExit(1)
+
+    baseline_path = os.path.join(BASELINES_DIR, "startup.json")
+    if args.save_baseline:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved: {baseline_path}")
+        return
+    if not os.path.exists(baseline_path):
+        print("No startup baseline yet (--save-baseline)")
+        return
+    with open(baseline_path) as f:
+        old = json.load(f)["median_seconds"]
+    new = report["median_seconds"]
+    if new - old >= ABS_FLOOR and new > old * (1 + args.tolerance):
+        print(f"REGRESSION median_seconds: {old} -> {new}")
+        raise SystemExit(1)
+    print(f"Within {args.tolerance:.0%} of the baseline ({old}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import os
+import re
+import json
+import secrets
+from utils.state_store import StateStore
+from downloader.inflight import normalize_url
+
+# Many links in one message (or a .txt file) make one batch instead of one
+# probe, keyboard and job per link: the links are extracted, deduplicated by
+# their normalized form and kept under a short token until the user picks a
+# format. Then they go out as one parent job (downloader/album.py, batch_job)
+# that probes them on the worker with bounded concurrency, runs them as tracks
+# with bounded parallelism and reports into one status message.
+BULK_MAX_LINKS = int(os.getenv("BULK_MAX_LINKS", "50"))
+BULK_TTL = int(os.getenv("BULK_TTL", "1800"))
+BULK_MAX_FILE_BYTES = int(os.getenv("BULK_MAX_FILE_BYTES", str(256 * 1024)))
+
+_URL_RE = re.compile(r"https?://[^\s<>\"']+", re.I)
+_TRAILING = ".,;:!?)]}»\"'"
+
+_store = StateStore("bulk", BULK_TTL)
+
+
+def extract_urls(text: str) -> list:
+    """Links of a text in order of appearance, one per normalized URL"""
+    urls, seen = [], set()
+    for match in _URL_RE.finditer(text or ""):
+        url = match.group().rstrip(_TRAILING)
+        try:
+            key = normalize_url(url)
+        except ValueError:
+            continue
+        if key not in seen:
+            seen.add(key)
+            urls.append(url)
+    return urls
+
+
+async def open_batch(urls: list) -> str:
+    """Keep links until a format is picked; return token for callback_data"""
+    token = secrets.token_urlsafe(6)
+    await _store.set(token, {"urls": json.dumps(urls[:BULK_MAX_LINKS])})
+    return token
+
+
+async def take_batch(token: str):
+    """Links of a token (once, across replicas), None if expired or already taken"""
+    raw = (await _store.take(token, "urls")).get("urls")
+    return json.loads(raw) if raw is not None else None
@@ -0,0 +1,130 @@
+import os
+import asyncio
+import logging
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from utils.metrics import RETRIES
+
+logger = logging.getLogger("bot.extract_pool")
+
+# Long-lived extraction processes with warm yt_dlp.YoutubeDL instances:
+# interpreter start, yt-dlp import and extractor registration are paid once
+# per worker process instead of once per probe.
+POOL_SIZE = int(os.getenv("EXTRACT_POOL_SIZE", "2"))
+MAX_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", str(POOL_SIZE)))
+MAX_PENDING = int(os.getenv("EXTRACT_QUEUE_SIZE", "32"))
+CALL_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "30"))
+RECYCLE_AFTER_CALLS = int(os.getenv("EXTRACT_RECYCLE_AFTER", "200"))
+RECYCLE_RSS_MB = int(os.getenv("EXTRACT_RECYCLE_RSS_MB", "400"))
+
+BASE_OPTS = {"quiet": True, "no_warnings": True, "skip_download": True}
+
+
+class ExtractorBusy(Exception):
+    """Too many extractions waiting; caller should back off"""
+
+
+class ExtractionError(Exception):
+    """yt-dlp failed; carries only the message (yt-dlp errors don't pickle)"""
+
+
+# ---- runs inside pool processes ----
+_ydls = {}
+
+
+def _get_ydl(opts: tuple):
+    ydl = _ydls.get(opts)
+    if ydl is None:
+        from yt_dlp import YoutubeDL
+        ydl = _ydls[opts] = YoutubeDL({**BASE_OPTS, **dict(opts)})
+    return ydl
+
+
+def _warm():
+    _get_ydl(())
+
+
+def _extract(url: str, opts: tuple):
+    ydl = _get_ydl(opts)
+    try:
+        info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        raise ExtractionError(str(e)) from None
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    return info, rss_mb
+
+
+# ---- event loop side ----
+class ExtractorPool:
+    def __init__(self):
+        self._executor = None
+        self._sem = None
+        self._pending = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=POOL_SIZE,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm,
+                max_tasks_per_child=RECYCLE_AFTER_CALLS,
+            )
+        return self._executor
+
+    def recycle(self, reason: str, kill: bool = False):
+        old, self._executor = self._executor, None
+        if old is None:
+            return
+        logger.info("Recycling extraction pool: %s", reason)
+        if kill:
+            # a hung extraction never returns; its process has to go
+            for proc in list((old._processes or {}).values()):
+                proc.terminate()
+        old.shutdown(wait=False)
+
+    async def extract(self, url: str, **opts) -> dict:
+        """Return sanitized info dict (raises ExtractionError / ExtractorBusy / TimeoutError)"""
+        if self._pending >= MAX_PENDING:
+            raise ExtractorBusy(f"{self._pending} extractions pending")
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        key = tuple(sorted(opts.items()))
+        self._pending += 1
+        try:
+            async with self._sem:
+                for attempt in (1, 2):
+                    executor = self._get_executor()
+                    fut = asyncio.get_running_loop().run_in_executor(executor, _extract, url, key)
+                    try:
+                        info, rss_mb = await asyncio.wait_for(fut, CALL_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        if self._executor is executor:
+                            self.recycle(f"timeout on {url}", kill=True)
+                        raise
+                    except BrokenProcessPool:
+                        # another call's timeout killed the pool under us
+                        if self._executor is executor:
+                            self.recycle("broken pool")
+                        if attempt == 2:
+                            raise
+                        RETRIES.labels("extract_pool").inc()
+                        continue
+                    if rss_mb > RECYCLE_RSS_MB and self._executor is executor:
+                        self.recycle(f"worker RSS {rss_mb} MB")
+                    return info
+        finally:
+            self._pending -= 1
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+pool = ExtractorPool()
+
+
+async def extract_info(url: str, **opts) -> dict:
+    return await pool.extract(url, **opts)
@@ -0,0 +1,53 @@
+import os
+import json
+from typing import Any, Dict, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DEFAULT_DESTINY
+
+from utils.state_store import StateStore
+
+# FSM of all web replicas in Redis: one hash per chat/user ("state", "data" as
+# compact JSON), so the state lookup aiogram does for every update and the
+# handlers' get_data share one HGETALL, usually served from the write-through
+# cache (utils/state_store.py). Idle conversations expire after FSM_TTL.
+FSM_TTL = int(os.getenv("FSM_TTL", "86400"))
+
+
+class RedisFSMStorage(BaseStorage):
+    def __init__(self, store: StateStore = None):
+        self.store = store or StateStore("fsm", FSM_TTL)
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = [key.bot_id, key.chat_id, key.user_id]
+        if key.thread_id:
+            parts.append(f"t{key.thread_id}")
+        if key.business_connection_id:
+            parts.append(f"b{key.business_connection_id}")
+        if key.destiny != DEFAULT_DESTINY:
+            parts.append(key.destiny)
+        return ":".join(map(str, parts))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            await self.store.delete(self._key(key), "state")
+        else:
+            await self.store.set(self._key(key), {"state": state})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state = (await self.store.get(self._key(key))).get("state")
+        return state.decode() if state else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if not data:
+            await self.store.delete(self._key(key), "data")
+            return
+        await self.store.set(self._key(key), {"data": json.dumps(data, separators=(",", ":"), ensure_ascii=False)})
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        data = (await self.store.get(self._key(key))).get("data")
+        return json.loads(data) if data else {}
+
+    async def close(self) -> None:
+        pass
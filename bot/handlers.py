@@ -1,48 +1,111 @@
 import logging
-from aiogram import Dispatcher
+from aiogram import Dispatcher, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
 
 from bot.keyboards import (
     build_format_keyboard,
     build_search_results_keyboard,
     build_album_keyboard,
     build_pagination_keyboard,
+    build_bulk_keyboard,
 )
 from bot.state import DownloadStates
 from bot.messages import (
     MSG_WELCOME,
     MSG_SELECT_FORMAT,
     MSG_JOB_QUEUED,
+    MSG_JOB_ATTACHED,
     MSG_UNKNOWN_ACTION,
+    MSG_SEARCH_EXPIRED,
+    MSG_LINK_EXPIRED,
+    MSG_ALBUM_FAILED,
+    MSG_BULK_SELECT,
+    MSG_BULK_TRUNCATED,
+    MSG_BULK_QUEUED,
+    MSG_BULK_EXPIRED,
+    MSG_BULK_NO_LINKS,
+    MSG_BULK_BAD_FILE,
 )
 from bot.utils import (
     is_url,
     probe_formats_async,
     enqueue_download_task,
-    search_youtube_async,
     get_album_meta_async,
+    open_album,
+    get_album,
+    enqueue_batch,
 )
+from bot.bulk import (
+    BULK_MAX_LINKS,
+    BULK_MAX_FILE_BYTES,
+    extract_urls,
+    open_batch,
+    take_batch,
+)
+from bot.search_session import open_session, get_page, get_result
+from bot.progress import watch
+from downloader.inflight import PENDING
+from utils.info_store import get_link
 
 logger = logging.getLogger("bot.handlers")
 
 
 def register_handlers(dp: Dispatcher):
     dp.message.register(cmd_start, Command("start"))
+    dp.message.register(handle_document, F.document)
     dp.message.register(handle_text)
     dp.callback_query.register(handle_callback)
 
 
-async def cmd_start(message: Message):
+async def _reply_queued(callback: CallbackQuery, job: dict, track: bool = True):
+    msg = await callback.message.reply(MSG_JOB_ATTACHED if job.get("attached") else MSG_JOB_QUEUED)
+    # это сообщение дальше показывает прогресс задачи
+    if track and job["job_id"] != PENDING:
+        await watch(job["job_id"], msg.chat.id, msg.message_id)
+
+
+async def cmd_start(message: Message, state: FSMContext):
     await message.reply(MSG_WELCOME)
-    await DownloadStates.waiting_for_link.set()
+    await state.set_state(DownloadStates.waiting_for_link)
+
+
+async def _offer_batch(message: Message, urls: list):
+    text = MSG_BULK_SELECT.format(count=min(len(urls), BULK_MAX_LINKS))
+    if len(urls) > BULK_MAX_LINKS:
+        text = MSG_BULK_TRUNCATED.format(limit=BULK_MAX_LINKS) + "\n" + text
+    token = await open_batch(urls)
+    await message.reply(text, reply_markup=build_bulk_keyboard(token))
+
+
+async def handle_document(message: Message):
+    # .txt со ссылками → пакет (bot/bulk.py)
+    doc = message.document
+    is_text = (doc.mime_type or "").startswith("text/") or (doc.file_name or "").lower().endswith(".txt")
+    if not is_text or (doc.file_size or 0) > BULK_MAX_FILE_BYTES:
+        await message.reply(MSG_BULK_BAD_FILE.format(limit=BULK_MAX_FILE_BYTES // 1024))
+        return
+    data = await message.bot.download(doc)
+    urls = extract_urls(data.read().decode("utf-8", errors="replace"))
+    if not urls:
+        await message.reply(MSG_BULK_NO_LINKS)
+        return
+    await _offer_batch(message, urls)
 
 
-async def handle_text(message: Message):
-    text = message.text.strip()
-    if is_url(text):
-        # Ссылка → получаем форматы
-        opts = await probe_formats_async(text)
+async def handle_text(message: Message, state: FSMContext):
+    text = (message.text or "").strip()
+    if not text:
+        return
+    # Несколько ссылок → один пакет вместо задачи на каждую
+    urls = extract_urls(text)
+    if len(urls) > 1:
+        await _offer_batch(message, urls)
+        return
+    if urls:
+        # Ссылка → получаем форматы (клавиатура с токеном, не с URL)
+        opts = await probe_formats_async(urls[0])
         if not opts:
             await message.reply(
                 "Не удалось получить форматы для этой ссылки. "
@@ -51,56 +114,135 @@ async def handle_text(message: Message):
             return
         kb = build_format_keyboard(opts, token_id=message.message_id)
         await message.reply(MSG_SELECT_FORMAT, reply_markup=kb)
-        await DownloadStates.waiting_for_format.set()
+        await state.set_state(DownloadStates.waiting_for_format)
         return
 
     # Текстовый поиск
     query = text
-    results, pagination = await search_youtube_async(query, page=1)
-    if not results:
+    session = await open_session(query)
+    if not session:
         await message.reply(f"По запросу '{query}' ничего не найдено.")
         return
-    kb = build_search_results_keyboard(results, pagination, token_id=message.message_id)
+    results, pagination = await get_page(session, 1)
+    kb = build_search_results_keyboard(results, pagination, session)
     await message.reply(f"Результаты поиска для «{query}»:",
                         reply_markup=kb)
-    await DownloadStates.waiting_for_format.set()
+    await state.set_state(DownloadStates.waiting_for_format)
 
 
 async def handle_callback(callback: CallbackQuery):
     data = callback.data or ""
 
-    # FORMAT|<url>|<format_id>
+    # FORMAT|<info token>|<format_id> (старые клавиатуры: FORMAT|<url>|<format_id>)
     if data.startswith("FORMAT|"):
+        _, ref, fmt = data.split("|", 2)
+        if is_url(ref):
+            url, token, sched = ref, None, None
+        else:
+            (url, sched), token = await get_link(ref, fmt), ref
+            if not url:
+                await callback.answer(MSG_LINK_EXPIRED, show_alert=True)
+                return
+        await callback.answer("Запускаю загрузку...")
+        job = enqueue_download_task(url, fmt, callback.from_user.id, info_token=token, sched=sched)
+        await _reply_queued(callback, job)
+        return
+
+    # dl|<url>|<format>: клавиатуры, отправленные до проб с токенами
+    if data.startswith("dl|"):
         _, url, fmt = data.split("|", 2)
         await callback.answer("Запускаю загрузку...")
-        enqueue_download_task(url, fmt, callback.from_user.id)
-        await callback.message.reply(MSG_JOB_QUEUED)
+        job = enqueue_download_task(url, fmt, callback.from_user.id)
+        await _reply_queued(callback, job)
+        return
+
+    # SEARCHGET|<session>|<index>
+    if data.startswith("SEARCHGET|"):
+        _, session, index = data.split("|", 2)
+        result = await get_result(session, int(index))
+        if result is None:
+            await callback.answer(MSG_SEARCH_EXPIRED, show_alert=True)
+            return
+        await callback.answer("Запускаю загрузку...")
+        job = enqueue_download_task(result["url"], "best", callback.from_user.id)
+        await _reply_queued(callback, job)
         return
 
-    # SEARCHPAGE|<query>|<page>
+    # SEARCHPAGE|<session>|<page>
     if data.startswith("SEARCHPAGE|"):
-        _, query, page = data.split("|", 2)
-        results, pagination = await search_youtube_async(query, page=int(page))
-        kb = build_search_results_keyboard(results, pagination, token_id=callback.message.message_id)
+        _, session, page = data.split("|", 2)
+        found = await get_page(session, int(page))
+        if found is None:
+            await callback.answer(MSG_SEARCH_EXPIRED, show_alert=True)
+            return
+        results, pagination = found
+        kb = build_search_results_keyboard(results, pagination, session)
         await callback.message.edit_reply_markup(reply_markup=kb)
         await callback.answer()
         return
 
+    # номер страницы в пагинации
+    if data == "IGNORE":
+        await callback.answer()
+        return
+
+    # BULK|<token>|<format>|<g — файлами, z — архивом>
+    if data.startswith("BULK|"):
+        _, token, fmt, delivery = data.split("|", 3)
+        urls = await take_batch(token)
+        if urls is None:
+            await callback.answer(MSG_BULK_EXPIRED, show_alert=True)
+            return
+        await callback.answer()
+        # ссылки проверяет воркер (downloader/album.py, batch_job); это сообщение
+        # дальше показывает прогресс всего пакета
+        status = callback.message
+        await status.edit_text(MSG_BULK_QUEUED.format(count=len(urls)))
+        enqueue_batch(urls, fmt, status.chat.id, callback.from_user.id, archive=delivery == "z",
+                      status_msg=status.message_id)
+        return
+
     # ALBUM|<album_id>
     if data.startswith("ALBUM|"):
         _, album_id = data.split("|", 1)
         meta = await get_album_meta_async(album_id)
-        kb = build_album_keyboard(meta, token_id=callback.message.message_id)
+        if not meta:
+            await callback.answer(MSG_ALBUM_FAILED, show_alert=True)
+            return
+        kb = build_album_keyboard(meta, await open_album(meta))
         await callback.message.reply(f"Альбом: {meta['title']}", reply_markup=kb)
         await callback.answer()
         return
 
-    # ALBUM_DOWNLOAD|<album_id>
-    if data.startswith("ALBUM_DOWNLOAD|"):
-        _, album_id = data.split("|", 1)
+    # ALBUMTRACK|<album token>|<index>
+    if data.startswith("ALBUMTRACK|"):
+        _, session, index = data.split("|", 2)
+        meta = await get_album(session)
+        tracks = meta["tracks"] if meta else []
+        if not 0 <= int(index) < len(tracks):
+            await callback.answer(MSG_LINK_EXPIRED, show_alert=True)
+            return
+        await callback.answer("Запускаю загрузку...")
+        job = enqueue_download_task(tracks[int(index)]["url"], "best", callback.from_user.id)
+        await _reply_queued(callback, job)
+        return
+
+    # ALBUM_DOWNLOAD|<album token>, ALBUM_ZIP|<album token> (старые клавиатуры: <album_id>)
+    if data.startswith(("ALBUM_DOWNLOAD|", "ALBUM_ZIP|")):
+        action, ref = data.split("|", 1)
+        if is_url(ref):
+            album_id = ref
+        else:
+            meta = await get_album(ref)
+            if meta is None:
+                await callback.answer(MSG_LINK_EXPIRED, show_alert=True)
+                return
+            album_id = meta["id"]
         await callback.answer("Поставил задачу на скачивание альбома...")
-        enqueue_download_task(album_id, "album", callback.from_user.id)
-        await callback.message.reply(MSG_JOB_QUEUED)
+        fmt = "album_zip" if action == "ALBUM_ZIP" else "album"
+        job = enqueue_download_task(album_id, fmt, callback.from_user.id)
+        # у альбома своё сообщение с прогрессом (downloader/album.py)
+        await _reply_queued(callback, job, track=False)
         return
 
     await callback.answer(MSG_UNKNOWN_ACTION, show_alert=True)
@@ -0,0 +1,117 @@
+import os
+import hmac
+import asyncio
+import logging
+from collections import deque
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+from utils.redis_client import get_async_redis
+from utils.metrics import INGRESS_UPDATES, UPDATE_SECONDS
+
+logger = logging.getLogger("bot.ingress")
+
+# The webhook only validates, dedups and queues: Telegram gets its 200 right
+# away while handlers (probes, searches: seconds) run in the background. Updates
+# of one chat are handled one after another in arrival order, at most
+# INGRESS_WORKERS chats at a time. When INGRESS_MAX_PENDING updates are waiting
+# we answer 503 and Telegram redelivers later: backpressure instead of a pile-up.
+INGRESS_WORKERS = int(os.getenv("INGRESS_WORKERS", "16"))
+INGRESS_MAX_PENDING = int(os.getenv("INGRESS_MAX_PENDING", "500"))
+INGRESS_HANDLER_TIMEOUT = int(os.getenv("INGRESS_HANDLER_TIMEOUT", "120"))
+INGRESS_DEDUP_TTL = int(os.getenv("INGRESS_DEDUP_TTL", "86400"))  # Telegram keeps undelivered updates 24h
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def chat_key(data: dict):
+    """Ordering key of a raw update: chat id, else sender id, else update id"""
+    for name, value in data.items():
+        if name == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if value.get("from"):
+            return value["from"]["id"]
+    return data.get("update_id")
+
+
+class Ingress:
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str):
+        self.dp, self.bot, self.secret = dp, bot, secret
+        self.pending = 0
+        self._chats = {}  # chat key -> deque of updates not handled yet
+        self._tasks = set()
+        self._slots = None
+        self._closing = False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """aiohttp webhook handler"""
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            INGRESS_UPDATES.labels("bad_secret").inc()
+            return web.Response(status=403)
+        if self._closing or self.pending >= INGRESS_MAX_PENDING:
+            INGRESS_UPDATES.labels("rejected").inc()
+            return web.Response(status=503, headers={"Retry-After": "5"})
+        try:
+            data = await request.json()
+            update_id = int(data["update_id"])
+        except (ValueError, KeyError, TypeError):
+            INGRESS_UPDATES.labels("invalid").inc()
+            return web.Response(status=400)
+        if not await self._first_delivery(update_id):
+            INGRESS_UPDATES.labels("duplicate").inc()
+            return web.Response(text="ok")
+        INGRESS_UPDATES.labels("accepted").inc()
+        self._submit(chat_key(data), data)
+        return web.Response(text="ok")
+
+    async def _first_delivery(self, update_id: int) -> bool:
+        try:
+            return bool(await get_async_redis().set(f"upd:{update_id}", 1, nx=True, ex=INGRESS_DEDUP_TTL))
+        except Exception:
+            # better a rare double than dropping updates while Redis is down
+            logger.warning("Update dedup unavailable", exc_info=True)
+            return True
+
+    def _submit(self, key, data: dict):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(INGRESS_WORKERS)
+        self.pending += 1
+        queue = self._chats.get(key)
+        if queue is not None:
+            queue.append(data)
+            return
+        queue = self._chats[key] = deque([data])
+        task = asyncio.create_task(self._drain(key, queue))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key, queue: deque):
+        """Handle one chat's updates in order while holding a worker slot"""
+        async with self._slots:
+            while queue:
+                data = queue.popleft()
+                try:
+                    # not feed_webhook_update: that one returns after its own 55 s and
+                    # leaves the handler running, so the chat's next update would overtake it
+                    with UPDATE_SECONDS.time():
+                        await asyncio.wait_for(self.dp.feed_raw_update(self.bot, data), INGRESS_HANDLER_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.error("Update %s timed out after %ss", data.get("update_id"), INGRESS_HANDLER_TIMEOUT)
+                except Exception:
+                    logger.exception("Update %s failed", data.get("update_id"))
+                finally:
+                    self.pending -= 1
+        # nothing can be appended between the loop's last check and here (no await)
+        del self._chats[key]
+
+    async def close(self, timeout: float = 30):
+        """Stop accepting updates, give queued ones `timeout` seconds to finish"""
+        self._closing = True
+        if self._tasks:
+            _, left = await asyncio.wait(set(self._tasks), timeout=timeout)
+            for task in left:
+                task.cancel()
+            if left:
+                logger.warning("Dropped %d chats' updates on shutdown", len(left))
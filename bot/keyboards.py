@@ -3,77 +3,94 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from typing import List, Dict, Tuple
 
 
+# Telegram limit for callback_data
+MAX_CALLBACK_BYTES = 64
+
+
 def build_format_keyboard(formats: List[Dict], token_id: int) -> InlineKeyboardMarkup:
     """
     Клавиатура для выбора формата (например, видео 720p, аудио mp3).
-    formats: список словарей {"format_id": str, "ext": str, "resolution": str}
+    formats: список словарей {"id": str, "label": str, "token": str}
+    (token — ключ сохранённого результата probe, см. utils/info_store.py)
     """
     kb = InlineKeyboardMarkup(inline_keyboard=[])
     for fmt in formats:
-        text = f"{fmt.get('ext', '')} {fmt.get('resolution', '')}".strip()
-        callback = f"FORMAT|{fmt['url']}|{fmt['format_id']}"
-        kb.inline_keyboard.append([InlineKeyboardButton(text=text, callback_data=callback)])
+        callback = f"FORMAT|{fmt['token']}|{fmt['id']}"
+        if len(callback.encode()) > MAX_CALLBACK_BYTES:
+            continue
+        kb.inline_keyboard.append([InlineKeyboardButton(text=fmt["label"], callback_data=callback)])
     return kb
 
 
 def build_search_results_keyboard(
     results: List[Dict],
     pagination: Tuple[int, int, int],
-    token_id: int
+    session: str
 ) -> InlineKeyboardMarkup:
     """
     Клавиатура для результатов поиска YouTube.
     results: [{"title": str, "url": str}]
     pagination: (page, total_pages, per_page)
+    session: токен поисковой сессии (bot/search_session.py)
     """
-    page, total_pages, _ = pagination
+    page, total_pages, per_page = pagination
     kb = InlineKeyboardMarkup(inline_keyboard=[])
 
-    # результаты поиска
-    for r in results:
+    # результаты поиска (индекс — позиция в сессии)
+    for i, r in enumerate(results, start=(page - 1) * per_page):
         kb.inline_keyboard.append([
-            InlineKeyboardButton(text=r["title"], callback_data=f"FORMAT|{r['url']}|best")
+            InlineKeyboardButton(text=r["title"], callback_data=f"SEARCHGET|{session}|{i}")
         ])
 
     # пагинация
-    nav = []
-    if page > 1:
-        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"SEARCHPAGE|{r['query']}|{page-1}"))
-    if page < total_pages:
-        nav.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"SEARCHPAGE|{r['query']}|{page+1}"))
-
-    if nav:
-        kb.inline_keyboard.append(nav)
+    if total_pages > 1:
+        kb.inline_keyboard.append(build_pagination_keyboard(session, page, total_pages).inline_keyboard[0])
 
     return kb
 
 
-def build_album_keyboard(meta: Dict, token_id: int) -> InlineKeyboardMarkup:
+def build_album_keyboard(meta: Dict, session: str) -> InlineKeyboardMarkup:
     """
-    Клавиатура для альбома (скачать весь альбом или треки по отдельности).
+    Клавиатура для альбома (скачать весь альбом, архивом или треки по отдельности).
     meta: {"id": str, "title": str, "tracks": [{"title": str, "url": str}]}
+    session: токен сохранённого альбома (bot/utils.py, open_album)
     """
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬇️ Скачать альбом", callback_data=f"ALBUM_DOWNLOAD|{meta['id']}")]
+        [InlineKeyboardButton(text="⬇️ Скачать альбом", callback_data=f"ALBUM_DOWNLOAD|{session}")],
+        [InlineKeyboardButton(text="🗜 Скачать архивом", callback_data=f"ALBUM_ZIP|{session}")],
     ])
 
-    for track in meta.get("tracks", []):
+    for i, track in enumerate(meta.get("tracks", [])):
         kb.inline_keyboard.append([
-            InlineKeyboardButton(text=track["title"], callback_data=f"FORMAT|{track['url']}|best")
+            InlineKeyboardButton(text=track["title"] or str(i + 1), callback_data=f"ALBUMTRACK|{session}|{i}")
         ])
     return kb
 
 
-def build_pagination_keyboard(query: str, page: int, total_pages: int) -> InlineKeyboardMarkup:
+def build_bulk_keyboard(token: str) -> InlineKeyboardMarkup:
+    """
+    Клавиатура для пакета ссылок (bot/bulk.py): формат и способ доставки.
+    token: ключ сохранённого списка ссылок
+    """
+    rows = []
+    for fmt, label in (("mp3", "MP3"), ("720p", "MP4 720p")):
+        rows.append([
+            InlineKeyboardButton(text=f"{label} — файлами", callback_data=f"BULK|{token}|{fmt}|g"),
+            InlineKeyboardButton(text=f"{label} — архивом", callback_data=f"BULK|{token}|{fmt}|z"),
+        ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def build_pagination_keyboard(session: str, page: int, total_pages: int) -> InlineKeyboardMarkup:
     """
     Общая пагинация (например, при поиске).
     """
     kb = InlineKeyboardMarkup(inline_keyboard=[])
     nav = []
     if page > 1:
-        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"SEARCHPAGE|{query}|{page-1}"))
+        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"SEARCHPAGE|{session}|{page-1}"))
     nav.append(InlineKeyboardButton(text=f"{page}/{total_pages}", callback_data="IGNORE"))
     if page < total_pages:
-        nav.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"SEARCHPAGE|{query}|{page+1}"))
+        nav.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"SEARCHPAGE|{session}|{page+1}"))
     kb.inline_keyboard.append(nav)
     return kb
@@ -1,14 +1,17 @@
 import os
+import asyncio
+import hashlib
 import logging
 from aiohttp import web
-from aiogram import Bot, Dispatcher, F
-from aiogram.client.session.aiohttp import AiohttpSession
-from aiogram.types import Update, Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram import Bot, Dispatcher
 
-from rq import Queue
-from redis import Redis
-from downloader.task import download_job  # твой воркер
 from bot.handlers import register_handlers
+from bot.fsm_storage import RedisFSMStorage
+from bot.extract_pool import pool
+from bot.progress import relay
+from bot.ingress import Ingress
+from utils import metrics, telegram_client
+from downloader import scheduler
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("bot.main")
@@ -17,79 +20,68 @@ logger = logging.getLogger("bot.main")
 TOKEN = os.getenv("BOT_TOKEN")
 PORT = int(os.getenv("PORT", 10000))
 RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL")
-WEBHOOK_PATH = f"/webhook/{TOKEN}"
-
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-redis_conn = Redis.from_url(REDIS_URL)
-queue = Queue(connection=redis_conn)
+# sent by Telegram in X-Telegram-Bot-Api-Secret-Token; also keeps the bot token out of URLs and logs
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()[:32]
+WEBHOOK_PATH = f"/webhook/{WEBHOOK_SECRET}"
 
 if not TOKEN or not RENDER_EXTERNAL_URL:
     logger.error("BOT_TOKEN and RENDER_EXTERNAL_URL must be set")
     raise SystemExit(1)
 
 
-# === Handlers ===
-async def cmd_start(message: Message):
-    await message.answer("Привет! Я бот для скачивания медиа. Отправь ссылку или запрос 🔗")
-
-
-async def process_link(message: Message):
-    url = message.text.strip()
-    # Заглушка: определяем форматы
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="MP4 720p", callback_data=f"dl|{url}|720p")],
-            [InlineKeyboardButton(text="MP3", callback_data=f"dl|{url}|mp3")],
-        ]
-    )
-    await message.answer("Выбери формат:", reply_markup=kb)
-
-
-async def process_callback(callback: CallbackQuery):
-    _, url, fmt = callback.data.split("|")
-    job = queue.enqueue(download_job, url, fmt)
-    await callback.message.edit_text(f"Задача поставлена в очередь ✅\nФормат: {fmt}\nURL: {url}\nJob ID: {job.id}")
-
-
 # === Webhook ===
 async def handle_update(request: web.Request):
-    data = await request.json()
-    update = Update(**data)
-    await request.app["dp"].feed_webhook_update(request.app["bot"], update)
-    return web.Response(text="ok")
+    # ack right away, handlers run in the background (bot/ingress.py)
+    with metrics.WEBHOOK_SECONDS.time():
+        return await request.app["ingress"].handle(request)
+
+
+async def handle_metrics(request: web.Request):
+    # collectors hit Redis synchronously: keep them off the event loop
+    body = await asyncio.get_running_loop().run_in_executor(None, metrics.render, request.app["metrics"])
+    return web.Response(body=body, headers={"Content-Type": metrics.CONTENT_TYPE})
 
 
 async def on_startup(app: web.Application):
     bot: Bot = app["bot"]
     webhook_url = f"{RENDER_EXTERNAL_URL}{WEBHOOK_PATH}"
-    await bot.set_webhook(webhook_url)
-    logger.info("Webhook set: %s", webhook_url)
+    await bot.set_webhook(webhook_url, secret_token=WEBHOOK_SECRET)
+    logger.info("Webhook set: %s/webhook/…", RENDER_EXTERNAL_URL)
+    relay.start(bot)
 
 
 async def on_shutdown(app: web.Application):
     bot: Bot = app["bot"]
     await bot.delete_webhook()
+    await app["ingress"].close()
+    await relay.stop()
     await bot.session.close()
+    pool.close()
 
 
 # === Application ===
 def create_app():
-    session = AiohttpSession()
-    bot = Bot(token=TOKEN, session=session)
-    dp = Dispatcher()
-
-    # Регистрация хендлеров
-    dp.message.register(cmd_start, F.text == "/start")
-    dp.message.register(process_link, F.text.startswith("http"))
-    dp.callback_query.register(process_callback, F.data.startswith("dl|"))
+    bot = Bot(token=TOKEN, session=telegram_client.session())
+    # state shared by all web replicas (Redis), not per process
+    dp = Dispatcher(storage=RedisFSMStorage())
 
+    # Регистрация хендлеров (bot/handlers.py)
     register_handlers(dp)
 
     app = web.Application()
     app["bot"] = bot
     app["dp"] = dp
+    app["ingress"] = ingress = Ingress(dp, bot, WEBHOOK_SECRET)
+    metrics.prune()
+    app["metrics"] = metrics.registry(
+        metrics.CallbackGauge("freedom_queue_depth", "Waiting jobs", scheduler.queue_depths, "lane"),
+        metrics.CallbackGauge("freedom_jobs_in_progress", "Running jobs, all workers", scheduler.running_jobs),
+        metrics.CallbackGauge("freedom_ingress_pending", "Updates accepted, not handled yet",
+                              lambda: ingress.pending),
+    )
 
     app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.router.add_get("/metrics", handle_metrics)
 
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
@@ -6,4 +6,25 @@ MSG_WELCOME = (
 )
 MSG_SELECT_FORMAT = "Выберите формат/качество:"
 MSG_JOB_QUEUED = "Задача поставлена в очередь. Как только результат будет готов — пришлю в этот чат."
+MSG_JOB_ATTACHED = "Эта ссылка уже скачивается по другому запросу — пришлю результат, как только он будет готов."
 MSG_UNKNOWN_ACTION = "Нераспознанное действие."
+MSG_SEARCH_EXPIRED = "Результаты поиска устарели — отправьте запрос ещё раз."
+MSG_LINK_EXPIRED = "Варианты для этой ссылки устарели — отправьте ссылку ещё раз."
+MSG_ALBUM_FAILED = "Не удалось получить список треков альбома."
+
+# пакет ссылок (bot/bulk.py)
+MSG_BULK_SELECT = "Ссылок: {count}. Выберите формат и как прислать:"
+MSG_BULK_TRUNCATED = "Ссылок больше {limit} — возьму первые {limit}."
+MSG_BULK_QUEUED = "Ссылок: {count}. Задача поставлена в очередь."
+MSG_BULK_EXPIRED = "Этот список ссылок устарел или уже запущен — отправьте его ещё раз."
+MSG_BULK_NO_LINKS = "В файле не нашлось ссылок."
+MSG_BULK_BAD_FILE = "Пришлите ссылки текстовым файлом (.txt) до {limit} КБ."
+
+# статус задачи (bot/progress.py)
+MSG_PROGRESS_QUEUED = "⏳ В очереди"
+MSG_PROGRESS_POSITION = "⏳ В очереди, перед вами ~{position}"
+MSG_PROGRESS_DOWNLOADING = "⬇️ Скачивание"
+MSG_PROGRESS_TRANSCODING = "⚙️ Обработка файла..."
+MSG_PROGRESS_UPLOADING = "⬆️ Отправка..."
+MSG_PROGRESS_DONE = "✅ Готово"
+MSG_PROGRESS_FAILED = "❌ Не удалось скачать"
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from utils.redis_client import get_async_redis
+from utils.info_store import INFO_TOKEN_TTL
+from utils.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger("bot.meta_cache")
+
+# Two tiers: in-process LRU in front of Redis (shared by all web replicas).
+# Concurrent lookups of the same key share one in-flight extraction.
+TTLS = {
+    # cached probe options carry an info token: never outlive it
+    "probe": min(int(os.getenv("META_TTL_PROBE", "600")), INFO_TOKEN_TTL // 2),
+    "search": int(os.getenv("META_TTL_SEARCH", "900")),
+    "album": int(os.getenv("META_TTL_ALBUM", "3600")),
+}
+LOCAL_MAX_ENTRIES = int(os.getenv("META_CACHE_LOCAL_SIZE", "512"))
+
+_local = OrderedDict()  # key -> (expires_at, value)
+_inflight = {}  # key -> asyncio.Task
+
+
+def _make_key(kind: str, ident: str) -> str:
+    return f"meta:{kind}:{hashlib.sha1(ident.encode()).hexdigest()}"
+
+
+def _local_get(key: str):
+    item = _local.get(key)
+    if item is None:
+        return None
+    expires_at, value = item
+    if expires_at < time.monotonic():
+        del _local[key]
+        return None
+    _local.move_to_end(key)
+    return value
+
+
+def _local_put(key: str, value, ttl: int):
+    _local[key] = (time.monotonic() + ttl, value)
+    _local.move_to_end(key)
+    while len(_local) > LOCAL_MAX_ENTRIES:
+        _local.popitem(last=False)
+
+
+async def _load(kind: str, key: str, loader):
+    ttl = TTLS[kind]
+    try:
+        raw = await get_async_redis().get(key)
+    except Exception:
+        logger.warning("Redis unavailable for %s lookup", kind, exc_info=True)
+        raw = None
+    if raw is not None:
+        CACHE_REQUESTS.labels(kind, "hit").inc()
+        value = json.loads(raw)
+        _local_put(key, value, ttl)
+        return value
+
+    CACHE_REQUESTS.labels(kind, "miss").inc()
+    value = await loader()
+    # empty result == failed extraction: don't pin it in the cache
+    if value:
+        _local_put(key, value, ttl)
+        try:
+            await get_async_redis().set(key, json.dumps(value), ex=ttl)
+        except Exception:
+            logger.warning("Redis unavailable for %s store", kind, exc_info=True)
+    return value
+
+
+async def cached(kind: str, ident: str, loader):
+    """
+    Return cached value of `kind` ("probe"/"search"/"album") for `ident`,
+    calling `loader()` (coroutine function) on a miss.
+    """
+    key = _make_key(kind, ident)
+    value = _local_get(key)
+    if value is not None:
+        CACHE_REQUESTS.labels(kind, "hit").inc()
+        return value
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_load(kind, key, loader))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: a cancelled webhook handler must not cancel the shared lookup
+    return await asyncio.shield(task)
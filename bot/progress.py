@@ -0,0 +1,170 @@
+import os
+import asyncio
+import logging
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from bot.messages import (
+    MSG_PROGRESS_QUEUED,
+    MSG_PROGRESS_POSITION,
+    MSG_PROGRESS_DOWNLOADING,
+    MSG_PROGRESS_TRANSCODING,
+    MSG_PROGRESS_UPLOADING,
+    MSG_PROGRESS_DONE,
+    MSG_PROGRESS_FAILED,
+)
+from downloader.progress import PROGRESS_CHANNEL, PROGRESS_TTL, FINAL_STAGES
+from downloader.scheduler import queue_position
+from utils.redis_client import get_async_redis
+
+logger = logging.getLogger("bot.progress")
+
+# Workers publish job progress (downloader/progress.py); this turns it into
+# edits of the status message the bot replied with. Events are coalesced: a
+# status message is edited at most once per PROGRESS_EDIT_INTERVAL, only when
+# its text changed, and the last state always makes it out. The edit lock lives
+# in Redis, so with several web instances only one of them edits.
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))
+TICK = 1.0
+
+_STAGE_TEXT = {
+    "transcoding": MSG_PROGRESS_TRANSCODING,
+    "uploading": MSG_PROGRESS_UPLOADING,
+    "done": MSG_PROGRESS_DONE,
+    "failed": MSG_PROGRESS_FAILED,
+}
+
+
+def _watchers_key(job_id: str) -> str:
+    return f"progress:{job_id}:watchers"
+
+
+def _mb(value) -> str:
+    return f"{int(value) / 2 ** 20:.1f}"
+
+
+def render(state: dict) -> str:
+    """Status line for a progress state"""
+    stage = state.get("stage")
+    if stage == "queued":
+        position = state.get("position")
+        return MSG_PROGRESS_POSITION.format(position=position) if position else MSG_PROGRESS_QUEUED
+    if stage == "downloading":
+        parts = [MSG_PROGRESS_DOWNLOADING]
+        if state.get("percent"):
+            parts[0] += f": {float(state['percent']):.0f}%"
+        if state.get("speed"):
+            parts.append(f"{_mb(state['speed'])} МБ/с")
+        if state.get("eta"):
+            minutes, seconds = divmod(int(state["eta"]), 60)
+            parts.append(f"осталось {minutes}:{seconds:02d}")
+        return " · ".join(parts)
+    return _STAGE_TEXT.get(stage, MSG_PROGRESS_QUEUED)
+
+
+async def watch(job_id: str, chat_id: int, message_id: int):
+    """Keep message `message_id` in `chat_id` updated with the job's progress"""
+    r = get_async_redis()
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.sadd(_watchers_key(job_id), f"{chat_id}:{message_id}")
+        pipe.expire(_watchers_key(job_id), PROGRESS_TTL)
+        # show the state right away, not only on the next event
+        pipe.publish(PROGRESS_CHANNEL, job_id)
+        await pipe.execute()
+    relay.track_queued(job_id)
+
+
+class ProgressRelay:
+    def __init__(self):
+        self.bot = None
+        self._dirty = set()
+        self._queued = set()
+        self._tasks = []
+
+    def track_queued(self, job_id: str):
+        """Refresh this job's queue position while it waits"""
+        self._queued.add(job_id)
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._flush())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _listen(self):
+        while True:
+            pubsub = get_async_redis().pubsub()
+            try:
+                await pubsub.subscribe(PROGRESS_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._dirty.add(message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Progress subscription lost, reconnecting", exc_info=True)
+                await asyncio.sleep(TICK)
+            finally:
+                await pubsub.close()
+
+    async def _flush(self):
+        while True:
+            await asyncio.sleep(TICK)
+            try:
+                await self._refresh_positions()
+                for job_id in list(self._dirty):
+                    if await self._render(job_id):
+                        self._dirty.discard(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Progress flush failed")
+
+    async def _refresh_positions(self):
+        r = get_async_redis()
+        for job_id in list(self._queued):
+            state = {k.decode(): v.decode() for k, v in (await r.hgetall(f"progress:{job_id}")).items()}
+            if state.get("stage") != "queued" or "lane" not in state:
+                self._queued.discard(job_id)
+                continue
+            position = await queue_position(r, job_id, state["user"], state["lane"])
+            if position is not None and str(position) != state.get("position"):
+                await r.hset(f"progress:{job_id}", "position", position)
+                self._dirty.add(job_id)
+
+    async def _render(self, job_id: str) -> bool:
+        """Edit the job's status messages; False if it has to wait for the edit interval"""
+        r = get_async_redis()
+        if not await r.set(f"progress:{job_id}:edit", 1, nx=True, px=int(PROGRESS_EDIT_INTERVAL * 1000)):
+            return False
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.hgetall(f"progress:{job_id}")
+            pipe.smembers(_watchers_key(job_id))
+            raw, watchers = await pipe.execute()
+        state = {k.decode(): v.decode() for k, v in raw.items()}
+        text = render(state)
+        if not watchers or text == state.get("shown"):
+            return True
+        for watcher in watchers:
+            chat_id, message_id = map(int, watcher.decode().split(":"))
+            try:
+                await self.bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
+            except TelegramBadRequest as e:
+                if "not modified" not in str(e):
+                    # message deleted or too old to edit
+                    await r.srem(_watchers_key(job_id), watcher)
+            except TelegramForbiddenError:
+                await r.srem(_watchers_key(job_id), watcher)
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.hset(f"progress:{job_id}", "shown", text)
+            if state.get("stage") in FINAL_STAGES:
+                pipe.delete(_watchers_key(job_id))
+            await pipe.execute()
+        return True
+
+
+relay = ProgressRelay()
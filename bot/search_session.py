@@ -0,0 +1,106 @@
+import os
+import json
+import math
+import asyncio
+import secrets
+import logging
+from utils.state_store import StateStore
+from bot.utils import search_youtube_async
+
+logger = logging.getLogger("bot.search_session")
+
+# One search per query: the ranked result list is kept under a short token and
+# pages are served by slicing it. The window is deepened in the background when
+# the user gets close to its end.
+SEARCH_WINDOW = int(os.getenv("SEARCH_WINDOW", "25"))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "100"))
+SEARCH_SESSION_TTL = int(os.getenv("SEARCH_SESSION_TTL", "1800"))
+SEARCH_PER_PAGE = 5
+PREFETCH_PAGES = 1  # start deepening when this many pages (or fewer) are left
+
+_prefetching = {}  # token -> asyncio.Task
+# paging through a session reads it on every click: cached (utils/state_store.py)
+_store = StateStore("search_session", SEARCH_SESSION_TTL)
+
+
+async def _save(token: str, session: dict):
+    await _store.set(token, {"session": json.dumps(session, separators=(",", ":"), ensure_ascii=False)})
+
+
+async def _load(token: str):
+    raw = (await _store.get(token, "session")).get("session")
+    return json.loads(raw) if raw else None
+
+
+async def open_session(query: str):
+    """Run the search once; return session token or None if nothing found"""
+    results = await search_youtube_async(query, SEARCH_WINDOW)
+    if not results:
+        return None
+    token = secrets.token_urlsafe(6)
+    await _save(token, {
+        "q": query,
+        "results": results,
+        "window": SEARCH_WINDOW,
+        "done": len(results) < SEARCH_WINDOW,
+    })
+    return token
+
+
+async def _extend(token: str, session: dict) -> dict:
+    window = min(session["window"] * 2, SEARCH_MAX_RESULTS)
+    results = await search_youtube_async(session["q"], window)
+    # keep already shown ranking stable, append only new entries
+    seen = {r["id"] for r in session["results"]}
+    fresh = [r for r in results if r["id"] not in seen]
+    session["results"].extend(fresh)
+    session["window"] = window
+    session["done"] = not fresh or len(results) < window or window >= SEARCH_MAX_RESULTS
+    await _save(token, session)
+    return session
+
+
+def _extend_once(token: str, session: dict) -> asyncio.Task:
+    task = _prefetching.get(token)
+    if task is None:
+        task = asyncio.ensure_future(_extend(token, session))
+        _prefetching[token] = task
+        task.add_done_callback(lambda t: _extend_done(token, t))
+    return task
+
+
+def _extend_done(token: str, task: asyncio.Task):
+    _prefetching.pop(token, None)
+    if not task.cancelled() and task.exception():
+        logger.warning("Search prefetch failed for %s: %s", token, task.exception())
+
+
+async def get_page(token: str, page: int, per_page: int = SEARCH_PER_PAGE):
+    """
+    Return (results, (page, total_pages, per_page)) for a session page,
+    or None if the session expired.
+    """
+    session = await _load(token)
+    if session is None:
+        return None
+    end = page * per_page
+    if end > len(session["results"]) and not session["done"]:
+        # user outran the prefetch
+        session = await asyncio.shield(_extend_once(token, session))
+    elif end + PREFETCH_PAGES * per_page >= len(session["results"]) and not session["done"]:
+        _extend_once(token, session)
+
+    results = session["results"]
+    total_pages = max(1, math.ceil(len(results) / per_page))
+    if not session["done"]:
+        total_pages += 1  # more can be fetched
+    page = max(1, min(page, total_pages))
+    return results[(page - 1) * per_page:page * per_page], (page, total_pages, per_page)
+
+
+async def get_result(token: str, index: int):
+    """Single result of a session by absolute index, None if expired/out of range"""
+    session = await _load(token)
+    if session is None or not 0 <= index < len(session["results"]):
+        return None
+    return session["results"][index]
@@ -1,28 +1,40 @@
 import os
-import asyncio
 import json
-import shlex
+import secrets
 import logging
 from typing import List, Tuple
+from rq import Retry
 from utils.validation import is_url as _is_url
-from utils.validation import safe_quote
+from bot.meta_cache import cached
+from bot.extract_pool import extract_info
+from utils.info_store import put_info
+from utils.state_store import StateStore
+from utils.metrics import PROBE_SECONDS, SEARCH_SECONDS
+from utils.telegram_client import UPLOAD_LIMIT
+from utils.redis_client import get_redis
+from downloader import inflight, scheduler, progress
+from downloader.sizing import estimate_selection
 
 logger = logging.getLogger("bot.utils")
 
-# probe and search should be fast; use yt-dlp in worker where heavy. But probing small JSON is OK here.
+# an album shown as a keyboard: buttons carry a token and a track index, the
+# URLs stay here (callback_data is 64 bytes)
+ALBUM_SESSION_TTL = int(os.getenv("ALBUM_SESSION_TTL", "1800"))
+_albums = StateStore("album_session", ALBUM_SESSION_TTL)
+
+# probe and search should be fast; use yt-dlp in worker where heavy. Metadata-only
+# extraction runs in the warm in-process pool (bot/extract_pool.py).
 
 async def probe_formats_async(url: str, max_options: int = 6):
     """Return list of formats for keyboard"""
-    cmd = f"yt-dlp -J --no-warnings {safe_quote(url)}"
-    proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    out, err = await proc.communicate()
-    if proc.returncode != 0:
-        logger.warning("Probe failed: %s", err.decode()[:200])
-        return []
+    return await cached("probe", f"{url}|{max_options}", lambda: _probe_formats(url, max_options))
+
+async def _probe_formats(url: str, max_options: int):
     try:
-        info = json.loads(out.decode())
+        with PROBE_SECONDS.time():
+            info = await extract_info(url)
     except Exception as e:
-        logger.exception("Parse probe JSON failed")
+        logger.warning("Probe failed: %s", str(e)[:200])
         return []
     formats = info.get("formats", [])
     options = []
@@ -35,71 +47,123 @@ async def probe_formats_async(url: str, max_options: int = 6):
         note = f.get("format_note") or f.get("ext") or ""
         desc = f"{f.get('ext','')} — {f.get('height') or f.get('abr') or ''} {note}".strip()
         label = desc[:45]
-        options.append({"id": fid, "label": label, "url": url})
+        options.append({"id": fid, "label": label})
         if len(options) >= max_options:
             break
-    # add always 'best video' and 'best audio'
-    options.insert(0, {"id": "bestvideo+bestaudio/best", "label": "Видео (лучшее)", "url": url})
-    options.insert(1, {"id": "bestaudio", "label": "Аудио (лучшее)", "url": url})
+    # best video/audio and the output profiles (downloader/postprocess.py) come first
+    options[:0] = [
+        {"id": "bestvideo+bestaudio/best", "label": "Видео (лучшее)"},
+        {"id": "720p", "label": "MP4 720p"},
+        {"id": "bestaudio", "label": "Аудио (лучшее)"},
+        {"id": "mp3", "label": "MP3"},
+    ]
+    # лучшее качество в Telegram не пролезет: предлагаем лучшее из того, что пролезет
+    best = estimate_selection(info, "bestvideo+bestaudio/best")
+    if best and best >= UPLOAD_LIMIT:
+        options.insert(1, {"id": "fit", "label": f"Видео (до {UPLOAD_LIMIT // 2 ** 20} МБ)"})
+    # the worker downloads from this very info dict (see utils/info_store.py);
+    # lanes are decided here once, not on every click
+    token = await put_info(info, {o["id"]: scheduler.classify(o["id"], info) for o in options})
+    for option in options:
+        option["token"] = token
     return options
 
-async def search_youtube_async(query: str, page: int = 1, per_page: int = 5):
-    """Use yt-dlp ytsearch for MVP."""
-    # yt-dlp doesn't support paged ytsearch natively; implement via ytsearchN: and slicing server-side.
-    cmd = f'yt-dlp "ytsearch{per_page}:{shlex.quote(query)}" --dump-json'
-    proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    out, err = await proc.communicate()
-    if proc.returncode != 0:
-        logger.warning("Search yt-dlp failed: %s", err.decode()[:200])
-        return [], {}
-    lines = out.decode().splitlines()
+async def search_youtube_async(query: str, limit: int = 5):
+    """Top `limit` ytsearch results: [{"title", "uploader", "url", "id"}]"""
+    return await cached("search", f"{query}|{limit}", lambda: _search_youtube(query, limit))
+
+async def _search_youtube(query: str, limit: int):
+    # yt-dlp doesn't support paged ytsearch natively: callers fetch a deeper
+    # window and slice it (bot/search_session.py)
+    try:
+        with SEARCH_SECONDS.time():
+            info = await extract_info(f"ytsearch{limit}:{query}", extract_flat="in_playlist")
+    except Exception as e:
+        logger.warning("Search yt-dlp failed: %s", str(e)[:200])
+        return []
     results = []
-    for line in lines:
-        try:
-            info = json.loads(line)
-        except Exception:
-            continue
+    for entry in info.get("entries") or []:
         results.append({
-            "title": info.get("title"),
-            "uploader": info.get("uploader"),
-            "url": info.get("webpage_url"),
-            "id": info.get("id"),
+            "title": entry.get("title"),
+            "uploader": entry.get("uploader") or entry.get("channel"),
+            "url": entry.get("webpage_url") or entry.get("url"),
+            "id": entry.get("id"),
         })
-    pagination = {
-        "next": f"SEARCHPAGE|{query}|{page+1}",
-    }
-    if page > 1:
-        pagination["prev"] = f"SEARCHPAGE|{query}|{page-1}"
-    return results, pagination
+    return results
 
 async def get_album_meta_async(album_id: str):
     """MVP: try to use yt-dlp to get playlist info."""
+    return await cached("album", album_id, lambda: _get_album_meta(album_id))
+
+async def _get_album_meta(album_id: str):
     # album_id could be playlist URL or id
-    cmd = f"yt-dlp -J {shlex.quote(album_id)}"
-    proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    out, err = await proc.communicate()
-    if proc.returncode != 0:
-        return {}
     try:
-        info = json.loads(out.decode())
+        info = await extract_info(album_id, extract_flat="in_playlist", playlistend=50)
     except Exception:
+        logger.warning("Album lookup failed for %s", album_id, exc_info=True)
         return {}
     tracks = []
-    for entry in info.get("entries", [])[:50]:
-        tracks.append({"title": entry.get("title"), "url": entry.get("webpage_url")})
+    for entry in (info.get("entries") or [])[:50]:
+        tracks.append({"title": entry.get("title"), "url": entry.get("webpage_url") or entry.get("url")})
     return {"id": album_id, "title": info.get("title", "Album"), "tracks": tracks}
 
+async def open_album(meta: dict) -> str:
+    """Keep album meta for its keyboard; return token for callback_data"""
+    token = secrets.token_urlsafe(6)
+    await _albums.set(token, {"meta": json.dumps(meta, separators=(",", ":"), ensure_ascii=False)})
+    return token
+
+async def get_album(token: str):
+    """Album meta of a token, None if expired"""
+    raw = (await _albums.get(token, "meta")).get("meta")
+    return json.loads(raw) if raw else None
+
 def is_url(text: str) -> bool:
     return _is_url(text)
 
-# enqueue download (send to RQ)
-from rq import Queue
-import redis
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-_conn = redis.from_url(REDIS_URL)
-q = Queue("downloads", connection=_conn)
+# enqueue download (handed to the scheduler, see downloader/scheduler.py)
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "1800"))
+# interrupted downloads run again and continue their partial files (downloader/workspace.py)
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "2"))
 
-def enqueue_download_task(url_or_id: str, fmt: str, user_id: int):
+def enqueue_download_task(url_or_id: str, fmt: str, user_id: int, info_token: str = None, sched: tuple = None):
+    """sched: (lane, cost) stored with the probe (utils/info_store.py, get_link)"""
     # pack metadata and push job. Worker will handle special fmt like 'album'
-    job = q.enqueue("downloader.task.download_job", url_or_id, fmt, user_id, job_timeout=int(os.getenv("DOWNLOAD_TIMEOUT", "1800")))
+    # Same link+format already queued/running: just wait for its result
+    owner = inflight.attach(url_or_id, fmt, user_id)
+    if owner is not None:
+        return {"job_id": owner, "attached": True}
+    retry = None
+    if fmt in ("album", "album_zip"):
+        # album = parent job that splits into per-track sub-jobs (downloader/album.py)
+        func, args = "downloader.album.album_job", (url_or_id, user_id, fmt == "album_zip")
+    else:
+        func, args = "downloader.task.download_job", (url_or_id, fmt, user_id, info_token)
+        retry = Retry(max=DOWNLOAD_RETRIES) if DOWNLOAD_RETRIES else None
+    # lane and cost come from the probed sizes when we have them
+    lane, cost = sched or scheduler.classify(fmt)
+    try:
+        with get_redis().pipeline() as pipe:
+            job = scheduler.enqueue(func, *args, user_id=user_id, lane=lane, cost=cost,
+                                    job_timeout=DOWNLOAD_TIMEOUT, retry=retry, pipeline=pipe)
+            progress.publish(job.id, "queued", pipeline=pipe, user=user_id, lane=lane)
+            pipe.execute()
+    except Exception:
+        inflight.finish(url_or_id, fmt)
+        raise
+    inflight.set_job_id(url_or_id, fmt, job.id)
     return {"job_id": job.id}
+
+def enqueue_batch(urls: list, fmt: str, chat_id: int, user_id: int, archive: bool = False, status_msg: int = 0):
+    """
+    Enqueue links (bot/bulk.py) as one batch: a parent job that probes them and
+    fans out into per-link jobs (downloader/album.py, batch_job); returns {"job_id", "batch_id"}
+    """
+    batch_id = secrets.token_hex(6)
+    lane, cost = scheduler.classify("album")
+    with get_redis().pipeline() as pipe:
+        job = scheduler.enqueue("downloader.album.batch_job", batch_id, chat_id, urls, fmt, archive, status_msg,
+                                user_id=user_id, lane=lane, cost=cost, job_timeout=DOWNLOAD_TIMEOUT, pipeline=pipe)
+        progress.publish(job.id, "queued", pipeline=pipe, user=user_id, lane=lane)
+        pipe.execute()
+    return {"job_id": job.id, "batch_id": batch_id}
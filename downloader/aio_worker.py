@@ -0,0 +1,163 @@
+import os
+import sys
+import signal
+import asyncio
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from rq import Queue
+from rq.utils import utcnow
+
+from downloader import workspace, scheduler
+from utils import telegram_client
+from utils.redis_client import get_redis
+
+logger = logging.getLogger("downloader.aio_worker")
+
+# One process, one event loop, N jobs at a time. Jobs are mostly waiting on the
+# network, so they run in a thread pool (yt-dlp/ffmpeg block) while Telegram
+# calls from all of them share this loop's Bot and aiohttp session. The RQ
+# Worker object is only used for registration and job bookkeeping: nothing forks.
+# Jobs come from downloader/scheduler.py; the last SCHED_SHORT_SLOT_SHARE of the
+# slots only take short-lane jobs.
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "10"))
+DEQUEUE_TIMEOUT = 5
+HEARTBEAT_INTERVAL = 60
+
+
+class AsyncWorker:
+    def __init__(self, queue_names, concurrency: int = WORKER_CONCURRENCY):
+        self.conn = get_redis()
+        self.queues = [Queue(name, connection=self.conn) for name in queue_names]
+        self.concurrency = concurrency
+        self.rq = scheduler.FairWorker(self.queues, connection=self.conn)
+        self.lanes = self.rq.lanes
+        # at most this many slots run anything but short jobs
+        self.long_slots = concurrency - int(concurrency * scheduler.SHORT_SLOT_SHARE)
+        self.long_running = 0
+        self.jobs = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="job")
+        # BLPOP must not wait behind busy job threads
+        self.dequeuer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dequeue")
+        self._stopping = False
+
+    def stop(self):
+        if not self._stopping:
+            logger.info("Warm shutdown: finishing running jobs")
+        self._stopping = True
+
+    def _dequeue(self, lanes):
+        return scheduler.next_job(lanes, DEQUEUE_TIMEOUT)
+
+    def _start(self, job):
+        timeout = job.timeout or Queue.DEFAULT_TIMEOUT
+        with self.conn.pipeline() as pipe:
+            job.heartbeat(utcnow(), timeout + 60, pipeline=pipe)
+            job.prepare_for_execution(self.rq.name, pipe)
+            pipe.execute()
+        job.started_at = utcnow()
+
+    def _succeed(self, job, queue, rv):
+        job.ended_at = utcnow()
+        job._result = rv
+        self.rq.handle_job_success(job, queue, queue.started_job_registry)
+
+    def _fail(self, job, queue, exc_string: str):
+        job.ended_at = utcnow()
+        self.rq.handle_job_failure(job, queue, started_job_registry=queue.started_job_registry,
+                                   exc_string=exc_string)
+
+    async def _run(self, job, queue):
+        try:
+            await self._perform(job, queue)
+        except Exception:
+            # bookkeeping failed (Redis hiccup): don't leave the job dequeued but
+            # nowhere, park it in the failed registry where it can be requeued
+            logger.exception("Job %s: worker error", job.id)
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._fail, job, queue, traceback.format_exc())
+            except Exception:
+                logger.exception("Job %s: could not mark as failed", job.id)
+
+    async def _perform(self, job, queue):
+        loop = asyncio.get_running_loop()
+        timeout = job.timeout or Queue.DEFAULT_TIMEOUT
+        await loop.run_in_executor(self.jobs, self._start, job)
+        fut = loop.run_in_executor(self.jobs, job.perform)
+        done, _ = await asyncio.wait({fut}, timeout=timeout)
+        if not done:
+            # threads can't be killed: report the timeout now, keep the slot
+            # until the thread actually returns. No retry: the thread still
+            # owns the job's workspace and would race its next attempt.
+            logger.error("Job %s exceeded %ss", job.id, timeout)
+            job.retries_left = None
+            await loop.run_in_executor(None, self._fail, job, queue, f"Job exceeded timeout ({timeout}s)")
+            await asyncio.wait({fut})
+            return
+        exc = fut.exception()
+        if exc is None:
+            await loop.run_in_executor(None, self._succeed, job, queue, fut.result())
+            logger.info("%s: Job OK (%s)", queue.name, job.id)
+        else:
+            exc_string = "".join(traceback.format_exception(exc))
+            logger.error("%s: Job %s failed:\n%s", queue.name, job.id, exc_string)
+            await loop.run_in_executor(None, self._fail, job, queue, exc_string)
+
+    def _long_done(self, _):
+        self.long_running -= 1
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            await asyncio.get_running_loop().run_in_executor(None, self.rq.heartbeat)
+            # registry cleanup and the album sweep, as fork workers do between jobs
+            if self.rq.should_run_maintenance_tasks:
+                await asyncio.get_running_loop().run_in_executor(None, self.rq.run_maintenance_tasks)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # all job threads talk to Telegram through this loop
+        telegram_client.bind_loop(loop)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+
+        self.rq.register_birth()
+        heartbeat = asyncio.create_task(self._heartbeat())
+        slots = asyncio.Semaphore(self.concurrency)
+        running = set()
+        logger.info("Async worker %s: %d slots on %s", self.rq.name, self.concurrency,
+                    ", ".join(q.name for q in self.queues))
+        try:
+            while not self._stopping:
+                await slots.acquire()
+                lanes = self.lanes if self.long_running < self.long_slots else ("short",)
+                found = await loop.run_in_executor(self.dequeuer, self._dequeue, lanes)
+                if not found:
+                    slots.release()
+                    continue
+                task = asyncio.create_task(self._run(*found))
+                running.add(task)
+                task.add_done_callback(running.discard)
+                task.add_done_callback(lambda _: slots.release())
+                if found[0].meta.get("sched", {}).get("lane") != "short":
+                    self.long_running += 1
+                    task.add_done_callback(self._long_done)
+            if running:
+                await asyncio.wait(running)
+        finally:
+            heartbeat.cancel()
+            self.rq.register_death()
+            await telegram_client.close()
+            self.jobs.shutdown(wait=False)
+            self.dequeuer.shutdown(wait=False)
+
+
+def main(queue_names):
+    # leftovers of jobs killed together with the previous worker
+    workspace.janitor()
+    asyncio.run(AsyncWorker(queue_names).run())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:] or ["downloads"])
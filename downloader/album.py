@@ -0,0 +1,418 @@
+import os
+import json
+import shutil
+import logging
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from rq import get_current_job
+from rq.job import Job, JobStatus
+from rq.utils import utcnow
+from rq.exceptions import NoSuchJobError
+from yt_dlp import YoutubeDL
+from aiogram.types import FSInputFile, InputMediaDocument
+
+from downloader import result_cache, inflight, scheduler, postprocess
+from downloader.sizing import estimate_size
+from downloader.workspace import workspace
+from downloader.task import MAX_FILE_SIZE, SIGNATURE, _downloaded_files
+from utils import telegram_client
+from utils.redis_client import get_redis
+from utils.info_store import load_info, save_info
+from utils.s3 import upload_file_key, presign, download_file, open_object, stream_upload
+from utils.validation import sanitize_filename
+
+logger = logging.getLogger("downloader.album")
+
+# An album is a parent job that fans out into one sub-job per track. At most
+# ALBUM_PARALLELISM tracks of one album run at once: every finished track
+# enqueues the next pending one. Tracks are staged in S3 and sent as media
+# groups in album order once the last one finishes. Track jobs are scheduled
+# under the requesting user like any other download. Staged tracks and the
+# archive live under downloads/, where the bucket lifecycle rule removes them.
+# Delivery is a job of its own (finalize_job). A track whose job died without
+# reporting (killed horse, lost worker) is given up on by sweep(), run from the
+# workers' maintenance, so the album still finishes with what it has. sweep()
+# runs in the worker's parent process, which must not call Telegram (its loop
+# would be inherited by every forked job): it leaves the status message and the
+# delivery to jobs (progress_job, finalize_job).
+# A batch (bot/bulk.py: many links in one message or .txt file) runs the same
+# way: its parent job probes the links, BATCH_PROBE_CONCURRENCY at a time, and
+# stores their info dicts (utils/info_store.py) so the tracks don't extract
+# again; tracks come in the requested format, delivered as media groups or
+# only the archive.
+ALBUM_PARALLELISM = int(os.getenv("ALBUM_PARALLELISM", "4"))
+ALBUM_MAX_TRACKS = int(os.getenv("ALBUM_MAX_TRACKS", "50"))
+ALBUM_STATE_TTL = int(os.getenv("ALBUM_STATE_TTL", "21600"))
+ALBUM_PROGRESS_INTERVAL = int(os.getenv("ALBUM_PROGRESS_INTERVAL", "5"))
+TRACK_TIMEOUT = int(os.getenv("TRACK_TIMEOUT", "600"))
+ALBUM_FINALIZE_TIMEOUT = int(os.getenv("ALBUM_FINALIZE_TIMEOUT", "1800"))
+BATCH_PROBE_CONCURRENCY = int(os.getenv("BULK_PROBE_CONCURRENCY", "4"))
+TRACK_FORMAT = "bestaudio/best"
+MEDIA_GROUP_SIZE = 10  # Telegram limit
+MESSAGE_LIMIT = 4096  # Telegram limit, characters
+ACTIVE_KEY = "album:active"  # albums with tracks in flight, for sweep()
+
+
+def _keys(album_key: str):
+    """state, tracks, results, pending, track job ids"""
+    base = f"album:{album_key}"
+    return base, f"{base}:tracks", f"{base}:results", f"{base}:pending", f"{base}:jobs"
+
+
+def _enqueue_track(album_key: str, index: int, chat_id: int, track: dict, fmt: str = TRACK_FORMAT,
+                   pipeline=None):
+    lane, cost = scheduler.classify(fmt, {"duration": track.get("duration")})
+    pipe = pipeline if pipeline is not None else get_redis().pipeline()
+    job = scheduler.enqueue("downloader.album.track_job", album_key, index, user_id=chat_id,
+                            lane=lane, cost=cost, job_timeout=TRACK_TIMEOUT, pipeline=pipe)
+    pipe.hset(_keys(album_key)[4], index, job.id)
+    if pipeline is None:
+        pipe.execute()
+
+
+# ========================
+# Родительская задача
+# ========================
+def album_job(album_id: str, chat_id: int, archive: bool = False):
+    job = get_current_job()
+    album_key = job.id if job else sanitize_filename(album_id)
+    fmt = "album_zip" if archive else "album"
+    try:
+        with YoutubeDL({"quiet": True, "extract_flat": "in_playlist", "playlistend": ALBUM_MAX_TRACKS}) as ydl:
+            info = ydl.extract_info(album_id, download=False)
+        tracks = [{"url": e.get("webpage_url") or e.get("url"), "title": e.get("title") or f"Track {i + 1}",
+                   "duration": e.get("duration")}
+                  for i, e in enumerate(info.get("entries") or []) if e]
+        if not tracks:
+            raise ValueError("в альбоме нет треков")
+    except Exception as e:
+        logger.exception("Album %s lookup failed", album_id)
+        for waiter in inflight.finish(album_id, fmt):
+            telegram_client.send_text(waiter, f"Произошла ошибка при скачивании альбома: {e}")
+        return
+
+    title = info.get("title") or "Album"
+    label = f"Альбом «{title}»"
+    status = telegram_client.send_text(chat_id, f"{label}: 0/{len(tracks)}")
+    _start(album_key, chat_id, tracks, {
+        "album_id": album_id, "fmt": fmt, "title": title, "label": label, "archive": int(archive),
+        "status_msg": status.message_id if status else 0,
+    })
+    # this job ends here, the album goes on until finalize_job's inflight.finish()
+    inflight.hand_off(album_id, fmt, _keys(album_key)[0])
+
+
+def _probe(url: str) -> dict:
+    """Track of a batch link, its info dict stored for the track job; {"title", "error"} if it failed"""
+    try:
+        with YoutubeDL({"quiet": True, "noplaylist": True}) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        logger.warning("Batch probe failed for %s: %s", url, str(e)[:200])
+        return {"title": url, "error": str(e)[:200] or type(e).__name__}
+    if info.get("_type", "video") != "video":
+        return {"title": info.get("title") or url, "error": "плейлист — отправьте его отдельной ссылкой"}
+    return {"url": url, "title": info.get("title") or url, "duration": info.get("duration"),
+            "token": save_info(info)}
+
+
+def batch_job(batch_id: str, chat_id: int, urls: list, fmt: str, archive: bool = False, status_msg: int = 0):
+    """Parent job of a batch of links: probe them, then run them as the album's tracks"""
+    album_key = f"batch-{batch_id}"
+    label = "Ссылки"
+    _edit_status(chat_id, status_msg, f"Проверяю ссылки: {len(urls)}...")
+    with ThreadPoolExecutor(max_workers=BATCH_PROBE_CONCURRENCY, thread_name_prefix="probe") as pool:
+        probed = list(pool.map(_probe, urls))
+    tracks = [p for p in probed if "error" not in p]
+    failed = [p for p in probed if "error" in p]
+    _edit_status(chat_id, status_msg, f"{label}: {len(failed)}/{len(probed)}")
+    _start(album_key, chat_id, tracks, {
+        "album_id": batch_id, "fmt": "batch", "title": "links", "label": label, "format": fmt,
+        "archive": int(archive), "groups": int(not archive), "status_msg": status_msg,
+    }, failed=failed)
+    if not tracks:
+        _enqueue_finalize(album_key, chat_id)
+
+
+def _start(album_key: str, chat_id: int, tracks: list, state: dict, failed=()):
+    """Store the parent's state and enqueue the first ALBUM_PARALLELISM tracks, in one pipeline"""
+    state_key, tracks_key, results_key, pending_key, _ = _keys(album_key)
+    fmt = state.get("format", TRACK_FORMAT)
+    r = get_redis()
+    with r.pipeline() as pipe:
+        pipe.hset(state_key, mapping={
+            **state, "chat_id": chat_id, "total": len(tracks) + len(failed), "finished": len(failed),
+        })
+        if tracks:
+            pipe.hset(tracks_key, mapping={i: json.dumps(t) for i, t in enumerate(tracks)})
+            pipe.sadd(ACTIVE_KEY, album_key)
+        # links that failed before getting here count as finished tracks
+        if failed:
+            pipe.hset(results_key, mapping={len(tracks) + i: json.dumps(f) for i, f in enumerate(failed)})
+        if len(tracks) > ALBUM_PARALLELISM:
+            pipe.rpush(pending_key, *range(ALBUM_PARALLELISM, len(tracks)))
+        for index in range(min(ALBUM_PARALLELISM, len(tracks))):
+            _enqueue_track(album_key, index, chat_id, tracks[index], fmt, pipeline=pipe)
+        for key in _keys(album_key):
+            pipe.expire(key, ALBUM_STATE_TTL)
+        pipe.execute()
+
+
+# ========================
+# Задача на один трек
+# ========================
+def _fetch_track(album_key: str, index: int, track: dict, archive: bool, fmt: str = TRACK_FORMAT) -> dict:
+    with YoutubeDL({**postprocess.ydl_options(fmt), "quiet": True, "noplaylist": True,
+                    "outtmpl": "%(title)s.%(ext)s"}) as ydl:
+        postprocess.add_postprocessors(ydl, fmt)
+        # batch links come probed by batch_job (utils/info_store.py)
+        info = load_info(track["token"]) if track.get("token") else None
+        if info is not None:
+            info = ydl.process_ie_result(info, download=False)
+        else:
+            info = ydl.extract_info(track["url"], download=False)
+        cache_id = [info["extractor_key"], info["id"], postprocess.cache_format(info, fmt)]
+        hit = result_cache.get(*cache_id)
+        # the archive needs the bytes, a file_id alone won't do
+        if hit and hit.get("file_id") and not archive:
+            return {"file_id": hit["file_id"], "cache_id": cache_id}
+        with workspace(f"{album_key}-{index}", estimate_size(info)) as tmp_dir:
+            ydl.params["paths"] = {"home": tmp_dir}
+            info = ydl.process_ie_result(info, download=True)
+            files = _downloaded_files(info)
+            if not files:
+                raise RuntimeError("yt-dlp не сохранил файл")
+            path = files[0]
+            name = f"{index + 1:02d}. {sanitize_filename(info.get('title') or track['title'])}{os.path.splitext(path)[1]}"
+            key = upload_file_key(path, key=f"downloads/albums/{album_key}/{name}")
+            return {"s3_key": key, "name": name, "size": os.path.getsize(path), "cache_id": cache_id}
+
+
+def track_job(album_key: str, index: int):
+    state_key, tracks_key, _, _, _ = _keys(album_key)
+    r = get_redis()
+    track = json.loads(r.hget(tracks_key, index))
+    archive, fmt = r.hmget(state_key, "archive", "format")
+    result = {"title": track["title"]}
+    try:
+        result.update(_fetch_track(album_key, index, track, archive == b"1", fmt.decode() if fmt else TRACK_FORMAT))
+    except Exception as e:
+        logger.exception("Album %s track %d failed", album_key, index)
+        result["error"] = str(e)[:200]
+    finally:
+        _track_done(album_key, index, result)
+
+
+def _track_done(album_key: str, index: int, result: dict, in_job: bool = True):
+    """
+    Record a track's result (once: the job and sweep() may both try), start the next one.
+    in_job: running in a job process, which may edit the status message itself
+    """
+    state_key, tracks_key, results_key, pending_key, _ = _keys(album_key)
+    r = get_redis()
+    if not r.hsetnx(results_key, index, json.dumps(result)):
+        return
+    with r.pipeline() as pipe:
+        pipe.hincrby(state_key, "finished", 1)
+        pipe.lpop(pending_key)
+        pipe.hmget(state_key, "total", "chat_id", "format")
+        finished, next_index, (total, chat_id, fmt) = pipe.execute()
+    if total is None:
+        return  # state expired
+    if next_index is not None:
+        _enqueue_track(album_key, int(next_index), int(chat_id), json.loads(r.hget(tracks_key, next_index)),
+                       fmt.decode() if fmt else TRACK_FORMAT)
+    if finished == int(total):
+        _enqueue_finalize(album_key, int(chat_id))
+    else:
+        _report_progress(album_key, int(chat_id), in_job)
+
+
+def _job_dead(job_id: str) -> bool:
+    """The track's job is gone without having reported"""
+    try:
+        job = Job.fetch(job_id, connection=get_redis())
+    except NoSuchJobError:
+        return True
+    status = job.get_status(refresh=False)
+    if status in (JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED):
+        return True
+    # the worker running it is gone: nobody killed it at the timeout
+    return (status == JobStatus.STARTED and job.started_at is not None
+            and (utcnow() - job.started_at).total_seconds() > TRACK_TIMEOUT + scheduler.LEASE_GRACE)
+
+
+def sweep(album_key: str = None):
+    """Fail tracks of album_key (default: all active albums) whose jobs died without reporting"""
+    r = get_redis()
+    album_keys = [album_key] if album_key else [k.decode() for k in r.smembers(ACTIVE_KEY)]
+    for key in album_keys:
+        _, tracks_key, results_key, _, jobs_key = _keys(key)
+        if not r.exists(tracks_key):
+            r.srem(ACTIVE_KEY, key)
+            continue
+        done = set(r.hkeys(results_key))
+        for index, job_id in r.hgetall(jobs_key).items():
+            if index in done or not _job_dead(job_id.decode()):
+                continue
+            logger.warning("Album %s track %s: job %s died, giving up on it", key, index.decode(), job_id.decode())
+            track = json.loads(r.hget(tracks_key, index))
+            _track_done(key, int(index), {"title": track["title"], "error": "задача прервана"}, in_job=False)
+
+
+# ========================
+# Итог: медиагруппы, архив, отчёт
+# ========================
+def _report_progress(album_key: str, chat_id: int, in_job: bool = True):
+    if not get_redis().set(f"{_keys(album_key)[0]}:progress", 1, nx=True, ex=ALBUM_PROGRESS_INTERVAL):
+        return
+    if in_job:
+        progress_job(album_key)
+    else:
+        scheduler.enqueue("downloader.album.progress_job", album_key, user_id=chat_id, lane="short", cost=1.0,
+                          job_timeout=60)
+
+
+def progress_job(album_key: str):
+    """Show the album's finished/total in its status message"""
+    state = {k.decode(): v.decode() for k, v in get_redis().hgetall(_keys(album_key)[0]).items()}
+    if not state:
+        return  # expired
+    _edit_status(int(state["chat_id"]), int(state.get("status_msg") or 0),
+                 f"{_label(state)}: {state.get('finished', 0)}/{state['total']}")
+
+
+def _edit_status(chat_id: int, message_id: int, text: str):
+    if not message_id:
+        return
+    try:
+        telegram_client.call("edit_message_text", chat_id=chat_id, message_id=message_id, text=text)
+    except Exception:
+        logger.debug("Progress edit failed", exc_info=True)
+
+
+def _label(state: dict) -> str:
+    return state.get("label") or f"Альбом «{state['title']}»"
+
+
+def _send_media_groups(chat_id: int, album_key: str, items: list):
+    """Send tracks in order, 10 per media group; return file_ids in the same order"""
+    file_ids = []
+    chunks = [items[i:i + MEDIA_GROUP_SIZE] for i in range(0, len(items), MEDIA_GROUP_SIZE)]
+    largest = max((sum(t.get("size", 0) for t in chunk) for chunk in chunks), default=0)
+    with workspace(f"{album_key}-send", largest or None) as tmp_dir:
+        for chunk in chunks:
+            media = []
+            for track in chunk:
+                if track.get("file_id"):
+                    document = track["file_id"]
+                else:
+                    path = os.path.join(tmp_dir, track["name"])
+                    download_file(track["s3_key"], path)
+                    document = FSInputFile(path)
+                media.append(InputMediaDocument(media=document))
+            media[0].caption, media[0].parse_mode = SIGNATURE, "Markdown"
+            messages = telegram_client.call("send_media_group", chat_id=chat_id, media=media)
+            for track, msg in zip(chunk, messages):
+                file_id = msg.document.file_id if msg.document else None
+                file_ids.append(file_id)
+                if file_id and not track.get("file_id"):
+                    result_cache.put(*track["cache_id"], file_id=file_id)
+            for name in os.listdir(tmp_dir):
+                if not name.startswith("."):
+                    os.remove(os.path.join(tmp_dir, name))
+    return file_ids
+
+
+def _archive(album_key: str, title: str, tracks: list) -> str:
+    """Zip staged tracks into one S3 object without touching local disk"""
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def produce():
+        try:
+            with os.fdopen(write_fd, "wb") as out, zipfile.ZipFile(out, "w", zipfile.ZIP_STORED) as zf:
+                for track in tracks:
+                    with zf.open(track["name"], "w", force_zip64=True) as dst:
+                        shutil.copyfileobj(open_object(track["s3_key"]), dst, 1024 * 1024)
+        except Exception as e:
+            errors.append(e)
+
+    def check():
+        producer.join()
+        if errors:
+            raise errors[0]
+
+    producer = threading.Thread(target=produce, name=f"zip-{album_key}", daemon=True)
+    producer.start()
+    with os.fdopen(read_fd, "rb") as stream:
+        return stream_upload(stream, f"downloads/albums/{album_key}/{sanitize_filename(title)}.zip",
+                             before_complete=check)
+
+
+def _split_text(lines: list, limit: int = MESSAGE_LIMIT) -> list:
+    """Join lines into as few texts under Telegram's message limit as possible"""
+    texts = [""]
+    for line in lines:
+        line = line[:limit]
+        if texts[-1] and len(texts[-1]) + 1 + len(line) > limit:
+            texts.append("")
+        texts[-1] = f"{texts[-1]}\n{line}" if texts[-1] else line
+    return texts
+
+
+def _enqueue_finalize(album_key: str, chat_id: int):
+    scheduler.enqueue("downloader.album.finalize_job", album_key, user_id=chat_id, lane="short", cost=1.0,
+                      job_timeout=ALBUM_FINALIZE_TIMEOUT)
+
+
+def finalize_job(album_key: str):
+    """Deliver a finished album: media groups, links, archive, summary, waiters"""
+    state_key, _, results_key, _, _ = _keys(album_key)
+    r = get_redis()
+    state = {k.decode(): v.decode() for k, v in r.hgetall(state_key).items()}
+    results = r.hgetall(results_key)
+    results = [json.loads(results[i]) for i in sorted(results, key=int)]
+    chat_id, title, total = int(state["chat_id"]), state["title"], int(state["total"])
+
+    ok = [t for t in results if "error" not in t]
+    sendable = [t for t in ok if t.get("file_id") or t.get("size", 0) < MAX_FILE_SIZE]
+    oversized = [t for t in ok if t not in sendable]
+    lines = [f"{_label(state)}: готово {len(ok)} из {total}."]
+    file_ids = []
+    # a batch asked for the archive gets only the archive
+    groups = state.get("groups", "1") == "1"
+    try:
+        if sendable and groups:
+            file_ids = _send_media_groups(chat_id, album_key, sendable)
+        for track in oversized if groups else ():
+            lines.append(f"{track['name']}: {presign(track['s3_key'])}")
+        if state.get("archive") == "1" and ok and all(t.get("s3_key") for t in ok):
+            lines.append(f"Архив: {presign(_archive(album_key, title, ok))}")
+    except Exception as e:
+        logger.exception("Album %s delivery failed", album_key)
+        lines.append(f"Ошибка отправки: {e}")
+    failed = [t for t in results if "error" in t]
+    if failed:
+        lines.append("Не удалось скачать:")
+        lines += [f"— {t['title']}: {t['error']}" for t in failed]
+    # a batch of links can report more than one message holds
+    summary = _split_text(lines)
+    for text in summary:
+        telegram_client.send_text(chat_id, text)
+
+    # те, кто попросил тот же альбом, пока он качался
+    waiters = [c for c in inflight.finish(state["album_id"], state["fmt"]) if c != chat_id]
+    for waiter in waiters:
+        try:
+            ids = [f for f in file_ids if f]
+            for i in range(0, len(ids), MEDIA_GROUP_SIZE):
+                telegram_client.call("send_media_group", chat_id=waiter,
+                                     media=[InputMediaDocument(media=f) for f in ids[i:i + MEDIA_GROUP_SIZE]])
+            for text in summary:
+                telegram_client.send_text(waiter, text)
+        except Exception:
+            logger.exception("Album fan-out to %s failed", waiter)
+    r.delete(*_keys(album_key))
+    r.srem(ACTIVE_KEY, album_key)
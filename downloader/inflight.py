@@ -0,0 +1,137 @@
+import os
+import hashlib
+import logging
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
+from utils.redis_client import get_redis
+
+logger = logging.getLogger("downloader.inflight")
+
+# One job per normalized (url, format) while it is queued or running; repeated
+# requests attach their chat as a waiter and get the same result fanned out.
+# The registration outlives the longest job. An owner that died without
+# finish() (OOM, killed work horse) is taken over by the next request: its RQ
+# job is failed, stopped or gone. The workers' failure handler also release()s
+# it. An owner whose work goes on after its job (downloader/album.py) hands off
+# to a Redis key and is alive while that key exists.
+INFLIGHT_TTL = int(os.getenv("DOWNLOAD_TIMEOUT", "1800")) + 300
+PENDING = "pending"  # owner value until the job id is known
+PENDING_TTL = 60  # attach() to set_job_id(): one enqueue
+_KEY_OWNER = "key:"
+
+_TRACKING_PARAMS = {"si", "feature", "fbclid", "gclid", "igshid", "pp", "ab_channel"}
+_YOUTUBE_ALIASES = {"www.youtube.com", "m.youtube.com", "music.youtube.com"}
+
+# KEYS[1] owner, KEYS[2] waiters; ARGV[1] chat id, ARGV[2] ttl, ARGV[3] pending ttl
+# returns current owner (job id / "pending"), or nil if the caller became owner
+_ATTACH = """
+local owner = redis.call('GET', KEYS[1])
+redis.call('RPUSH', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+if owner then return owner end
+redis.call('SET', KEYS[1], 'pending', 'EX', ARGV[3])
+return false
+"""
+# KEYS[1] owner; ARGV[1] dead owner, ARGV[2] pending ttl; 1 if the caller took over
+_TAKE_OVER = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('SET', KEYS[1], 'pending', 'EX', ARGV[2])
+return 1
+"""
+# KEYS[1] owner, KEYS[2] waiters; ARGV[1] owner; waiters if it still was the owner
+_RELEASE = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return {} end
+local waiters = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2])
+return waiters
+"""
+_scripts = {}
+
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    # www./m./music.youtube.com serve the same videos; other sites' subdomains
+    # can be different services (music.apple.com is not apple.com)
+    if host in _YOUTUBE_ALIASES:
+        host = "youtube.com"
+    path = parts.path.rstrip("/")
+    query = [(k, v) for k, v in parse_qsl(parts.query)
+             if k not in _TRACKING_PARAMS and not k.startswith("utm_")]
+    # youtu.be/<id> and /shorts/<id> are the same video as /watch?v=<id>
+    if host == "youtu.be" and path:
+        host, query, path = "youtube.com", [("v", path.lstrip("/"))] + query, "/watch"
+    elif host == "youtube.com" and path.startswith("/shorts/"):
+        query, path = [("v", path.split("/")[2])] + query, "/watch"
+    return urlunsplit(("https", host, path, urlencode(sorted(query)), ""))
+
+
+def _keys(url: str, fmt: str):
+    digest = hashlib.sha1(f"{normalize_url(url)}|{fmt}".encode()).hexdigest()
+    return f"inflight:{digest}", f"inflight:{digest}:waiters"
+
+
+def _script(source: str):
+    if source not in _scripts:
+        _scripts[source] = get_redis().register_script(source)
+    return _scripts[source]
+
+
+def _owner_dead(owner: str) -> bool:
+    """The owner won't finish(): its job failed, was stopped or is gone"""
+    if owner == PENDING:
+        return False  # expires PENDING_TTL after a lost enqueue
+    r = get_redis()
+    if owner.startswith(_KEY_OWNER):
+        return not r.exists(owner[len(_KEY_OWNER):])
+    try:
+        job = Job.fetch(owner, connection=r)
+    except NoSuchJobError:
+        return True
+    return job.get_status() in (JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED)
+
+
+def attach(url: str, fmt: str, chat_id: int):
+    """
+    Register chat as waiter for (url, fmt).
+    Returns owner job id ("pending" while being enqueued) if a live job already exists,
+    None if the caller must enqueue it and then call set_job_id().
+    """
+    keys = _keys(url, fmt)
+    owner = _script(_ATTACH)(keys=keys, args=[chat_id, INFLIGHT_TTL, PENDING_TTL])
+    if owner is None:
+        return None
+    owner = owner.decode()
+    if not _owner_dead(owner):
+        return owner
+    # the waiters stay: the new job fans out to them as well
+    if _script(_TAKE_OVER)(keys=keys[:1], args=[owner, PENDING_TTL]):
+        logger.warning("Owner %s of %s (%s) is dead, taking over", owner, url, fmt)
+        return None
+    return (get_redis().get(keys[0]) or PENDING.encode()).decode()
+
+
+def set_job_id(url: str, fmt: str, job_id: str):
+    get_redis().set(_keys(url, fmt)[0], job_id, xx=True, ex=INFLIGHT_TTL)
+
+
+def hand_off(url: str, fmt: str, key: str):
+    """The owner's job ends but its work goes on: the registration lives while key exists"""
+    get_redis().set(_keys(url, fmt)[0], _KEY_OWNER + key, xx=True, keepttl=True)
+
+
+def release(url: str, fmt: str, job_id: str):
+    """finish() for a job that died (FairWorker.handle_job_failure): only if it still owns (url, fmt)"""
+    raw = _script(_RELEASE)(keys=_keys(url, fmt), args=[job_id])
+    return list(dict.fromkeys(int(c) for c in raw))
+
+
+def finish(url: str, fmt: str):
+    """Drop the registration, return chat ids (unique, in arrival order) waiting for it"""
+    owner_key, waiters_key = _keys(url, fmt)
+    with get_redis().pipeline() as pipe:
+        pipe.lrange(waiters_key, 0, -1)
+        pipe.delete(waiters_key, owner_key)
+        raw, _ = pipe.execute()
+    return list(dict.fromkeys(int(c) for c in raw))
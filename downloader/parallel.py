@@ -0,0 +1,171 @@
+import os
+import re
+import time
+import socket
+import logging
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from yt_dlp.networking import Request
+from yt_dlp.postprocessor.common import PostProcessor
+
+from utils.redis_client import get_redis
+
+logger = logging.getLogger("downloader.parallel")
+
+# Big downloads fetch several pieces at once. HLS/DASH fragments go through
+# yt-dlp's concurrent_fragment_downloads; a plain single-file format is cut into
+# byte ranges and handed to yt-dlp as a synthetic HLS playlist (#EXT-X-BYTERANGE),
+# so the same fragment machinery fetches it in parallel and its .ytdl state file
+# lets a retried job continue where the previous attempt stopped (the workspace
+# keeps partial files, downloader/workspace.py). Connections are leased in Redis
+# per source host (all workers) and per worker, so ten jobs from one CDN don't
+# open forty sockets to it.
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", "4"))  # per job
+HOST_MAX_CONNECTIONS = int(os.getenv("DOWNLOAD_HOST_MAX_CONNECTIONS", "16"))  # per source host, all workers
+WORKER_MAX_CONNECTIONS = int(os.getenv("DOWNLOAD_WORKER_MAX_CONNECTIONS", "32"))
+RANGE_SPLIT_MIN_BYTES = int(os.getenv("RANGE_SPLIT_MIN_MB", "32")) * 1024 * 1024
+RANGE_CHUNK_BYTES = int(os.getenv("RANGE_CHUNK_MB", "8")) * 1024 * 1024
+LEASE_TTL = int(os.getenv("DOWNLOAD_TIMEOUT", "1800")) + 60
+WAIT_LOG_SECONDS = 30
+
+# KEYS: connection zsets (member "job:n", score = lease expiry); ARGV[1] now,
+# ARGV[2] job id, ARGV[3] wanted, ARGV[4] expiry, then each key's cap.
+# Grants as many as every key can spare (0 if one is full). A retried job
+# re-adds the same members, so its crashed attempt's lease isn't counted twice.
+_ACQUIRE = """
+local now, want = tonumber(ARGV[1]), tonumber(ARGV[3])
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+    local held = redis.call('ZCARD', key)
+    for n = 1, want do
+        if redis.call('ZSCORE', key, ARGV[2] .. ':' .. n) then held = held - 1 end
+    end
+    want = math.min(want, tonumber(ARGV[4 + i]) - held)
+end
+if want < 1 then return 0 end
+for _, key in ipairs(KEYS) do
+    for n = 1, want do
+        redis.call('ZADD', key, ARGV[4], ARGV[2] .. ':' .. n)
+    end
+    redis.call('EXPIREAT', key, math.ceil(tonumber(ARGV[4])))
+end
+return want
+"""
+_acquire_script = None
+
+
+def _worker_name() -> str:
+    return os.getenv("WORKER_NAME") or socket.gethostname()
+
+
+def hosts(info: dict) -> set:
+    """Source hosts of the selected formats of a processed info dict"""
+    if info.get("_type") == "playlist":
+        return {h for entry in info.get("entries") or [] if entry for h in hosts(entry)}
+    urls = [f.get("url") for f in info.get("requested_formats") or [info]]
+    return {urlsplit(u).hostname for u in urls if u and urlsplit(u).hostname}
+
+
+@contextmanager
+def connections(job_id: str, source_hosts, worker: str = None, want: int = DOWNLOAD_CONNECTIONS):
+    """
+    Lease up to `want` connections to `source_hosts` for job_id, waiting while
+    any host or this worker is at its cap. Yields the number granted.
+    """
+    global _acquire_script
+    r = get_redis()
+    if _acquire_script is None:
+        _acquire_script = r.register_script(_ACQUIRE)
+    keys = [f"conn:host:{h}" for h in sorted(source_hosts)]
+    keys.append(f"conn:worker:{worker or _worker_name()}")
+    caps = [HOST_MAX_CONNECTIONS] * (len(keys) - 1) + [WORKER_MAX_CONNECTIONS]
+    want = max(1, want)
+    started = time.monotonic()
+    logged = False
+    while True:
+        now = time.time()
+        granted = int(_acquire_script(keys=keys, args=[now, job_id, want, now + LEASE_TTL] + caps))
+        if granted:
+            break
+        if not logged and time.monotonic() - started > WAIT_LOG_SECONDS:
+            logger.warning("Job %s waiting for a connection to %s", job_id, ", ".join(source_hosts))
+            logged = True
+        time.sleep(1)
+    try:
+        yield granted
+    finally:
+        with r.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.zrem(key, *(f"{job_id}:{n}" for n in range(1, granted + 1)))
+            pipe.execute()
+
+
+def ydl_options(granted: int) -> dict:
+    """yt-dlp options for a job holding `granted` connections"""
+    return {
+        "concurrent_fragment_downloads": granted,
+        # keep .part/.ytdl files and continue them on the next attempt
+        "continuedl": True,
+        "retries": 10,
+        "fragment_retries": 10,
+        "file_access_retries": 3,
+    }
+
+
+def _range_playlist(url: str, size: int) -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:4", "#EXT-X-TARGETDURATION:1",
+             "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:VOD"]
+    for offset in range(0, size, RANGE_CHUNK_BYTES):
+        length = min(RANGE_CHUNK_BYTES, size - offset)
+        lines += ["#EXTINF:1.0,", f"#EXT-X-BYTERANGE:{length}@{offset}", url]
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+class RangeSplitPP(PostProcessor):
+    """
+    before_dl step: serve big single-file http(s) formats as byte-range HLS
+    playlists so they download over several connections and resume per piece.
+    """
+
+    def __init__(self, downloader=None, connections: int = 1):
+        super().__init__(downloader)
+        self.connections = connections
+
+    def _total_size(self, fmt: dict):
+        """Size from a 1-byte range request; None if the server ignores ranges"""
+        request = Request(fmt["url"], headers={**(fmt.get("http_headers") or {}), "Range": "bytes=0-0"})
+        try:
+            with self._downloader.urlopen(request) as response:
+                if response.status != 206:
+                    return None
+                match = re.match(r"bytes 0-0/(\d+)$", response.headers.get("Content-Range", ""))
+                return int(match.group(1)) if match else None
+        except Exception as e:
+            self.write_debug(f"Range probe failed: {e}")
+            return None
+
+    def _split(self, fmt: dict) -> bool:
+        if fmt.get("protocol") not in ("http", "https") or fmt.get("section_start") or fmt.get("section_end"):
+            return False
+        known = fmt.get("filesize") or fmt.get("filesize_approx")
+        if known and known < RANGE_SPLIT_MIN_BYTES:
+            return False
+        size = self._total_size(fmt)
+        if not size or size < RANGE_SPLIT_MIN_BYTES:
+            return False
+        fmt.update(protocol="m3u8_native", filesize=size,
+                   hls_media_playlist_data=_range_playlist(fmt["url"], size))
+        return True
+
+    @PostProcessor._restrict_to(images=False)
+    def run(self, info):
+        if self.connections < 2:
+            return [], info
+        requested = info.get("requested_formats")
+        if requested:
+            if any([self._split(f) for f in requested]):
+                info["protocol"] = "+".join(f["protocol"] for f in requested)
+        else:
+            self._split(info)
+        return [], info
@@ -0,0 +1,92 @@
+import os
+from functools import lru_cache
+
+from downloader.routing import fit_selector
+
+# Buttons ask for an output ("mp3", "720p"), not a yt-dlp format. A profile turns
+# it into a selector that picks the source needing the least work (audio-only
+# streams for audio, <=720p h264/aac for video) plus the steps to reach the
+# output: stream copies (audio passthrough, merge/remux into mp4) where codecs
+# allow, an encode only where they don't (in a host-wide pool, see
+# downloader/transcode.py). Outputs are cached per source format and profile
+# (cache_format), every video is encoded once. "fit" is the best video that fits
+# the Telegram upload limit (downloader/routing.py). Anything that isn't a
+# profile name is used as a yt-dlp format selector as is.
+# The web process only needs the selectors (lanes, sizes): yt-dlp is imported
+# where post-processors are actually added.
+AUDIO_PASSTHROUGH = os.getenv("AUDIO_PASSTHROUGH", "1") == "1"  # deliver aac/mp3 sources without encoding
+
+PROFILES = {
+    "mp3": {
+        "format": "ba[acodec^=mp3]/ba[ext=m4a]/ba/b",
+        "format_no_ffmpeg": "ba[ext=m4a]/ba/b",
+        # source ext > output; aac and mp3 pass through as they are
+        "audio": "mp3>mp3/m4a>m4a/mp4>m4a/mp3" if AUDIO_PASSTHROUGH else "mp3",
+    },
+    "720p": {
+        "format": "bv*[height<=720]+ba/b[height<=720]/bv*+ba/b",
+        "format_no_ffmpeg": "b[height<=720]/b",
+        # prefer what merges into mp4 without encoding
+        "format_sort": ["res:720", "vcodec:h264", "acodec:aac"],
+        "remux": "mp4",
+    },
+    "fit": {
+        "format": fit_selector(merge=True),
+        "format_no_ffmpeg": fit_selector(merge=False),
+        "format_sort": ["res", "vcodec:h264", "acodec:aac"],
+        "remux": "mp4",
+    },
+}
+
+
+@lru_cache(maxsize=1)
+def ffmpeg_available() -> bool:
+    from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+    return FFmpegPostProcessor().available
+
+
+def selector(fmt: str, ffmpeg: bool = None) -> str:
+    """
+    yt-dlp format selector (string or callable) for a requested output;
+    ffmpeg: whether the downloading side has it (default: this host)
+    """
+    profile = PROFILES.get(fmt)
+    if profile is None:
+        return fmt
+    if ffmpeg is None:
+        ffmpeg = ffmpeg_available()
+    return profile["format"] if ffmpeg else profile["format_no_ffmpeg"]
+
+
+def converts(fmt: str) -> bool:
+    """Output differs from the downloaded source (needs a local file to post-process)"""
+    return fmt in PROFILES and ffmpeg_available()
+
+
+def ydl_options(fmt: str) -> dict:
+    options = {"format": selector(fmt)}
+    profile = PROFILES.get(fmt, {})
+    if profile.get("format_sort"):
+        options["format_sort"] = profile["format_sort"]
+    if profile.get("remux"):
+        options["merge_output_format"] = profile["remux"]
+    return options
+
+
+def add_postprocessors(ydl, fmt: str):
+    """Register the profile's steps on a YoutubeDL"""
+    if not converts(fmt):
+        return
+    from yt_dlp.postprocessor import FFmpegVideoRemuxerPP
+    from downloader.transcode import PooledExtractAudioPP
+    profile = PROFILES[fmt]
+    if profile.get("audio"):
+        ydl.add_post_processor(PooledExtractAudioPP(ydl, preferredcodec=profile["audio"]), when="post_process")
+    if profile.get("remux"):
+        ydl.add_post_processor(FFmpegVideoRemuxerPP(ydl, preferedformat=profile["remux"]), when="post_process")
+
+
+def cache_format(info: dict, fmt: str) -> str:
+    """Result cache format of a processed info dict: source format, plus profile if converted"""
+    source = info.get("format_id") or fmt
+    return f"{source}>{fmt}" if converts(fmt) else source
@@ -0,0 +1,87 @@
+import os
+import time
+import logging
+from utils.redis_client import get_redis
+from utils.metrics import TRANSCODE_SECONDS
+
+logger = logging.getLogger("downloader.progress")
+
+# Jobs report what they are doing into a Redis hash per job and ping the bot
+# over pub/sub; the bot turns that into edits of one status message
+# (bot/progress.py). Publishing is throttled here already: yt-dlp calls its
+# hooks for every chunk.
+PROGRESS_CHANNEL = "progress"
+PROGRESS_TTL = int(os.getenv("DOWNLOAD_TIMEOUT", "1800")) + 600
+PUBLISH_INTERVAL = float(os.getenv("PROGRESS_PUBLISH_INTERVAL", "1"))
+STAGES = ("queued", "downloading", "transcoding", "uploading", "done", "failed")
+FINAL_STAGES = ("done", "failed")
+
+
+def _key(job_id: str) -> str:
+    return f"progress:{job_id}"
+
+
+def publish(job_id: str, stage: str, pipeline=None, **fields):
+    """Set job's stage (+ fields like percent/speed/eta) and notify the bot"""
+    state = {"stage": stage, "updated": round(time.time(), 1)}
+    state.update({k: v for k, v in fields.items() if v is not None})
+    pipe = pipeline if pipeline is not None else get_redis().pipeline(transaction=False)
+    pipe.hset(_key(job_id), mapping=state)
+    pipe.expire(_key(job_id), PROGRESS_TTL)
+    pipe.publish(PROGRESS_CHANNEL, job_id)
+    if pipeline is None:
+        pipe.execute()
+
+
+def get(job_id: str) -> dict:
+    """Current progress state of a job ({} if unknown)"""
+    return {k.decode(): v.decode() for k, v in get_redis().hgetall(_key(job_id)).items()}
+
+
+class Reporter:
+    """Progress of one job: yt-dlp hooks plus explicit stages, rate-limited"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self._stage = None
+        self._last = 0.0
+        self._pp_started = {}
+
+    def stage(self, stage: str, **fields):
+        now = time.monotonic()
+        # stage changes always go out, updates within a stage at most every PUBLISH_INTERVAL
+        if stage == self._stage and now - self._last < PUBLISH_INTERVAL:
+            return
+        self._stage, self._last = stage, now
+        try:
+            publish(self.job_id, stage, **fields)
+        except Exception:
+            # progress is best effort, never fail the download over it
+            logger.debug("Progress publish failed", exc_info=True)
+
+    def hook(self, d: dict):
+        """yt-dlp progress_hooks entry"""
+        if d.get("status") != "downloading":
+            return
+        total = d.get("total_bytes") or d.get("total_bytes_estimate")
+        percent = None
+        if total and d.get("downloaded_bytes") is not None:
+            percent = round(100 * d["downloaded_bytes"] / total, 1)
+        elif d.get("fragment_count"):
+            percent = round(100 * (d.get("fragment_index") or 0) / d["fragment_count"], 1)
+        speed, eta = d.get("speed"), d.get("eta")
+        self.stage("downloading", percent=percent, speed=int(speed) if speed else None,
+                   eta=int(eta) if eta is not None else None)
+
+    def pp_hook(self, d: dict):
+        """yt-dlp postprocessor_hooks entry"""
+        name = d.get("postprocessor")
+        # bookkeeping, not transcoding: moving files, and downloader/parallel.py's
+        # before_dl range split (which would show "transcoding" before the download)
+        if name in ("MoveFiles", "RangeSplit"):
+            return
+        if d.get("status") == "started":
+            self._pp_started[name] = time.monotonic()
+            self.stage("transcoding", step=name)
+        elif d.get("status") == "finished" and name in self._pp_started:
+            TRANSCODE_SECONDS.labels(name).observe(time.monotonic() - self._pp_started.pop(name))
@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import logging
+from utils.redis_client import get_redis
+from utils.s3 import RESULT_TTL_SECONDS, S3_OBJECT_TTL_SECONDS
+from utils.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger("downloader.result_cache")
+
+# Results are content-addressed: (extractor, video id, resolved format) -> what we
+# already delivered once (Telegram file_id and/or S3 object key).
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "2592000"))  # 30 days
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "50000"))
+
+_PREFIX = "result:"
+_LRU_KEY = "result:lru"  # zset: key -> last access time
+
+
+def cache_key(extractor: str, video_id: str, fmt: str) -> str:
+    return f"{_PREFIX}{extractor.lower()}:{video_id}:{fmt}"
+
+
+def _s3_ttl() -> int:
+    # a hit must be able to hand out a full-length presigned link before the
+    # bucket lifecycle rule deletes the object
+    return S3_OBJECT_TTL_SECONDS - RESULT_TTL_SECONDS
+
+
+def get(extractor: str, video_id: str, fmt: str):
+    """Return {"file_id": ..., "s3_key": ...} or None"""
+    key = cache_key(extractor, video_id, fmt)
+    r = get_redis()
+    raw = r.get(key)
+    if raw is None:
+        CACHE_REQUESTS.labels("result", "miss").inc()
+        return None
+    entry = json.loads(raw)
+    if entry.get("s3_key") and entry.get("s3_expires", 0) <= time.time():
+        entry.pop("s3_key")
+    if not entry.get("file_id") and not entry.get("s3_key"):
+        CACHE_REQUESTS.labels("result", "miss").inc()
+        return None
+    CACHE_REQUESTS.labels("result", "hit").inc()
+    r.zadd(_LRU_KEY, {key: time.time()})
+    return entry
+
+
+def put(extractor: str, video_id: str, fmt: str, file_id: str = None, s3_key: str = None):
+    key = cache_key(extractor, video_id, fmt)
+    now = time.time()
+    entry = {"created": int(now)}
+    ttl = 0
+    if file_id:
+        entry["file_id"] = file_id
+        ttl = RESULT_CACHE_TTL
+    if s3_key and _s3_ttl() > 0:
+        entry["s3_key"] = s3_key
+        entry["s3_expires"] = int(now + _s3_ttl())
+        ttl = max(ttl, _s3_ttl())
+    if ttl <= 0:
+        return
+    r = get_redis()
+    with r.pipeline() as pipe:
+        pipe.set(key, json.dumps(entry), ex=ttl)
+        pipe.zadd(_LRU_KEY, {key: now})
+        pipe.zremrangebyscore(_LRU_KEY, 0, now - RESULT_CACHE_TTL)
+        pipe.zcard(_LRU_KEY)
+        size = pipe.execute()[-1]
+    if size > RESULT_CACHE_MAX_ENTRIES:
+        _evict(r, size - RESULT_CACHE_MAX_ENTRIES)
+
+
+def invalidate(extractor: str, video_id: str, fmt: str):
+    key = cache_key(extractor, video_id, fmt)
+    r = get_redis()
+    with r.pipeline() as pipe:
+        pipe.delete(key)
+        pipe.zrem(_LRU_KEY, key)
+        pipe.execute()
+
+
+def _evict(r, count: int):
+    victims = [k for k, _ in r.zpopmin(_LRU_KEY, count)]
+    if victims:
+        r.delete(*victims)
+        logger.info("Result cache: evicted %d LRU entries", len(victims))
@@ -0,0 +1,73 @@
+import os
+from functools import lru_cache
+
+from downloader.sizing import estimate_size
+from downloader.streaming import STREAM_UPLOAD
+from utils.telegram_client import UPLOAD_LIMIT
+from utils.metrics import DELIVERY_ROUTES
+
+# Where a result goes is decided from the probed sizes (filesize, filesize_approx,
+# bitrate x duration) once formats are selected, before anything is downloaded:
+#   TELEGRAM   fits the Bot API upload limit: workspace, then sendDocument
+#   S3_STREAM  too big, delivered as is: yt-dlp stdout straight into S3, no disk
+#   S3         too big but post-processed: workspace, then S3 upload
+# Unknown sizes go the TELEGRAM way and are routed by the real file size after
+# the download. The limit is 50 MB, 2000 MB with a local Bot API server
+# (TELEGRAM_API_LOCAL, utils/telegram_client.py). The "fit" profile picks the
+# best quality whose estimate stays under the limit instead.
+TELEGRAM, S3_STREAM, S3 = "telegram", "s3_stream", "s3"
+# estimates are rough: "fit" aims this share of the limit
+FIT_HEADROOM = float(os.getenv("FIT_HEADROOM", "0.9"))
+
+
+def route(info: dict, converts: bool) -> str:
+    """Delivery route of a processed info dict (formats selected)"""
+    size = estimate_size(info)
+    if size is None or size < UPLOAD_LIMIT:
+        decided = TELEGRAM
+    elif STREAM_UPLOAD and not converts and info.get("_type", "video") == "video":
+        decided = S3_STREAM
+    else:
+        decided = S3
+    DELIVERY_ROUTES.labels(decided).inc()
+    return decided
+
+
+@lru_cache(maxsize=None)
+def _compiled(spec: str):
+    from yt_dlp import YoutubeDL
+    return YoutubeDL({"quiet": True, "merge_output_format": "mp4"}).build_format_selector(spec)
+
+
+def fit_selector(merge: bool = True):
+    """
+    yt-dlp format selector (a callable, see "format" in YoutubeDL's options):
+    the highest resolution whose estimated size fits UPLOAD_LIMIT. Candidates
+    without a size are only taken if nothing known fits; if nothing fits at
+    all, the smallest formats (they get routed to S3).
+    """
+    budget = UPLOAD_LIMIT * FIT_HEADROOM
+
+    def select(ctx):
+        heights = sorted({f["height"] for f in ctx["formats"] if f.get("height")}, reverse=True)
+        specs = []
+        for height in heights:
+            if merge:
+                specs += [f"bv*[height<={height}]+ba", f"bv*[height<={height}]+wa"]
+            specs.append(f"b[height<={height}]")
+        unknown = None
+        for spec in specs:
+            picked = next(_compiled(spec)(ctx), None)
+            if picked is None:
+                continue
+            size = estimate_size(picked)
+            if size is None:
+                unknown = unknown or picked
+            elif size <= budget:
+                yield picked
+                return
+        picked = unknown or next(_compiled("wv*+wa/w" if merge else "w")(ctx), None)
+        if picked is not None:
+            yield picked
+
+    return select
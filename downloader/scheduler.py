@@ -0,0 +1,352 @@
+import os
+import time
+import logging
+import redis
+from rq import Queue, Worker
+from rq.job import Job, JobStatus
+from rq.utils import utcnow
+from rq.worker import WorkerStatus
+from rq.exceptions import NoSuchJobError, DequeueTimeout
+
+from downloader import inflight, progress
+from downloader.sizing import estimate_selection
+from downloader.postprocess import selector
+from downloader.routing import FIT_HEADROOM
+from utils.telegram_client import UPLOAD_LIMIT
+from utils.redis_client import get_redis
+from utils.metrics import QUEUE_WAIT_SECONDS, prune as prune_metrics
+
+logger = logging.getLogger("downloader.scheduler")
+
+# Jobs don't go into one FIFO. Each one is filed under its user in a cost lane
+# and a worker with a free slot asks for the next one: deficit round-robin
+# between users inside a lane (cost = expected MB), a cap on running jobs per
+# user and on the heavy lane, short lane first. Async workers keep part of their
+# slots for short jobs, so a 4 MB song doesn't wait behind a 2-hour 4K video.
+# RQ still owns job state and registries; only the order comes from here.
+QUEUE_NAME = "downloads"
+LANES = ("short", "standard", "heavy")
+LANE_SHORT_MAX_MB = float(os.getenv("LANE_SHORT_MAX_MB", "25"))
+LANE_HEAVY_MIN_MB = float(os.getenv("LANE_HEAVY_MIN_MB", "500"))
+LANE_HEAVY_MAX_RUNNING = int(os.getenv("LANE_HEAVY_MAX_RUNNING", "2"))  # whole cluster, 0 = no cap
+USER_MAX_RUNNING = int(os.getenv("SCHED_USER_MAX_RUNNING", "2"))
+QUANTUM_MB = float(os.getenv("SCHED_QUANTUM_MB", "25"))
+# share of an async worker's slots that only take short-lane jobs
+SHORT_SLOT_SHARE = float(os.getenv("SCHED_SHORT_SLOT_SHARE", "0.25"))
+# lanes this worker takes jobs from, e.g. WORKER_LANES=short for a dedicated fast worker
+WORKER_LANES = tuple(os.getenv("WORKER_LANES", ",".join(LANES)).split(","))
+LEASE_GRACE = 60  # a crashed worker's slot comes back after job timeout + this
+
+_WAKEUP = "sched:wakeup"
+
+# ARGV[1] lane, ARGV[2] user, ARGV[3] job id, ARGV[4] cost, ARGV[5] lease seconds
+# sched:jobs holds "cost lease" per waiting job
+_SUBMIT = """
+local p = 'sched:' .. ARGV[1]
+redis.call('RPUSH', p .. ':u:' .. ARGV[2], ARGV[3])
+redis.call('HSET', 'sched:jobs', ARGV[3], ARGV[4] .. ' ' .. ARGV[5])
+if redis.call('SADD', p .. ':users', ARGV[2]) == 1 then
+    redis.call('RPUSH', p .. ':ring', ARGV[2])
+end
+redis.call('LPUSH', 'sched:wakeup', 1)
+redis.call('LTRIM', 'sched:wakeup', 0, 99)
+"""
+
+# ARGV[1] now, ARGV[2] per-user cap, ARGV[3] quantum, then (lane, lane cap) pairs in
+# priority order. Returns {job id, lane, user} or nil.
+# DRR without looping round by round: the user that needs the fewest quantum
+# top-ups for its head job wins (ring order breaks ties), every eligible user gets
+# those top-ups, the winner pays the job cost and moves to the ring tail.
+_DISPATCH = """
+local now, user_cap, quantum = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+for i = 4, #ARGV, 2 do
+    local lane, lane_cap = ARGV[i], tonumber(ARGV[i + 1])
+    local p = 'sched:' .. lane
+    redis.call('ZREMRANGEBYSCORE', p .. ':running', '-inf', now)
+    if lane_cap == 0 or redis.call('ZCARD', p .. ':running') < lane_cap then
+        local eligible, best, best_rounds, best_job, best_cost, best_lease = {}
+        for _, user in ipairs(redis.call('LRANGE', p .. ':ring', 0, -1)) do
+            local running = 'sched:running:' .. user
+            redis.call('ZREMRANGEBYSCORE', running, '-inf', now)
+            local job = redis.call('LINDEX', p .. ':u:' .. user, 0)
+            if not job then
+                redis.call('LREM', p .. ':ring', 0, user)
+                redis.call('SREM', p .. ':users', user)
+                redis.call('HDEL', p .. ':deficit', user)
+            elseif redis.call('ZCARD', running) < user_cap then
+                local cost, lease = string.match(redis.call('HGET', 'sched:jobs', job) or '1 3600', '(%S+) (%S+)')
+                cost = tonumber(cost)
+                local deficit = tonumber(redis.call('HGET', p .. ':deficit', user) or '0')
+                local rounds = math.max(0, math.ceil((cost - deficit) / quantum))
+                eligible[#eligible + 1] = user
+                if best == nil or rounds < best_rounds then
+                    best, best_rounds, best_job, best_cost, best_lease = user, rounds, job, cost, tonumber(lease)
+                end
+            end
+        end
+        if best then
+            if best_rounds > 0 then
+                for _, user in ipairs(eligible) do
+                    redis.call('HINCRBYFLOAT', p .. ':deficit', user, best_rounds * quantum)
+                end
+            end
+            local list = p .. ':u:' .. best
+            redis.call('LPOP', list)
+            redis.call('HDEL', 'sched:jobs', best_job)
+            redis.call('LREM', p .. ':ring', 1, best)
+            if redis.call('LLEN', list) > 0 then
+                redis.call('RPUSH', p .. ':ring', best)
+                redis.call('HINCRBYFLOAT', p .. ':deficit', best, -best_cost)
+            else
+                redis.call('SREM', p .. ':users', best)
+                redis.call('HDEL', p .. ':deficit', best)
+            end
+            redis.call('ZADD', 'sched:running:' .. best, now + best_lease, best_job)
+            redis.call('ZADD', p .. ':running', now + best_lease, best_job)
+            return {best_job, lane, best}
+        end
+    end
+end
+return false
+"""
+_scripts = {}
+
+
+def _script(source: str):
+    if source not in _scripts:
+        _scripts[source] = get_redis().register_script(source)
+    return _scripts[source]
+
+
+def _audio_only(fmt) -> bool:
+    return isinstance(fmt, str) and fmt.split("/")[0].split("[")[0] in ("bestaudio", "ba")
+
+
+def _estimate(info: dict, fmt):
+    if callable(fmt):
+        # running a callable selector ("fit") takes yt-dlp, which the web process
+        # doesn't load; "fit" aims at the upload limit, so the best capped there
+        best = estimate_selection(info, "bv*+ba/b")
+        return min(best, UPLOAD_LIMIT * FIT_HEADROOM) if best else None
+    return estimate_selection(info, fmt)
+
+
+def classify(fmt: str, info: dict = None):
+    """(lane, cost in MB) of a request for `fmt`, from the probed info dict if there is one"""
+    if fmt in ("album", "album_zip"):
+        # the parent job only lists tracks, every track is scheduled on its own
+        return "short", 1.0
+    # as picked by a worker with ffmpeg (the image has it), whatever this host has
+    fmt = selector(fmt, ffmpeg=True)
+    size = _estimate(info, fmt) if info else None
+    if size is None:
+        duration = (info or {}).get("duration")
+        if not duration:
+            return "standard", QUANTUM_MB
+        # ~160 kbit/s audio, ~2.5 Mbit/s video
+        size = duration * (160 if _audio_only(fmt) else 2500) * 1000 / 8
+    mb = size / 2 ** 20
+    if mb <= LANE_SHORT_MAX_MB:
+        return "short", max(mb, 1.0)
+    return ("heavy" if mb >= LANE_HEAVY_MIN_MB else "standard"), mb
+
+
+def enqueue(func: str, *args, user_id: int, lane: str, cost: float, job_timeout: int, retry=None,
+            pipeline=None) -> Job:
+    """
+    Create an RQ job and file it under user_id in lane (executed on `pipeline` if given).
+    RQ puts retries (`retry`: rq.Retry) into the plain queue list, next_job() takes them from there.
+    """
+    r = get_redis()
+    queue = Queue(QUEUE_NAME, connection=r)
+    job = queue.create_job(func, args=args, timeout=job_timeout, retry=retry,
+                           meta={"sched": {"user": user_id, "lane": lane}})
+    job.enqueued_at = utcnow()
+    pipe = pipeline if pipeline is not None else r.pipeline()
+    pipe.sadd(queue.redis_queues_keys, queue.key)
+    job.save(pipeline=pipe)
+    _script(_SUBMIT)(args=[lane, user_id, job.id, round(cost, 2), job_timeout + LEASE_GRACE], client=pipe)
+    if pipeline is None:
+        pipe.execute()
+    return job
+
+
+def queue_depths() -> dict:
+    """Waiting jobs per lane (+ "legacy": jobs in the plain RQ list)"""
+    r = get_redis()
+    with r.pipeline(transaction=False) as pipe:
+        for lane in LANES:
+            pipe.lrange(f"sched:{lane}:ring", 0, -1)
+        rings = pipe.execute()
+        for lane, users in zip(LANES, rings):
+            for user in users:
+                pipe.llen(f"sched:{lane}:u:{user.decode()}")
+        lengths = iter(pipe.execute())
+    depths = {lane: sum(next(lengths) for _ in users) for lane, users in zip(LANES, rings)}
+    depths["legacy"] = Queue(QUEUE_NAME, connection=r).count
+    return depths
+
+
+def running_jobs() -> int:
+    """Jobs started and not finished, all workers"""
+    return Queue(QUEUE_NAME, connection=get_redis()).started_job_registry.count
+
+
+async def queue_position(r, job_id: str, user_id, lane: str):
+    """
+    Rough number of jobs starting before a waiting one (every other user in the
+    lane gets a turn per round), None once it left the queue. `r`: asyncio Redis.
+    """
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.lpos(f"sched:{lane}:u:{user_id}", job_id)
+        pipe.llen(f"sched:{lane}:ring")
+        index, users = await pipe.execute()
+    if index is None:
+        return None
+    return index + (users - 1) * (index + 1)
+
+
+def release(job: Job):
+    """Give the job's user/lane slot back (idempotent)"""
+    sched = job.meta.get("sched")
+    if not sched:
+        return
+    with get_redis().pipeline() as pipe:
+        pipe.zrem(f"sched:running:{sched['user']}", job.id)
+        pipe.zrem(f"sched:{sched['lane']}:running", job.id)
+        pipe.lpush(_WAKEUP, 1)
+        pipe.ltrim(_WAKEUP, 0, 99)
+        pipe.execute()
+
+
+def _sweep_albums(album_key: str = None):
+    # album tracks whose job died without reporting (downloader/album.py);
+    # imported here, the web process loads this module too
+    from downloader import album
+    try:
+        album.sweep(album_key)
+    except Exception:
+        logger.exception("Album sweep failed")
+
+
+def _release_inflight(job: Job):
+    # a download that died before its own inflight.finish() (killed horse) and
+    # won't be retried: free the link for the next request, tell its watchers
+    if job.get_status() != JobStatus.FAILED:
+        return
+    if job.func_name == "downloader.task.download_job":
+        url, fmt = job.args[0], job.args[1]
+    elif job.func_name == "downloader.album.album_job":
+        url, fmt = job.args[0], "album_zip" if len(job.args) > 2 and job.args[2] else "album"
+    else:
+        return
+    try:
+        inflight.release(url, fmt, job.id)
+        progress.publish(job.id, "failed")
+    except Exception:
+        logger.exception("Releasing %s failed", job.id)
+
+
+def _dispatch(lanes):
+    args = [time.time(), USER_MAX_RUNNING, QUANTUM_MB]
+    for lane in lanes:
+        args += [lane, LANE_HEAVY_MAX_RUNNING if lane == "heavy" else 0]
+    while True:
+        picked = _script(_DISPATCH)(args=args)
+        if not picked:
+            return None
+        job_id, lane, user = (v.decode() for v in picked)
+        try:
+            job = Job.fetch(job_id, connection=get_redis())
+        except NoSuchJobError:
+            # expired or deleted while waiting
+            with get_redis().pipeline() as pipe:
+                pipe.zrem(f"sched:running:{user}", job_id)
+                pipe.zrem(f"sched:{lane}:running", job_id)
+                pipe.execute()
+            continue
+        if job.enqueued_at:
+            QUEUE_WAIT_SECONDS.labels(lane).observe((utcnow() - job.enqueued_at).total_seconds())
+        return job, Queue(job.origin, connection=get_redis())
+
+
+def next_job(lanes=WORKER_LANES, timeout: int = None):
+    """
+    Next job for a worker slot that may run `lanes`: (job, queue) or None.
+    Waits up to `timeout` seconds for a submit/release, then tries once more.
+    """
+    found = _dispatch(lanes)
+    if found is None:
+        # jobs put straight into the RQ list (old bot processes, rq CLI)
+        try:
+            found = Queue.dequeue_any([Queue(QUEUE_NAME, connection=get_redis())], None,
+                                      connection=get_redis())
+        except DequeueTimeout:
+            found = None
+    if found is None and timeout:
+        get_redis().blpop(_WAKEUP, timeout)
+        found = _dispatch(lanes)
+    return found
+
+
+class FairWorker(Worker):
+    """RQ worker that takes jobs from the scheduler instead of popping the queue list"""
+
+    def __init__(self, *args, lanes=WORKER_LANES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lanes = lanes
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        self.set_state(WorkerStatus.IDLE)
+        self.procline("Listening on " + ",".join(self.lanes))
+        connection_wait_time = 1.0
+        result = None
+        while True:
+            try:
+                self.heartbeat()
+                if self.should_run_maintenance_tasks:
+                    self.run_maintenance_tasks()
+                result = next_job(self.lanes, timeout)
+                # burst mode (timeout None) returns right away
+                if result is not None or timeout is None:
+                    break
+            except redis.exceptions.ConnectionError as conn_err:
+                self.log.error("Could not connect to Redis instance: %s Retrying in %d seconds...",
+                               conn_err, connection_wait_time)
+                time.sleep(connection_wait_time)
+                connection_wait_time = min(connection_wait_time * self.exponential_backoff_factor,
+                                           self.max_connection_wait_time)
+            else:
+                connection_wait_time = 1.0
+        if result is not None:
+            self.log.info("%s: %s", result[0].meta.get("sched", {}).get("lane", result[1].name), result[0].id)
+        self.heartbeat()
+        return result
+
+    def execute_job(self, job, queue):
+        try:
+            super().execute_job(job, queue)
+        finally:
+            # the job's forked process is gone: fold its metric files away
+            prune_metrics()
+
+    def handle_job_success(self, job, queue, started_job_registry):
+        try:
+            super().handle_job_success(job, queue, started_job_registry)
+        finally:
+            release(job)
+
+    def handle_job_failure(self, job, queue, started_job_registry=None, exc_string=""):
+        try:
+            super().handle_job_failure(job, queue, started_job_registry=started_job_registry,
+                                       exc_string=exc_string)
+        finally:
+            release(job)
+        # a killed work horse never ran the job's own bookkeeping
+        if job.func_name == "downloader.album.track_job":
+            _sweep_albums(job.args[0])
+        _release_inflight(job)
+
+    def run_maintenance_tasks(self):
+        super().run_maintenance_tasks()
+        _sweep_albums()
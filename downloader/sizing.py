@@ -0,0 +1,80 @@
+import re
+
+_HEIGHT_LIMIT = re.compile(r"\[height<=\??(\d+)\]")
+
+
+def format_size(fmt: dict, duration=None):
+    """Best guess of one format's size in bytes, None if unknown"""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return int(size)
+    tbr = fmt.get("tbr") or ((fmt.get("vbr") or 0) + (fmt.get("abr") or 0))
+    duration = fmt.get("duration") or duration
+    if tbr and duration:
+        return int(tbr * 1000 / 8 * duration)  # tbr is kbit/s
+    return None
+
+
+def estimate_size(info: dict):
+    """Expected download size of a processed info dict (selected formats), None if unknown"""
+    if info.get("_type") == "playlist":
+        sizes = [estimate_size(e) for e in info.get("entries") or [] if e]
+        return sum(sizes) if sizes and None not in sizes else None
+    duration = info.get("duration")
+    requested = info.get("requested_formats")
+    if requested:
+        sizes = [format_size(f, duration) for f in requested]
+        return sum(sizes) if None not in sizes else None
+    return format_size(info, duration)
+
+
+def _largest(formats, duration, pred):
+    sizes = [format_size(f, duration) for f in formats if pred(f)]
+    sizes = [s for s in sizes if s]
+    return max(sizes) if sizes else None
+
+
+_SELECTORS = {
+    "bestaudio": lambda f: f.get("vcodec") == "none" and f.get("acodec") != "none",
+    "bestvideo": lambda f: f.get("vcodec") != "none" and f.get("acodec") == "none",
+    "best": lambda f: f.get("vcodec") != "none" and f.get("acodec") != "none",
+}
+_SELECTORS.update({"ba": _SELECTORS["bestaudio"], "bv": _SELECTORS["bestvideo"], "b": _SELECTORS["best"],
+                   "bv*": lambda f: f.get("vcodec") != "none", "b*": lambda f: True})
+
+
+def _matcher(part: str):
+    pred = _SELECTORS.get(part.split("[")[0], lambda f: True)
+    limit = _HEIGHT_LIMIT.search(part)
+    if limit is None:
+        return pred
+    return lambda f: pred(f) and (f.get("height") or 0) <= int(limit.group(1))
+
+
+def estimate_selection(info: dict, selector: str):
+    """
+    Rough size of what a format selector ("bestaudio", "bestvideo+bestaudio/best", "137")
+    would download from an unprocessed info dict; None if unknown.
+    Only the first alternative is considered, "best" means "largest" and of the
+    filters only [height<=N] is applied. A callable selector is run on the formats.
+    """
+    formats = info.get("formats") or [info]
+    duration = info.get("duration")
+    if callable(selector):
+        ctx = {"formats": formats,
+               "has_merged_format": any("none" not in (f.get("acodec"), f.get("vcodec")) for f in formats),
+               "incomplete_formats": (all(f.get("vcodec") == "none" for f in formats)
+                                      or all(f.get("acodec") == "none" for f in formats))}
+        picked = next(selector(ctx), None)
+        return estimate_size({"duration": duration, **picked}) if picked else None
+    total = 0
+    for part in selector.split("/")[0].split("+"):
+        exact = [f for f in formats if f.get("format_id") == part]
+        if exact:
+            size = format_size(exact[0], duration)
+        else:
+            size = _largest(formats, duration, _matcher(part))
+        if size is None:
+            return None
+        total += size
+    return total
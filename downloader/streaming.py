@@ -0,0 +1,50 @@
+import os
+import sys
+import json
+import logging
+import tempfile
+import subprocess
+from utils.s3 import stream_upload
+
+logger = logging.getLogger("downloader.streaming")
+
+# Large files go straight from yt-dlp's stdout into a multipart S3 upload:
+# upload overlaps the download and nothing but the (small) info json touches disk.
+STREAM_UPLOAD = os.getenv("STREAM_UPLOAD", "1") == "1"
+
+
+def stream_ext(info: dict) -> str:
+    """Container yt-dlp produces when writing this info to stdout"""
+    protocol = info.get("protocol") or ""
+    # merged mp4 and HLS are muxed by ffmpeg as mpegts when piped
+    if (info.get("requested_formats") and info.get("ext") == "mp4") or protocol.startswith("m3u8"):
+        return "ts"
+    return info.get("ext") or "bin"
+
+
+def stream_to_s3(info: dict, key: str, connections: int = 1) -> str:
+    """Download the selected format(s) of a processed info dict directly into S3"""
+    from yt_dlp.utils import DownloadError
+    with tempfile.NamedTemporaryFile("w", suffix=".info.json") as info_file, \
+            tempfile.TemporaryFile() as stderr:
+        json.dump(info, info_file)
+        info_file.flush()
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "yt_dlp", "--load-info-json", info_file.name,
+             "-f", info["format_id"], "-o", "-", "-N", str(connections),
+             "--quiet", "--no-warnings", "--no-progress"],
+            stdout=subprocess.PIPE, stderr=stderr,
+        )
+
+        def check_exit():
+            if proc.wait() != 0:
+                stderr.seek(0)
+                raise DownloadError(stderr.read().decode(errors="replace")[-300:].strip())
+
+        try:
+            return stream_upload(proc.stdout, key, before_complete=check_exit)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
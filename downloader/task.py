@@ -1,56 +1,249 @@
 import os
-import subprocess
-import shutil
-from redis import Redis
+import uuid
+import logging
 from rq import get_current_job
-from aiogram import Bot
+from rq.timeouts import JobTimeoutException
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError
+from aiogram.exceptions import TelegramBadRequest
+
+from downloader import result_cache, inflight, progress, parallel, postprocess, routing
+from downloader.sizing import estimate_size
+from downloader.workspace import workspace, discard
+from downloader.streaming import stream_ext, stream_to_s3
+from utils import telegram_client
+from utils.s3 import upload_file_key, presign
+from utils.info_store import load_info
+from utils.validation import sanitize_filename
+from utils.metrics import DOWNLOAD_SECONDS, FAILURES, RETRIES
+
+logger = logging.getLogger("downloader.task")
 
 # ========================
 # Переменные окружения
 # ========================
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-CDN_BASE_URL = os.getenv("CDN_BASE_URL", "https://example.com/files/")  # пример ссылки, замените на S3/Cloudflare
-MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB
+MAX_FILE_SIZE = telegram_client.UPLOAD_LIMIT  # 50 MB, 2000 MB with a local Bot API server
+SIGNATURE = "Скачано через [Freedom Downloader](https://t.me/freedom_downloadbot)"
+
+
+def _send_file(chat_id: int, document):
+    """Send local path or file_id, return file_id of the sent document"""
+    msg = telegram_client.send_document(chat_id, document, caption=SIGNATURE, parse_mode="Markdown")
+    return msg.document.file_id if msg.document else None
+
+
+def _send_link(chat_id: int, url: str):
+    telegram_client.send_text(chat_id,
+                              f"Файл слишком большой для Telegram. Скачивайте по ссылке: {url}\n{SIGNATURE}",
+                              parse_mode="Markdown")
+
+
+def _bad_file_id(error: TelegramBadRequest) -> bool:
+    # "wrong file identifier/HTTP URL specified", "wrong remote file identifier specified", ...
+    text = str(error).lower()
+    return "file identifier" in text or "file_id" in text
+
+
+def _send_cached(chat_id: int, hit: dict):
+    """
+    Deliver a cached result without downloading; None if the cache entry is unusable.
+    Other Telegram errors (flood, blocked bot, network) say nothing about the entry: they're raised.
+    """
+    if hit.get("file_id"):
+        try:
+            _send_file(chat_id, hit["file_id"])
+            return [("file_id", hit["file_id"])]
+        except TelegramBadRequest as e:
+            if not _bad_file_id(e):
+                raise
+            logger.warning("Cached file_id rejected: %s", e)
+    if hit.get("s3_key"):
+        url = presign(hit["s3_key"])
+        _send_link(chat_id, url)
+        return [("link", url)]
+    return None
+
+
+def _deliver(chat_id: int, file_path: str, cache_id: tuple = None):
+    """Send one downloaded file, return ("file_id", id) or ("link", url) for fan-out"""
+    # Проверяем размер
+    file_size = os.path.getsize(file_path)
+    if file_size < MAX_FILE_SIZE:
+        # Отправляем файл напрямую
+        file_id = _send_file(chat_id, file_path)
+        if cache_id and file_id:
+            result_cache.put(*cache_id, file_id=file_id)
+        return "file_id", file_id
+    # Большой файл — в S3 и presigned-ссылка
+    file_name = os.path.basename(file_path)
+    if cache_id:
+        key = upload_file_key(file_path, key=f"downloads/{'/'.join(cache_id)}/{file_name}")
+        result_cache.put(*cache_id, s3_key=key)
+    else:
+        key = upload_file_key(file_path)
+    url = presign(key)
+    _send_link(chat_id, url)
+    return "link", url
+
+
+def _stream_deliver(chat_id: int, info: dict, cache_id: tuple, job_id: str, worker: str = None):
+    """Stream a known-oversized file straight to S3 (no local copy) and send the link"""
+    file_name = f"{sanitize_filename(info.get('title') or info['id'])}.{stream_ext(info)}"
+    with parallel.connections(job_id, parallel.hosts(info), worker) as granted:
+        key = stream_to_s3(info, f"downloads/{'/'.join(cache_id)}/{file_name}", connections=granted)
+    result_cache.put(*cache_id, s3_key=key)
+    url = presign(key)
+    _send_link(chat_id, url)
+    return "link", url
+
+
+def _fan_out(chat_ids, delivered, error: Exception = None):
+    """Deliver the job's result to chats that attached to it while it was in flight"""
+    for chat_id in chat_ids:
+        try:
+            if error is not None:
+                telegram_client.send_text(chat_id, f"Произошла ошибка при скачивании: {error}")
+                continue
+            for kind, value in delivered:
+                if kind == "file_id" and value:
+                    _send_file(chat_id, value)
+                elif kind == "link":
+                    _send_link(chat_id, value)
+        except Exception:
+            logger.exception("Fan-out to %s failed", chat_id)
+
+
+def _downloaded_files(info: dict):
+    """Final file paths (after merge/postprocessing) of a processed info dict"""
+    if info.get("_type") == "playlist":
+        return [p for entry in info.get("entries") or [] if entry for p in _downloaded_files(entry)]
+    return [d["filepath"] for d in info.get("requested_downloads") or [] if d.get("filepath")]
+
+
+def _resolve(ydl: YoutubeDL, url: str, info_token: str = None):
+    """Info dict with formats selected; reuses the bot's probe when possible"""
+    info = load_info(info_token) if info_token else None
+    if info is not None:
+        try:
+            return ydl.process_ie_result(info, download=False), True
+        except Exception as e:
+            logger.warning("Cached info for %s unusable (%s), extracting again", url, e)
+    return ydl.extract_info(url, download=False), False
+
+
+def _will_retry(job, error: Exception) -> bool:
+    """RQ runs the job again after this error (and it continues the partial download)"""
+    return bool(job and job.retries_left) and isinstance(error, (DownloadError, JobTimeoutException))
 
-bot = Bot(token=BOT_TOKEN)
 
 # ========================
 # Функция задачи для очереди
 # ========================
-def download_job(url: str, chat_id: int):
+def download_job(url: str, fmt: str, chat_id: int, info_token: str = None):
+    # playlist links, errors and fan-out texts leave as one message per chat
+    with telegram_client.batched():
+        _download(url, fmt, chat_id, info_token)
+
+
+def _download(url: str, fmt: str, chat_id: int, info_token: str = None):
     job = get_current_job()
-    tmp_dir = "/tmp/freedom_download"
-    os.makedirs(tmp_dir, exist_ok=True)
+    # stable over RQ retries: the retry finds the previous attempt's partial files
+    job_id = job.id if job else uuid.uuid4().hex
+    worker = job.worker_name if job else None
+    # статус для пользователя (bot/progress.py редактирует сообщение)
+    reporter = progress.Reporter(job_id)
 
-    # Опции yt-dlp
+    # Опции yt-dlp (каталог задаётся после резервирования места, см. workspace);
+    # формат и постобработка — из профиля ("mp3", "720p") или селектор как есть
     ydl_opts = {
-        'outtmpl': f'{tmp_dir}/%(title)s.%(ext)s',
-        'format': 'best',
+        'outtmpl': '%(title)s.%(ext)s',
+        **postprocess.ydl_options(fmt),
         'noplaylist': False,
+        'progress_hooks': [reporter.hook],
+        'postprocessor_hooks': [reporter.pp_hook],
     }
 
+    delivered, error, extractor = [], None, "unknown"
+    downloading = retrying = False
     try:
         with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            file_path = ydl.prepare_filename(info)
-
-        # Проверяем размер
-        file_size = os.path.getsize(file_path)
-        if file_size < MAX_FILE_SIZE:
-            # Отправляем файл напрямую
-            with open(file_path, 'rb') as f:
-                bot.send_document(chat_id, f,
-                                  caption=f"Скачано через [Freedom Downloader](https://t.me/freedom_downloadbot)")
-        else:
-            # Если большой файл — отправляем ссылку (пример)
-            file_name = os.path.basename(file_path)
-            download_link = f"{CDN_BASE_URL}{file_name}"
-            bot.send_message(chat_id,
-                             f"Файл слишком большой для Telegram. Скачивайте по ссылке: {download_link}\n"
-                             f"Скачано через [Freedom Downloader](https://t.me/freedom_downloadbot)")
+            postprocess.add_postprocessors(ydl, fmt)
+            info, from_probe = _resolve(ydl, url, info_token)
+            extractor = info.get("extractor_key") or extractor
+
+            # Одиночное видео: сначала смотрим в кэш результатов
+            cache_id = None
+            if info.get("_type", "video") == "video":
+                # source format + output profile: a conversion is made once per video
+                cache_id = (info["extractor_key"], info["id"], postprocess.cache_format(info, fmt))
+                hit = result_cache.get(*cache_id)
+                if hit:
+                    delivered = _send_cached(chat_id, hit)
+                    if delivered:
+                        logger.info("Result cache hit %s", cache_id)
+                        return
+                    delivered = []
+                    result_cache.invalidate(*cache_id)
+
+            # Маршрут доставки решается до скачивания (downloader/routing.py):
+            # заведомо больше лимита Telegram — качаем сразу в S3, минуя диск
+            route = routing.route(info, postprocess.converts(fmt))
+            logger.info("Job %s: ~%s bytes, route %s", job_id, estimate_size(info), route)
+            if cache_id and route == routing.S3_STREAM:
+                reporter.stage("uploading")
+                try:
+                    delivered.append(_stream_deliver(chat_id, info, cache_id, job_id, worker))
+                except DownloadError:
+                    if not from_probe:
+                        raise
+                    logger.warning("Streaming from cached info failed for %s, extracting again", url)
+                    RETRIES.labels("reextract").inc()
+                    info = ydl.extract_info(url, download=False)
+                    delivered.append(_stream_deliver(chat_id, info, cache_id, job_id, worker))
+                return
+
+            # Своя папка на задачу + резерв места под ожидаемый размер;
+            # при сбое частичные файлы остаются для повторной попытки
+            with workspace(job_id, estimate_size(info), resumable=True) as tmp_dir:
+                ydl.params['paths'] = {'home': tmp_dir}
+                # connections to the source are capped per host and per worker
+                with parallel.connections(job_id, parallel.hosts(info), worker) as granted, \
+                        DOWNLOAD_SECONDS.labels(extractor).time():
+                    ydl.params.update(parallel.ydl_options(granted))
+                    ydl.add_post_processor(parallel.RangeSplitPP(ydl, granted), when='before_dl')
+                    downloading = True
+                    try:
+                        info = ydl.process_ie_result(info, download=True)
+                    except DownloadError:
+                        if not from_probe:
+                            raise
+                        # signed media URLs of the probe expired/revoked earlier than advertised
+                        logger.warning("Download from cached info failed for %s, extracting again", url)
+                        RETRIES.labels("reextract").inc()
+                        info = ydl.extract_info(url, download=True)
+                    downloading = False
+
+                reporter.stage("uploading")
+                for file_path in _downloaded_files(info):
+                    delivered.append(_deliver(chat_id, file_path, cache_id))
     except Exception as e:
-        bot.send_message(chat_id, f"Произошла ошибка при скачивании: {e}")
+        if downloading and _will_retry(job, e):
+            # RQ requeues the job; waiters stay attached, partial files stay on disk
+            retrying = True
+            RETRIES.labels("download").inc()
+            logger.warning("Job %s interrupted (%s), %d retries left", job_id, e, job.retries_left)
+            raise
+        error = e
+        discard(job_id)
+        FAILURES.labels(extractor).inc()
+        logger.exception("Job %s failed", job_id)
+        telegram_client.send_text(chat_id, f"Произошла ошибка при скачивании: {e}")
     finally:
-        # Убираем временные файлы
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if retrying:
+            reporter.stage("queued")
+        else:
+            reporter.stage("failed" if error else "done")
+            # Раздаём результат всем, кто ждал ту же ссылку/формат
+            waiters = [c for c in inflight.finish(url, fmt) if c != chat_id]
+            if waiters:
+                _fan_out(waiters, delivered, error)
@@ -0,0 +1,54 @@
+import os
+import time
+import fcntl
+import logging
+from contextlib import contextmanager
+from yt_dlp.postprocessor import FFmpegExtractAudioPP
+
+from utils.metrics import TRANSCODES
+
+logger = logging.getLogger("downloader.transcode")
+
+# Encodes wait for a slot of a host-wide pool (flock slots, shared by fork
+# workers and async worker threads), so a burst of audio requests can't starve
+# everything else of CPU. Stream copies don't take a slot.
+TRANSCODE_CONCURRENCY = int(os.getenv("TRANSCODE_CONCURRENCY", str(os.cpu_count() or 1)))
+ENCODE_THREADS = max(1, (os.cpu_count() or 1) // TRANSCODE_CONCURRENCY)
+SLOTS_DIR = os.getenv("TRANSCODE_SLOTS_DIR", "/tmp/freedom_transcode")
+
+
+@contextmanager
+def encode_slot():
+    """Hold one of TRANSCODE_CONCURRENCY host-wide encode slots"""
+    os.makedirs(SLOTS_DIR, exist_ok=True)
+    started = time.monotonic()
+    while True:
+        for i in range(TRANSCODE_CONCURRENCY):
+            lock = open(os.path.join(SLOTS_DIR, f"slot{i}"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            waited = time.monotonic() - started
+            if waited > 1:
+                logger.info("Waited %.1fs for an encode slot", waited)
+            try:
+                yield
+                return
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+        time.sleep(0.5)
+
+
+class PooledExtractAudioPP(FFmpegExtractAudioPP):
+    """yt-dlp audio extraction: stream copies run right away, encodes in the pool"""
+
+    def run_ffmpeg(self, path, out_path, codec, more_opts):
+        if codec == "copy":
+            TRANSCODES.labels("copy").inc()
+            return super().run_ffmpeg(path, out_path, codec, more_opts)
+        TRANSCODES.labels("encode").inc()
+        with encode_slot():
+            return super().run_ffmpeg(path, out_path, codec, [*more_opts, "-threads", str(ENCODE_THREADS)])
@@ -1,12 +1,33 @@
 import os
-import redis
-from rq import Worker, Queue, Connection
+from rq import Connection
+from utils import metrics, s3
+from utils.redis_client import get_redis
+from downloader import workspace, scheduler
+from downloader.scheduler import FairWorker
 
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-conn = redis.from_url(REDIS_URL)
+# "fork": classic RQ worker, one forked process per job
+# "asyncio": WORKER_CONCURRENCY jobs at once in one process (downloader/aio_worker.py)
+WORKER_MODE = os.getenv("WORKER_MODE", "fork")
 
 if __name__ == "__main__":
-    with Connection(conn):
-        qs = ["downloads"]
-        worker = Worker(qs)
+    qs = ["downloads"]
+    # /metrics of this host's workers (values of all job processes, see utils/metrics.py)
+    metrics.prune()
+    metrics.serve(metrics.registry(
+        metrics.CallbackGauge("freedom_queue_depth", "Waiting jobs", scheduler.queue_depths, "lane"),
+        metrics.CallbackGauge("freedom_jobs_in_progress", "Running jobs, all workers", scheduler.running_jobs),
+        metrics.CallbackGauge("freedom_disk_used_bytes", "Workspace disk usage on this host", workspace.usage),
+    ))
+    if WORKER_MODE == "asyncio":
+        from downloader import aio_worker
+        aio_worker.main(qs)
+        raise SystemExit(0)
+    # leftovers of jobs killed together with the previous worker
+    workspace.janitor()
+    # the web process never loads yt-dlp or boto3; here they are set up once and
+    # every job's forked process inherits them
+    import downloader.task  # noqa: F401
+    s3.client()
+    with Connection(get_redis()):
+        worker = FairWorker(qs)
         worker.work()
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger("downloader.workspace")
+
+# Every job gets its own directory under DOWNLOAD_DIR and reserves disk space up
+# front. Reservations live in the workspace itself (.lease), so the host-wide
+# ledger is just "all live workspaces" and can't drift when a job crashes.
+# A resumable workspace outlives a failed attempt ("parked"), so the job's retry
+# continues its partial files; parked ones count at their real size and are the
+# first to go when a running job needs the space.
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "/tmp/freedom_download")
+DISK_BUDGET_BYTES = int(os.getenv("DISK_BUDGET_MB", "2048")) * 1024 * 1024
+DISK_WAIT_SECONDS = int(os.getenv("DISK_WAIT_SECONDS", "300"))
+DEFAULT_RESERVE_BYTES = int(os.getenv("DISK_DEFAULT_RESERVE_MB", "200")) * 1024 * 1024
+# separate video/audio streams + merged output sit on disk at the same time
+RESERVE_FACTOR = float(os.getenv("DISK_RESERVE_FACTOR", "2"))
+ORPHAN_MAX_AGE = int(os.getenv("DOWNLOAD_TIMEOUT", "1800")) + 600
+RESUME_TTL = int(os.getenv("RESUME_TTL", "3600"))  # how long partial files wait for a retry
+
+_LEASE = ".lease"
+_LOCK = ".lock"
+
+_held = set()  # workspaces in use by this process (async workers run many jobs per pid)
+
+
+class DiskBudgetExceeded(Exception):
+    """Not enough disk budget for the job (now or ever)"""
+
+
+@contextmanager
+def _locked():
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    with open(os.path.join(DOWNLOAD_DIR, _LOCK), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_lease(path: str):
+    try:
+        with open(os.path.join(path, _LEASE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_lease(path: str, **lease):
+    with open(os.path.join(path, _LEASE), "w") as f:
+        json.dump(lease, f)
+
+
+def _parked(lease) -> bool:
+    """Left by a failed attempt (or a killed process) and kept for a retry"""
+    return lease.get("parked") is not None or not _pid_alive(lease["pid"])
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _remove(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _is_orphan(path: str, lease) -> bool:
+    now = time.time()
+    if lease is None:
+        # no lease yet (being created) or legacy/foreign file: give it time
+        try:
+            return now - os.path.getmtime(path) > ORPHAN_MAX_AGE
+        except OSError:
+            return False
+    if _parked(lease):
+        if not lease.get("resumable"):
+            return True
+        return now - (lease.get("parked") or lease["created"]) > RESUME_TTL
+    return now - lease["created"] > ORPHAN_MAX_AGE
+
+
+def _sweep(skip: str = None):
+    """
+    Remove workspaces left by crashed/killed jobs and expired parked ones.
+    Returns bytes in use by the others (except `skip`) and the parked ones,
+    oldest first, as (path, size).
+    """
+    used, parked = 0, []
+    for name in os.listdir(DOWNLOAD_DIR) if os.path.isdir(DOWNLOAD_DIR) else []:
+        if name == _LOCK:
+            continue
+        path = os.path.join(DOWNLOAD_DIR, name)
+        lease = _read_lease(path) if os.path.isdir(path) else None
+        if path not in _held and _is_orphan(path, lease):
+            logger.info("Removing orphaned workspace %s", path)
+            _remove(path)
+            continue
+        if path == skip:
+            continue
+        size = dir_size(path) if os.path.isdir(path) else os.path.getsize(path)
+        if lease and path not in _held and _parked(lease):
+            parked.append((lease.get("parked") or lease["created"], path, size))
+            used += size
+        else:
+            used += max(size, lease["reserve"] if lease else 0)
+    return used, [(path, size) for _, path, size in sorted(parked)]
+
+
+def usage() -> int:
+    """Bytes on disk in all workspaces of this host"""
+    return dir_size(DOWNLOAD_DIR) if os.path.isdir(DOWNLOAD_DIR) else 0
+
+
+def janitor() -> int:
+    with _locked():
+        return _sweep()[0]
+
+
+def discard(job_id: str):
+    """Drop a parked workspace whose job won't be retried"""
+    path = os.path.join(DOWNLOAD_DIR, job_id)
+    with _locked():
+        if path not in _held:
+            _remove(path)
+
+
+@contextmanager
+def workspace(job_id: str, estimate_bytes: int = None, resumable: bool = False):
+    """
+    Private directory for one job with `estimate_bytes` of disk reserved.
+    Waits up to DISK_WAIT_SECONDS for budget, raises DiskBudgetExceeded otherwise.
+    `resumable`: if the job fails, keep the files for RESUME_TTL and hand them to
+    the next workspace() with the same job_id.
+    """
+    reserve = int(estimate_bytes * RESERVE_FACTOR) if estimate_bytes else DEFAULT_RESERVE_BYTES
+    if reserve > DISK_BUDGET_BYTES:
+        raise DiskBudgetExceeded(f"needs {reserve >> 20} MB, budget is {DISK_BUDGET_BYTES >> 20} MB")
+    path = os.path.join(DOWNLOAD_DIR, job_id)
+    deadline = time.monotonic() + DISK_WAIT_SECONDS
+    while True:
+        with _locked():
+            used, parked = _sweep(skip=path)
+            lease = _read_lease(path)
+            # a previous attempt still running (timed out, not dead yet): wait for it
+            busy = path in _held or (lease is not None and not _parked(lease))
+            while not busy and parked and used + reserve > DISK_BUDGET_BYTES:
+                victim, size = parked.pop(0)
+                logger.info("Evicting parked workspace %s", victim)
+                _remove(victim)
+                used -= size
+            if not busy and used + reserve <= DISK_BUDGET_BYTES:
+                if lease is not None:
+                    logger.info("Resuming in %s (%d MB kept)", path, dir_size(path) >> 20)
+                os.makedirs(path, exist_ok=True)
+                _write_lease(path, pid=os.getpid(), reserve=reserve, created=time.time(), resumable=resumable)
+                _held.add(path)
+                break
+        if time.monotonic() > deadline:
+            raise DiskBudgetExceeded(f"no disk budget for {reserve >> 20} MB after {DISK_WAIT_SECONDS}s")
+        time.sleep(2)
+    keep = False
+    try:
+        yield path
+    except BaseException:
+        if resumable:
+            with _locked():
+                _write_lease(path, pid=os.getpid(), reserve=reserve, created=time.time(), resumable=True,
+                             parked=time.time())
+            keep = True
+        raise
+    finally:
+        _held.discard(path)
+        if not keep:
+            shutil.rmtree(path, ignore_errors=True)
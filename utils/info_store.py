@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import zlib
+import secrets
+import logging
+from urllib.parse import urlparse, parse_qs
+from utils.redis_client import get_redis
+from utils.state_store import StateStore
+
+logger = logging.getLogger("utils.info_store")
+
+# The web process probes a link once; the worker downloads from that same info
+# dict instead of extracting again. Signed media URLs inside it expire (YouTube:
+# ~6h), so tokens live much shorter than that.
+INFO_TOKEN_TTL = int(os.getenv("INFO_TOKEN_TTL", "1800"))
+# refuse cached info whose media URLs expire sooner than this
+INFO_MIN_REMAINING = int(os.getenv("INFO_MIN_REMAINING", "600"))
+# the probe's own format selection (what yt-dlp drops for --load-info-json):
+# left in, it outlives the worker's selection and yt-dlp merges files it never got
+_SELECTION_KEYS = ("requested_formats", "requested_downloads", "requested_subtitles",
+                   "filepath", "_filename", "filename")
+
+
+# callback tokens of the web process; only the URL and the lanes are worth caching there
+_store = StateStore("info", INFO_TOKEN_TTL, cached_fields=("url", "sched"))
+
+
+def _key(token: str) -> str:
+    return f"info:{token}"
+
+
+def _values(info: dict, sched: dict = None) -> dict:
+    values = {
+        "url": info.get("webpage_url") or info.get("original_url") or "",
+        "info": zlib.compress(json.dumps(info).encode()),
+    }
+    if sched:
+        values["sched"] = json.dumps(sched, separators=(",", ":"))
+    return values
+
+
+async def put_info(info: dict, sched: dict = None) -> str:
+    """
+    Store sanitized info dict, return short token for callback_data.
+    sched: {format: (lane, cost)} worked out at probe time (downloader/scheduler.py)
+    """
+    token = secrets.token_urlsafe(8)
+    await _store.set(token, _values(info, sched))
+    return token
+
+
+def save_info(info: dict) -> str:
+    """put_info for workers (batch links probed by downloader/album.py)"""
+    token = secrets.token_urlsafe(8)
+    with get_redis().pipeline(transaction=False) as pipe:
+        pipe.hset(_key(token), mapping=_values(info)).expire(_key(token), INFO_TOKEN_TTL).execute()
+    return token
+
+
+async def get_url(token: str):
+    """Source URL for a token, None if expired"""
+    url = (await _store.get(token, "url")).get("url")
+    return url.decode() if url else None
+
+
+async def get_link(token: str, fmt: str):
+    """(source URL, (lane, cost) or None) of a token and format, (None, None) if expired"""
+    values = await _store.get(token, "url", "sched")
+    if not values.get("url"):
+        return None, None
+    sched = json.loads(values["sched"]).get(fmt) if values.get("sched") else None
+    return values["url"].decode(), tuple(sched) if sched else None
+
+
+def _media_expiry(info: dict):
+    """Earliest `expire=` of signed format URLs, None if the site doesn't sign them"""
+    expiries = []
+    for f in info.get("formats") or []:
+        values = parse_qs(urlparse(f.get("url") or "").query).get("expire")
+        if values and values[0].isdigit():
+            expiries.append(int(values[0]))
+    return min(expiries) if expiries else None
+
+
+def load_info(token: str):
+    """Cached info dict for the worker, or None if missing or stale"""
+    raw = get_redis().hget(_key(token), "info")
+    if raw is None:
+        return None
+    try:
+        info = json.loads(zlib.decompress(raw))
+    except Exception:
+        logger.warning("Corrupt info blob for token %s", token)
+        return None
+    expiry = _media_expiry(info)
+    if expiry is not None and expiry - time.time() < INFO_MIN_REMAINING:
+        return None
+    for key in _SELECTION_KEYS:
+        info.pop(key, None)
+    return info
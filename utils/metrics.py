@@ -0,0 +1,159 @@
+import os
+import glob
+import fcntl
+import logging
+import tempfile
+
+# Fork workers run every job in a new process, so values live in per-process
+# mmap files (prometheus_client multiprocess mode) and /metrics sums them up.
+# The directory has to be known before prometheus_client is imported.
+METRICS_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR",
+                                    os.path.join(tempfile.gettempdir(), "freedom_metrics"))
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+from prometheus_client import (  # noqa: E402
+    Counter, Histogram, CollectorRegistry, generate_latest, start_http_server, CONTENT_TYPE_LATEST,
+)
+from prometheus_client import multiprocess  # noqa: E402
+from prometheus_client.mmap_dict import MmapedDict  # noqa: E402
+from prometheus_client.core import GaugeMetricFamily  # noqa: E402
+
+logger = logging.getLogger("utils.metrics")
+
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9101"))
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+_FAST = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+_SLOW = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+
+# ========================
+# Web
+# ========================
+WEBHOOK_SECONDS = Histogram("freedom_webhook_seconds", "Webhook request (validate, dedup, queue)", buckets=_FAST)
+UPDATE_SECONDS = Histogram("freedom_update_seconds", "Update handling (handlers)", buckets=_FAST + (60, 120))
+INGRESS_UPDATES = Counter("freedom_ingress_updates", "Webhook deliveries", ["result"])
+PROBE_SECONDS = Histogram("freedom_probe_seconds", "Format probe (metadata extraction)", buckets=_SLOW)
+SEARCH_SECONDS = Histogram("freedom_search_seconds", "Search extraction", buckets=_SLOW)
+
+# ========================
+# Workers
+# ========================
+QUEUE_WAIT_SECONDS = Histogram("freedom_queue_wait_seconds", "Enqueue to start of a job", ["lane"], buckets=_SLOW)
+DOWNLOAD_SECONDS = Histogram("freedom_download_seconds", "yt-dlp download", ["extractor"], buckets=_SLOW)
+TRANSCODE_SECONDS = Histogram("freedom_transcode_seconds", "Post-processing step", ["postprocessor"],
+                              buckets=_SLOW)
+S3_UPLOAD_SECONDS = Histogram("freedom_s3_upload_seconds", "S3 upload", ["mode"], buckets=_SLOW)
+TELEGRAM_SEND_SECONDS = Histogram("freedom_telegram_send_seconds", "Bot API request", ["method"], buckets=_SLOW)
+TELEGRAM_RATE_WAIT_SECONDS = Histogram("freedom_telegram_rate_wait_seconds", "Wait for a send slot",
+                                       buckets=_FAST + (60, 120))
+
+CACHE_REQUESTS = Counter("freedom_cache_requests", "Cache lookups", ["cache", "result"])
+RETRIES = Counter("freedom_retries", "Retried operations", ["kind"])
+FAILURES = Counter("freedom_download_failures", "Failed downloads", ["extractor"])
+DELIVERY_ROUTES = Counter("freedom_delivery_routes", "Delivery route decided before download", ["route"])
+TRANSCODES = Counter("freedom_transcodes", "Audio extractions by kind (stream copy or encode)", ["kind"])
+
+
+class CallbackGauge:
+    """Gauge computed at scrape time: fn() returns a number or {label value: number}"""
+
+    def __init__(self, name: str, documentation: str, fn, label: str = None):
+        self.name, self.documentation, self.fn, self.label = name, documentation, fn, label
+
+    def collect(self):
+        gauge = GaugeMetricFamily(self.name, self.documentation, labels=[self.label] if self.label else None)
+        try:
+            values = self.fn()
+        except Exception:
+            logger.warning("Metric %s unavailable", self.name, exc_info=True)
+            return
+        if self.label:
+            for label, value in values.items():
+                gauge.add_metric([label], value)
+        else:
+            gauge.add_metric([], values)
+        yield gauge
+
+
+def _send_stats() -> dict:
+    # utils/rate_limit.py imports this module
+    from utils.rate_limit import stats
+    return stats()
+
+
+def registry(*collectors) -> CollectorRegistry:
+    """Registry that sums all processes' values, plus scrape-time collectors"""
+    reg = CollectorRegistry()
+    multiprocess.MultiProcessCollector(reg)
+    # the shared Telegram send queue (utils/rate_limit.py), same in web and workers
+    collectors += (
+        CallbackGauge("freedom_telegram_sends_waiting", "Sends waiting for a rate limit slot, all processes",
+                      lambda: _send_stats()["waiting"]),
+        CallbackGauge("freedom_telegram_rate_limit", "Sends through the rate limiter since start (sent, delayed, "
+                      "wait_ms, retry_after)",
+                      lambda: {k: v for k, v in _send_stats().items() if k != "waiting"}, "counter"),
+    )
+    for collector in collectors:
+        reg.register(collector)
+    return reg
+
+
+def render(reg: CollectorRegistry) -> bytes:
+    return generate_latest(reg)
+
+
+def serve(reg: CollectorRegistry, port: int = WORKER_METRICS_PORT):
+    """/metrics on a background thread (workers)"""
+    try:
+        start_http_server(port, registry=reg)
+    except OSError as e:
+        # several workers sharing a host (and METRICS_DIR): the first one serves them all
+        logger.warning("Metrics port %s unavailable (%s), not serving", port, e)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# summed over processes: a dead process' values move into one file per type
+_ARCHIVED = ("counter", "histogram", "summary")
+
+
+def _archive(path: str, kind: str):
+    archive = MmapedDict(os.path.join(METRICS_DIR, f"{kind}_archive.db"))
+    try:
+        for key, value, timestamp, _ in MmapedDict.read_all_values_from_file(path):
+            archive.write_value(key, archive.read_value(key)[0] + value, timestamp)
+    finally:
+        archive.close()
+
+
+def prune():
+    """
+    Fold value files of processes that are gone into the archive files (counters
+    and histograms keep their totals) and drop the rest (their gauges). Fork
+    workers leave one set per job, so this runs at worker start and after every
+    job (downloader/scheduler.py).
+    """
+    # workers of one host share METRICS_DIR
+    with open(os.path.join(METRICS_DIR, ".prune.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for path in glob.glob(os.path.join(METRICS_DIR, "*.db")):
+            name = os.path.basename(path)[:-3]
+            pid = name.rsplit("_", 1)[-1]
+            if not pid.isdigit() or int(pid) == os.getpid() or _pid_alive(int(pid)):
+                continue
+            kind = name.split("_", 1)[0]
+            try:
+                if kind in _ARCHIVED:
+                    _archive(path, kind)
+                os.remove(path)
+            except OSError:
+                logger.warning("Could not prune %s", path, exc_info=True)
+            multiprocess.mark_process_dead(int(pid), METRICS_DIR)
@@ -0,0 +1,143 @@
+import os
+import time
+import asyncio
+import logging
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from utils.redis_client import get_redis, get_async_redis
+from utils.metrics import TELEGRAM_SEND_SECONDS, TELEGRAM_RATE_WAIT_SECONDS, RETRIES
+
+logger = logging.getLogger("utils.rate_limit")
+
+# Outbound Bot API calls of every process (web + all workers) share token
+# buckets in Redis: one for the bot as a whole, one per chat. A 429 blocks the
+# chat's bucket for retry_after, so every process backs off, not only the one
+# that got it. Installed as an aiogram session middleware, so it covers
+# message.answer() in handlers as well as telegram_client calls in jobs.
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))  # msg/s, Telegram allows ~30
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))  # msg/s in a private chat
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", "0.33"))  # 20 msg/min in groups
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+SLOW_WAIT = 5  # log waits longer than this (seconds)
+
+# only these count against Telegram's limits
+_LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+_GLOBAL = "tg:rl:global"
+_STATS = "tg:rl:stats"
+_WAITING = "tg:rl:waiting"
+
+# KEYS: bucket hashes {tokens, ts, until}; ARGV[1] now (ms), then rate (per s) and
+# burst for each key. Takes a token from every bucket if all have one, returns 0;
+# otherwise takes nothing and returns ms until they would.
+_TAKE = """
+local now = tonumber(ARGV[1])
+local wait, tokens = 0, {}
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+    local v = redis.call('HMGET', key, 'tokens', 'ts', 'until')
+    local t = tonumber(v[1]) or burst
+    t = math.min(burst, t + (now - (tonumber(v[2]) or now)) * rate / 1000)
+    tokens[i] = t
+    if t < 1 then wait = math.max(wait, (1 - t) * 1000 / rate) end
+    local blocked = tonumber(v[3]) or 0
+    if blocked > now then wait = math.max(wait, blocked - now) end
+end
+for i, key in ipairs(KEYS) do
+    local t = tokens[i]
+    if wait == 0 then t = t - 1 end
+    redis.call('HSET', key, 'tokens', t, 'ts', now)
+    local blocked = tonumber(redis.call('HGET', key, 'until') or 0)
+    redis.call('PEXPIRE', key, math.max(60000, blocked - now))
+end
+return math.ceil(wait)
+"""
+_take_script = None
+
+
+def _buckets(chat_id):
+    keys, args = [_GLOBAL], [TG_GLOBAL_RATE, TG_GLOBAL_RATE]
+    if chat_id is not None:
+        rate = TG_GROUP_RATE if str(chat_id).startswith("-") else TG_CHAT_RATE
+        keys.append(f"tg:rl:chat:{chat_id}")
+        args += [rate, TG_CHAT_BURST]
+    return keys, args
+
+
+async def acquire(chat_id=None):
+    """Wait for a send slot (global + chat bucket); returns seconds waited"""
+    global _take_script
+    keys, args = _buckets(chat_id)
+    started = time.monotonic()
+    waiting = False
+    r = get_async_redis()
+    if _take_script is None:
+        _take_script = r.register_script(_TAKE)
+    try:
+        while True:
+            # clients are per event loop, so pass ours explicitly
+            wait_ms = await _take_script(keys=keys, args=[int(time.time() * 1000)] + args, client=r)
+            if not wait_ms:
+                break
+            if not waiting:
+                waiting = True
+                await r.incr(_WAITING)
+            await asyncio.sleep(wait_ms / 1000)
+    finally:
+        if waiting:
+            await r.decr(_WAITING)
+    waited = time.monotonic() - started
+    TELEGRAM_RATE_WAIT_SECONDS.observe(waited)
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.hincrby(_STATS, "sent", 1)
+        if waiting:
+            pipe.hincrby(_STATS, "delayed", 1)
+            pipe.hincrby(_STATS, "wait_ms", int(waited * 1000))
+        await pipe.execute()
+    if waited > SLOW_WAIT:
+        logger.warning("Send to %s waited %.1fs for a rate limit slot", chat_id, waited)
+    return waited
+
+
+async def penalize(chat_id, retry_after: float):
+    """Block the chat (or the whole bot if chat_id is None) for retry_after seconds"""
+    key = _buckets(chat_id)[0][-1]
+    until = int((time.time() + retry_after) * 1000)
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.hset(key, mapping={"until": until, "tokens": 0})
+        pipe.pexpire(key, max(60000, int(retry_after * 1000)))
+        pipe.hincrby(_STATS, "retry_after", 1)
+        await pipe.execute()
+
+
+def stats() -> dict:
+    """Counters since start: sent, delayed, wait_ms, retry_after; plus current waiting (/metrics, utils/metrics.py)"""
+    with get_redis().pipeline(transaction=False) as pipe:
+        raw, waiting = pipe.hgetall(_STATS).get(_WAITING).execute()
+    result = {k.decode(): int(v) for k, v in raw.items()}
+    result["waiting"] = int(waiting or 0)
+    return result
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """aiogram session middleware: shared rate limit + retry on 429"""
+
+    async def __call__(self, make_request, bot, method):
+        limited = method.__api_method__.startswith(_LIMITED_PREFIXES)
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(TG_MAX_RETRIES + 1):
+            if limited:
+                await acquire(chat_id)
+            try:
+                with TELEGRAM_SEND_SECONDS.labels(method.__api_method__).time():
+                    return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == TG_MAX_RETRIES:
+                    raise
+                RETRIES.labels("telegram_429").inc()
+                logger.warning("429 on %s to %s, retry after %ss", method.__api_method__, chat_id, e.retry_after)
+                if limited:
+                    # acquire() sits out the block, in this and every other process
+                    await penalize(chat_id, e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
@@ -0,0 +1,29 @@
+import os
+import asyncio
+import weakref
+import redis
+import redis.asyncio
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+_conn = None
+
+
+def get_redis() -> redis.Redis:
+    """Shared (sync) Redis connection for this process, created on first use"""
+    global _conn
+    if _conn is None:
+        _conn = redis.from_url(REDIS_URL)
+    return _conn
+
+
+_async_conns = weakref.WeakKeyDictionary()
+
+
+def get_async_redis() -> "redis.asyncio.Redis":
+    """Shared asyncio Redis client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    conn = _async_conns.get(loop)
+    if conn is None:
+        conn = _async_conns[loop] = redis.asyncio.from_url(REDIS_URL)
+    return conn
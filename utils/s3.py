@@ -1,26 +1,136 @@
 import os
-import boto3
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.metrics import S3_UPLOAD_SECONDS
+
+logger = logging.getLogger("utils.s3")
 
 S3_REGION = os.getenv("S3_REGION", "us-east-1")
 S3_BUCKET = os.getenv("S3_BUCKET")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+# MinIO (docker-compose), moto or another S3-compatible endpoint; unset = AWS
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+# lifetime of presigned links handed to users
+RESULT_TTL_SECONDS = int(os.getenv("RESULT_TTL_SECONDS", "86400"))
+# expiry of the bucket lifecycle rule on downloads/ (objects vanish after this)
+S3_OBJECT_TTL_SECONDS = int(os.getenv("S3_OBJECT_TTL_SECONDS", "259200"))
+# streaming multipart upload: S3 minimum part size is 5 MB
+S3_PART_SIZE = max(int(os.getenv("S3_PART_SIZE_MB", "16")), 5) * 1024 * 1024
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", "4"))
+# one client is shared by all jobs of an async worker
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50"))
 
-_session = boto3.session.Session()
-s3_client = _session.client(
-    "s3",
-    region_name=S3_REGION,
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-)
+# boto3 takes a while to import and set up: the client is built on first use
+# (the web process mostly never needs it)
+_client = None
+_client_lock = threading.Lock()
 
-def upload_file_preserve(path: str) -> str:
-    """Upload file and return presigned URL"""
-    key = f"downloads/{path.split('/')[-1]}"
-    s3_client.upload_file(path, S3_BUCKET, key)
-    url = s3_client.generate_presigned_url(
+def client():
+    """Shared S3 client, created on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            import boto3
+            from botocore.config import Config
+            _client = boto3.session.Session().client(
+                "s3",
+                region_name=S3_REGION,
+                aws_access_key_id=AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                endpoint_url=S3_ENDPOINT_URL,
+                config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                              s3={"addressing_style": "path"} if S3_ENDPOINT_URL else None),
+            )
+    return _client
+
+def upload_file_key(path: str, key: str = None) -> str:
+    """Upload file and return its object key"""
+    key = key or f"downloads/{path.split('/')[-1]}"
+    with S3_UPLOAD_SECONDS.labels("file").time():
+        client().upload_file(path, S3_BUCKET, key)
+    return key
+
+def presign(key: str, expires_in: int = None) -> str:
+    """Presigned GET URL for an existing object"""
+    return client().generate_presigned_url(
         "get_object",
         Params={"Bucket": S3_BUCKET, "Key": key},
-        ExpiresIn=int(os.getenv("RESULT_TTL_SECONDS", "86400")),
+        ExpiresIn=expires_in or RESULT_TTL_SECONDS,
     )
-    return url
+
+def download_file(key: str, path: str):
+    client().download_file(S3_BUCKET, key, path)
+
+def open_object(key: str):
+    """Streaming body (file-like) of an object"""
+    return client().get_object(Bucket=S3_BUCKET, Key=key)["Body"]
+
+def upload_file_preserve(path: str) -> str:
+    """Upload file and return presigned URL"""
+    return presign(upload_file_key(path))
+
+def _read_part(stream, size: int) -> bytes:
+    """Read exactly `size` bytes unless EOF (pipes return short reads)"""
+    chunks, left = [], size
+    while left:
+        chunk = stream.read(left)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        left -= len(chunk)
+    return b"".join(chunks)
+
+def stream_upload(stream, key: str, part_size: int = None, concurrency: int = None, before_complete=None) -> str:
+    """
+    Multipart-upload a binary stream while it is still being produced.
+    At most `concurrency` parts are in flight plus one being filled, so memory
+    is bounded by (concurrency + 1) * part_size. `before_complete()` runs at
+    EOF and may raise to abort (e.g. producer exited with an error).
+    The upload is aborted on any failure. Returns object key.
+    """
+    part_size = part_size or S3_PART_SIZE
+    concurrency = concurrency or S3_UPLOAD_CONCURRENCY
+    started = time.monotonic()
+    upload_id = client().create_multipart_upload(Bucket=S3_BUCKET, Key=key)["UploadId"]
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def upload_part(number: int, body: bytes):
+        try:
+            resp = client().upload_part(Bucket=S3_BUCKET, Key=key, UploadId=upload_id,
+                                        PartNumber=number, Body=body)
+            return {"PartNumber": number, "ETag": resp["ETag"]}
+        finally:
+            slots.release()
+
+    try:
+        futures = []
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            number = 1
+            while True:
+                body = _read_part(stream, part_size)
+                if not body and number > 1:
+                    break
+                slots.acquire()
+                futures.append(pool.submit(upload_part, number, body))
+                # fail fast instead of reading the whole stream into a dead upload
+                for fut in futures:
+                    if fut.done() and fut.exception():
+                        raise fut.exception()
+                if len(body) < part_size:
+                    break
+                number += 1
+            parts = [fut.result() for fut in futures]
+        if before_complete:
+            before_complete()
+        client().complete_multipart_upload(Bucket=S3_BUCKET, Key=key, UploadId=upload_id,
+                                           MultipartUpload={"Parts": parts})
+    except BaseException:
+        logger.warning("Aborting multipart upload of %s", key)
+        client().abort_multipart_upload(Bucket=S3_BUCKET, Key=key, UploadId=upload_id)
+        raise
+    # includes waiting for the producer: this is the whole streamed transfer
+    S3_UPLOAD_SECONDS.labels("stream").observe(time.monotonic() - started)
+    return key
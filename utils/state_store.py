@@ -0,0 +1,90 @@
+import os
+import time
+from collections import OrderedDict
+from utils.redis_client import get_async_redis
+
+# Small per-key Redis hashes of the web process (FSM state, search sessions,
+# callback tokens) behind an in-process write-through cache. Everything one
+# update reads of a key comes from a single HGETALL (or nothing, if this process
+# wrote or read it within STATE_CACHE_TTL); writes are one HSET+EXPIRE pipeline,
+# so every key expires unless it's in use. Replicas share Redis: a replica can
+# serve a value up to STATE_CACHE_TTL old that another one has just changed,
+# which is about as long as Telegram takes to deliver a chat's next update.
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "1"))
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "10000"))
+
+
+class StateStore:
+    """
+    Hashes under "<prefix>:<key>" with a TTL. Values are bytes (callers encode);
+    cached_fields limits what is kept in memory (None: everything).
+    """
+
+    def __init__(self, prefix: str, ttl: int, cached_fields=None):
+        self.prefix, self.ttl = prefix, ttl
+        self.cached_fields = set(cached_fields) if cached_fields is not None else None
+        self._cache = OrderedDict()  # key -> (expires, {field: bytes or None if absent}, complete)
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    def _cached(self, key: str):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry
+
+    def _remember(self, key: str, values: dict, complete: bool):
+        """Merge values into the cached view of key; complete: values are the whole hash"""
+        entry = self._cached(key)
+        if entry is not None and not complete:
+            values, complete = {**entry[1], **values}, entry[2]
+        if self.cached_fields is not None:
+            values = {f: v for f, v in values.items() if f in self.cached_fields}
+            complete = False
+        self._cache[key] = (time.monotonic() + STATE_CACHE_TTL, values, complete)
+        self._cache.move_to_end(key)
+        while len(self._cache) > STATE_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def get(self, key: str, *fields: str) -> dict:
+        """{field: bytes} of key (all fields if none given); absent fields are left out"""
+        entry = self._cached(key)
+        if entry is not None and (entry[2] or (fields and all(f in entry[1] for f in fields))):
+            values = entry[1]
+        elif fields:
+            values = dict(zip(fields, await get_async_redis().hmget(self._key(key), fields)))
+            self._remember(key, values, complete=False)
+        else:
+            raw = await get_async_redis().hgetall(self._key(key))
+            values = {f.decode(): v for f, v in raw.items()}
+            self._remember(key, values, complete=True)
+        wanted = fields or values
+        return {f: values[f] for f in wanted if values.get(f) is not None}
+
+    async def set(self, key: str, values: dict, ttl: int = None):
+        """Write fields of key and (re)start its TTL"""
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            await pipe.hset(self._key(key), mapping=values).expire(self._key(key), ttl or self.ttl).execute()
+        self._remember(key, {f: v.encode() if isinstance(v, str) else v for f, v in values.items()},
+                       complete=False)
+
+    async def take(self, key: str, *fields: str) -> dict:
+        """get() and delete key in one transaction: of concurrent callers only one gets the values"""
+        async with get_async_redis().pipeline(transaction=True) as pipe:
+            values, _ = await pipe.hmget(self._key(key), fields).delete(self._key(key)).execute()
+        self._remember(key, {}, complete=True)
+        return {f: v for f, v in zip(fields, values) if v is not None}
+
+    async def delete(self, key: str, *fields: str):
+        """Delete fields of key, or the whole key if none given"""
+        if fields:
+            await get_async_redis().hdel(self._key(key), *fields)
+            self._remember(key, dict.fromkeys(fields), complete=False)
+        else:
+            await get_async_redis().delete(self._key(key))
+            self._remember(key, {}, complete=True)
@@ -1,19 +1,163 @@
 import os
+import asyncio
 import logging
+import threading
+from contextlib import contextmanager
 from aiogram import Bot
-from aiogram.types import InputFile
-from aiogram.utils.exceptions import TelegramAPIError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import FSInputFile
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from utils.rate_limit import RateLimitMiddleware
 
 TOKEN = os.getenv("BOT_TOKEN")
-bot = Bot(token=TOKEN)
+# Bot API base URL: api.telegram.org if unset, else e.g. a stand-in (bench/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+# TELEGRAM_API_URL is a local Bot API server (telegram-bot-api --local): uploads up to 2000 MB
+TELEGRAM_API_LOCAL = os.getenv("TELEGRAM_API_LOCAL", "0") == "1"
+UPLOAD_LIMIT = (2000 if TELEGRAM_API_LOCAL else 50) * 1024 * 1024
+# file uploads get longer than the default 60 s request timeout
+UPLOAD_TIMEOUT = int(os.getenv("TELEGRAM_UPLOAD_TIMEOUT", "1800" if TELEGRAM_API_LOCAL else "300"))
 logger = logging.getLogger("utils.telegram_client")
 
-def send_text(user_id: int, text: str):
+# Job code is synchronous, aiogram is not: all calls go through one event loop
+# (a background thread, or the async worker's own loop via bind_loop), so the
+# Bot and its aiohttp session are reused between calls and jobs. Both belong
+# to the process that made them (_pid): a forked job process, whose copy of the
+# loop has no thread running it, starts its own on first call.
+_loop = None
+_bot = None
+_pid = None
+_inherited = None
+_lock = threading.Lock()
+_batch = threading.local()
+MAX_MESSAGE_LENGTH = 4096
+
+
+def _forked() -> bool:
+    """Drop the loop and Bot inherited from the parent process (call under _lock)"""
+    global _loop, _bot, _pid, _inherited
+    if _pid == os.getpid():
+        return False
+    # the parent's session lives on the parent's loop: keep it from being
+    # collected (and warned about as unclosed) here, but don't touch it
+    _inherited = (_loop, _bot)
+    _loop = _bot = None
+    _pid = os.getpid()
+    return True
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _lock:
+        _forked()
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="telegram-client", daemon=True).start()
+    return _loop
+
+
+def bind_loop(loop: asyncio.AbstractEventLoop):
+    """Run calls on an already running loop (async worker) instead of a private thread"""
+    global _loop
+    with _lock:
+        _forked()
+        _loop = loop
+
+
+async def close():
+    global _bot
+    if _bot is not None:
+        await _bot.session.close()
+        _bot = None
+
+
+def session() -> AiohttpSession:
+    """Bot session for TELEGRAM_API_URL with the shared rate limits"""
+    api = TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL) if TELEGRAM_API_URL else None
+    s = AiohttpSession(api=api) if api else AiohttpSession()
+    # shared Redis token buckets + retry_after (utils/rate_limit.py)
+    s.middleware(RateLimitMiddleware())
+    return s
+
+
+def _get_bot() -> Bot:
+    global _bot
+    with _lock:
+        _forked()
+        if _bot is None:
+            _bot = Bot(token=TOKEN, session=session())
+    return _bot
+
+
+def call(method: str, **kwargs):
+    """Run Bot API method (e.g. "send_message") from sync code and return its result"""
+    async def _call():
+        return await getattr(_get_bot(), method)(**kwargs)
+    loop = _get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError("telegram_client.call() would deadlock on its own loop; await the Bot directly")
+    return asyncio.run_coroutine_threadsafe(_call(), loop).result()
+
+
+def _join(texts):
+    """Glue texts into as few messages as Telegram's length limit allows"""
+    chunk = ""
+    for text in texts:
+        if chunk and len(chunk) + 2 + len(text) > MAX_MESSAGE_LENGTH:
+            yield chunk
+            chunk = ""
+        chunk = f"{chunk}\n\n{text}" if chunk else text
+    if chunk:
+        yield chunk
+
+
+@contextmanager
+def batched():
+    """
+    Hold this thread's plain send_text() calls and send them on exit, joined per
+    chat: a playlist's links or a fan-out cost one message per chat, not one each.
+    """
+    if getattr(_batch, "pending", None) is not None:
+        yield
+        return
+    _batch.pending = {}
     try:
-        bot.send_message(chat_id=user_id, text=text)
+        yield
+    finally:
+        pending, _batch.pending = _batch.pending, None
+        for (user_id, kwargs), texts in pending.items():
+            for text in _join(texts):
+                send_text(user_id, text, **dict(kwargs))
+
+
+def send_text(user_id: int, text: str, **kwargs):
+    """Returns the sent Message, None on failure or while batched()"""
+    pending = getattr(_batch, "pending", None)
+    if pending is not None and set(kwargs) <= {"parse_mode", "disable_web_page_preview"}:
+        pending.setdefault((user_id, tuple(sorted(kwargs.items()))), []).append(text)
+        return None
+    try:
+        return call("send_message", chat_id=user_id, text=text, **kwargs)
     except TelegramAPIError as e:
         logger.exception("Failed to send text to %s: %s", user_id, e)
 
+
+def send_document(user_id: int, document, caption: str = None, **kwargs):
+    """
+    document: local path or Telegram file_id.
+    Returns sent Message (raises TelegramAPIError).
+    """
+    if isinstance(document, str) and os.path.exists(document):
+        document = FSInputFile(document)
+        kwargs.setdefault("request_timeout", UPLOAD_TIMEOUT)
+    return call("send_document", chat_id=user_id, document=document, caption=caption, **kwargs)
+
+
 def send_document_or_link(user_id: int, payload: str, signature: str, external: bool=False):
     """
     payload: local path (if external=False) or URL
@@ -26,8 +170,10 @@ def send_document_or_link(user_id: int, payload: str, signature: str, external:
         send_text(user_id, message)
         return
     try:
-        doc = InputFile(payload)
-        bot.send_document(chat_id=user_id, document=doc, caption=message)
+        return send_document(user_id, payload, caption=message)
+    except TelegramRetryAfter:
+        # still flooded after the rate limiter's retries: a re-upload won't help
+        logger.error("Send to %s rate limited, giving up", user_id)
     except TelegramAPIError as e:
         logger.warning("Direct send failed, fallback to upload -> link")
         # fallback: upload to s3 and send link (requires upload)